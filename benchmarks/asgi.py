@@ -0,0 +1,66 @@
+""" asgi.py
+
+Latency and throughput of the read routes under many concurrent connections,
+sync gunicorn workers (boot.sh) against uvicorn serving book.asgi (boot_async.sh).
+
+    python -m benchmarks.asgi --records 100000 --concurrency 64 --output asgi.json
+"""
+import argparse
+import json
+import os
+import sys
+from book import db
+from benchmarks.common import setup_database, seed
+from benchmarks.routes import routes, start_server, server_env, gunicorn_argv, drive
+
+READS = ('index', 'search', 'holidays_period')
+
+
+def uvicorn_argv(workers):
+    """ uvicorn command line, as in boot_async.sh """
+    return [sys.executable, '-m', 'uvicorn', '--workers', str(workers), '--host', '127.0.0.1',
+            '--port', '{port}', '--log-level', 'warning', '--no-access-log',
+            'book.asgi:application']
+
+
+def main():
+    """ benchmark entry point """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--records', type=int, default=100000)
+    parser.add_argument('--requests', type=int, default=500, help='requests per route')
+    parser.add_argument('--workers', type=int, default=2, help='processes per server')
+    parser.add_argument('--concurrency', type=int, default=64, help='concurrent connections')
+    parser.add_argument('--cache', action='store_true', help='keep the page cache enabled')
+    parser.add_argument('--output', help='write JSON results to this file')
+    args = parser.parse_args()
+
+    path = setup_database()
+    try:
+        seed(args.records)
+        db.engine.dispose()
+        route_list = [route for route in routes(args.records) if route[0] in READS]
+        results = {'records': args.records, 'workers': args.workers,
+                   'concurrency': args.concurrency}
+        for server, argv in (('gunicorn', gunicorn_argv(args.workers)),
+                             ('uvicorn', uvicorn_argv(args.workers))):
+            process, port = start_server(argv, server_env(path, args.cache))
+            try:
+                results[server] = drive(port, route_list, args.requests, args.concurrency)
+            finally:
+                process.terminate()
+                process.wait()
+            for name, stats in results[server].items():
+                print('{:<9} {:<16} p50 {:>9.3f} ms  p95 {:>9.3f} ms  {:>8.1f} req/s'
+                      .format(server, name, stats['p50'], stats['p95'], stats['throughput']))
+    finally:
+        db.engine.dispose()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+""" common.py """
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import date, timedelta
+from sqlalchemy import insert
+from book import app, db
+from book.models import Record, Phone, Email, Address, Note, Tag, note_tags, \
+    name_key
+from book.search import rebuild
+from book.snapshots import rebuild_snapshots
+from book.upcoming import rebuild_upcoming
+
+
+FIRST_NAMES = ['Anna', 'Bohdan', 'Daria', 'Ivan', 'Kateryna', 'Maksym', 'Olena',
+               'Petro', 'Sofia', 'Taras', 'Vira', 'Yurii']
+TAGS = ['family', 'work', 'friend', 'school', 'gym', 'neighbour', 'doctor', 'club']
+CHUNK = 10000
+
+
+def setup_database(path=None):
+    """ point the app at a fresh benchmark database and create the schema """
+    if path is None:
+        handle, path = tempfile.mkstemp(suffix='.db', prefix='bench-')
+        os.close(handle)
+    app.config['TESTING'] = True
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    db.drop_all()
+    db.create_all()
+    return path
+
+
+def contact_rows(first, last, rng):
+    """ synthetic rows for records first..last-1, one child row of each kind and one tag """
+    records, phones, emails, addresses, notes, tagged = [], [], [], [], [], []
+    for i in range(first, last):
+        birthday = date(1950, 1, 1) + timedelta(days=rng.randrange(365 * 60))
+        name = '{} {}'.format(rng.choice(FIRST_NAMES), i)
+        records.append({'id': i, 'name': name, 'name_key': name_key(name),
+                        'birthday': birthday})
+        phones.append({'records_id': i, 'number': '380{:09d}'.format(i),
+                       'normalized': '+380{:09d}'.format(i)})
+        emails.append({'records_id': i, 'title': 'contact{}@example.com'.format(i)})
+        addresses.append({'records_id': i, 'title': 'st. Main {}'.format(i)})
+        notes.append({'id': i, 'records_id': i, 'title': 'note {}'.format(i)})
+        tagged.append({'notes_id': i, 'tags_id': rng.randrange(len(TAGS)) + 1})
+    return {Record.__table__: records, Phone.__table__: phones, Email.__table__: emails,
+            Address.__table__: addresses, Note.__table__: notes, note_tags: tagged}
+
+
+def seed(count, seed_value=0):
+    """ bulk insert count synthetic contacts and build the search index and snapshots """
+    rng = random.Random(seed_value)
+    with db.engine.begin() as connection:
+        connection.execute(insert(Tag.__table__), [
+            {'id': i, 'title': title} for i, title in enumerate(TAGS, start=1)])
+        for first in range(1, count + 1, CHUNK):
+            rows = contact_rows(first, min(first + CHUNK, count + 1), rng)
+            for table, values in rows.items():
+                connection.execute(insert(table), values)
+        rebuild(connection)
+        rebuild_upcoming(connection, date.today())
+        rebuild_snapshots(connection)
+        connection.exec_driver_sql('ANALYZE')
+
+
+def measure(func, repeat):
+    """ run func repeat times, return latencies in milliseconds """
+    samples = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func(i)
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def percentile(samples, pct):
+    """ nearest-rank percentile """
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def summarize(samples):
+    """ latency summary in milliseconds """
+    return {'count': len(samples),
+            'mean': round(statistics.mean(samples), 3),
+            'p50': round(percentile(samples, 50), 3),
+            'p95': round(percentile(samples, 95), 3),
+            'p99': round(percentile(samples, 99), 3),
+            'max': round(max(samples), 3)}
@@ -0,0 +1,47 @@
+""" compare.py
+
+Compare two JSON reports of benchmarks.routes and fail on p95 regressions.
+
+    python -m benchmarks.compare before.json after.json --threshold 10
+"""
+import argparse
+import json
+import sys
+
+
+def regressions(before, after, metric, threshold):
+    """ (size, mode, route, old, new, change %) rows present in both reports """
+    rows = []
+    for size, modes in after['results'].items():
+        for mode, routes in modes.items():
+            for route, stats in routes.items():
+                old = before['results'].get(size, {}).get(mode, {}).get(route)
+                if old is None or not old[metric]:
+                    continue
+                change = (stats[metric] - old[metric]) / old[metric] * 100
+                rows.append((size, mode, route, old[metric], stats[metric], change,
+                             change > threshold))
+    return rows
+
+
+def main():
+    """ comparison entry point """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--metric', default='p95', help='summary field to compare')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='allowed slowdown in percent')
+    args = parser.parse_args()
+    with open(args.before) as before, open(args.after) as after:
+        rows = regressions(json.load(before), json.load(after), args.metric, args.threshold)
+    failed = False
+    for size, mode, route, old, new, change, regressed in rows:
+        failed = failed or regressed
+        print('{:>8} {:<9} {:<16} {:>9.3f} -> {:>9.3f} ms {:>+7.1f}%{}'.format(
+            size, mode, route, old, new, change, '  REGRESSION' if regressed else ''))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+""" group_commit.py
+
+Commits and edits per second of N threads posting phone edits as fast as they
+can, each request committing on its own against GROUP_COMMIT batching, with
+SQLite at synchronous NORMAL and FULL.
+
+    python -m benchmarks.group_commit --clients 16 --seconds 10
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from sqlalchemy import event
+from book import app, db
+from book.batching import committer
+from benchmarks.common import setup_database, seed, summarize
+
+MODES = {'direct': False, 'group': True}
+SYNCHRONOUS = ('NORMAL', 'FULL')
+
+
+def client(number, records, deadline, latencies, errors):
+    """ post edits of the phones of this client's records until the deadline """
+    test_client = app.test_client()
+    ops = 0
+    while time.monotonic() < deadline:
+        phone_id = 1 + (number + ops * 97) % records
+        start = time.perf_counter()
+        response = test_client.post('/edit_phone/{}'.format(phone_id),
+                                    data={'number': '381{:09d}'.format(number * 10 ** 6 + ops)})
+        if response.status_code == 302:
+            latencies.append((time.perf_counter() - start) * 1000)
+        else:
+            errors.append(response.status_code)
+        ops += 1
+
+
+def run(clients, records, seconds):
+    """ edits, commits and request latencies of clients threads for seconds """
+    commits = []
+
+    def count(connection):
+        commits.append(connection)
+
+    event.listen(db.engine, 'commit', count)
+    latencies, errors = [], []
+    deadline = time.monotonic() + seconds
+    threads = [threading.Thread(target=client, args=(number, records, deadline, latencies,
+                                                     errors))
+               for number in range(clients)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        event.remove(db.engine, 'commit', count)
+    return {'edits_per_second': round(len(latencies) / seconds, 1),
+            'commits_per_second': round(len(commits) / seconds, 1),
+            'errors': len(errors), 'latency_ms': summarize(latencies)}
+
+
+def main():
+    """ benchmark entry point """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--records', type=int, default=10000)
+    parser.add_argument('--window-ms', type=float, default=app.config['GROUP_COMMIT_WINDOW_MS'])
+    parser.add_argument('--output', help='write JSON results to this file')
+    args = parser.parse_args()
+
+    path = setup_database()
+    results = {'clients': args.clients, 'window_ms': args.window_ms}
+    try:
+        seed(args.records)
+        app.config['GROUP_COMMIT_WINDOW_MS'] = args.window_ms
+        for synchronous in SYNCHRONOUS:
+            app.config['SQLITE_SYNCHRONOUS'] = synchronous
+            db.engine.dispose()
+            for mode, enabled in MODES.items():
+                app.config['GROUP_COMMIT'] = enabled
+                name = '{}_{}'.format(mode, synchronous.lower())
+                results[name] = run(args.clients, args.records, args.seconds)
+                print('{:<14} {}'.format(name, results[name]))
+    finally:
+        committer.stop()
+        db.engine.dispose()
+        for suffix in ('', '-wal', '-shm', '-journal'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+""" indexes.py
+
+Latency of index, search, name validation, phone lookup and delete before and
+after the foreign key, name and phone indexes, on a synthetic address book.
+
+    python -m benchmarks.indexes --records 100000
+"""
+import argparse
+import json
+import os
+from sqlalchemy import func
+from book import app, db
+from book.models import Record
+from benchmarks.common import setup_database, seed, measure, summarize
+
+
+INDEXES = ['ix_phones_records_id', 'ix_emails_records_id', 'ix_addresses_records_id',
+           'ix_notes_records_id', 'ix_note_tags_tags_id', 'ix_records_name_id',
+           'uq_records_name_lower', 'uq_phones_normalized_records_id']
+
+
+def run(client, records, repeat, offset):
+    """ time each operation, deleting a fresh record on every delete run """
+    middle = records // 2
+    per_page = app.config['RECORDS_PER_PAGE']
+    return {
+        'index': summarize(measure(
+            lambda i: client.get('/index?page={}'.format(middle // per_page + i)), repeat)),
+        'search': summarize(measure(
+            lambda i: client.get('/search?q=contact{}'.format(middle + i)), repeat)),
+        'validate_name': summarize(measure(
+            lambda i: Record.query.filter(
+                func.lower(Record.name) == func.lower('Anna {}'.format(middle + i))).first(),
+            repeat)),
+        'lookup_phones': summarize(measure(
+            lambda i: client.post('/api/v1/phones/lookup', json={'numbers': [
+                '0{:09d}'.format((middle + i * 1000 + j) % records + 1) for j in range(1000)]}),
+            repeat)),
+        'delete': summarize(measure(
+            lambda i: client.post('/delete_record/{}'.format(offset + i)), repeat)),
+    }
+
+
+def main():
+    """ benchmark entry point """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--records', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--output', help='write JSON results to this file')
+    args = parser.parse_args()
+
+    path = setup_database()
+    # the cascading delete the foreign key indexes serve, not the soft delete UPDATE
+    app.config['SOFT_DELETE'] = False
+    try:
+        seed(args.records)
+        client = app.test_client()
+        with db.engine.begin() as connection:
+            for name in INDEXES:
+                connection.exec_driver_sql('DROP INDEX {}'.format(name))
+        before = run(client, args.records, args.repeat, offset=1)
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                if index.name in INDEXES:
+                    index.create(db.engine)
+        after = run(client, args.records, args.repeat, offset=args.repeat + 1)
+    finally:
+        db.session.remove()
+        db.engine.dispose()
+        os.remove(path)
+
+    results = {'records': args.records, 'before': before, 'after': after}
+    for operation in before:
+        print('{:<14} p50 {:>10.3f} ms -> {:>10.3f} ms'.format(
+            operation, before[operation]['p50'], after[operation]['p50']))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
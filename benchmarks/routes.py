@@ -0,0 +1,228 @@
+""" routes.py
+
+Latency percentiles and throughput of every route on synthetic address books,
+through the Flask test client and through a real gunicorn server.
+
+    python -m benchmarks.routes --sizes 1000,100000,1000000 --output bench.json
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+from book import app, db
+from book.cache import cache, NullCache
+from benchmarks.common import setup_database, seed, summarize
+
+
+def routes(size):
+    """ (name, method, path, form) factories for every route, spread over the address book """
+    def spread(i):
+        return i * 7919 % size + 1
+
+    def target(i):
+        return size - i
+
+    return [
+        ('index', 'GET', lambda i: '/index', None),
+        ('search', 'GET', lambda i: '/search?q=contact{}'.format(spread(i)), None),
+        ('holidays_period', 'POST', lambda i: '/holidays_period',
+         lambda i: {'period': str(i % 60 + 1)}),
+        ('add_record', 'POST', lambda i: '/add_record',
+         lambda i: {'name': 'Bench {}'.format(i), 'birthday': '1990-01-01',
+                    'phone': '380{:09d}'.format(size + i), 'email': 'bench@example.com',
+                    'address': 'st. Bench', 'note': 'bench'}),
+        ('edit_record', 'POST', lambda i: '/edit_record/{}'.format(spread(i)),
+         lambda i: {'name': 'Edited {}'.format(i), 'birthday': '1991-02-03'}),
+        ('edit_contact', 'POST', lambda i: '/contact/{}'.format(spread(i)),
+         lambda i: {'name': 'Combined {}'.format(i), 'birthday': '1992-03-04',
+                    'phones-0-ref': spread(i), 'phones-0-value': '380{:09d}'.format(i),
+                    'emails-0-ref': spread(i),
+                    'emails-0-value': 'combined{}@example.com'.format(i),
+                    'notes-0-ref': spread(i), 'notes-0-value': 'combined note {}'.format(i),
+                    'notes-0-tags': 'bench'}),
+        ('edit_phone', 'POST', lambda i: '/edit_phone/{}'.format(spread(i)),
+         lambda i: {'number': '380{:09d}'.format(i)}),
+        ('edit_email', 'POST', lambda i: '/edit_email/{}'.format(spread(i)),
+         lambda i: {'title': 'edited{}@example.com'.format(i)}),
+        ('edit_address', 'POST', lambda i: '/edit_address/{}'.format(spread(i)),
+         lambda i: {'title': 'st. Edited {}'.format(i)}),
+        ('edit_note', 'POST', lambda i: '/edit_note/{}'.format(spread(i)),
+         lambda i: {'title': 'edited note {}'.format(i)}),
+        ('add_tag', 'POST', lambda i: '/add_tag/{}'.format(spread(i)),
+         lambda i: {'title': 'bench'}),
+        ('edit_tag', 'POST', lambda i: '/edit_tag/{}?note={}'.format(i % 8 + 1, spread(i)),
+         lambda i: {'title': 'edited'}),
+        ('sync', 'GET', lambda i: '/api/v1/changes?since={}'.format(i * 5), None),
+        ('delete_record', 'POST', lambda i: '/delete_record/{}'.format(target(i)),
+         lambda i: {}),
+    ]
+
+
+def bench_client(size, requests):
+    """ run every route in process through the test client """
+    client = app.test_client()
+    results = {}
+    for name, method, path, form in routes(size):
+        samples = []
+        started = time.perf_counter()
+        for i in range(requests):
+            start = time.perf_counter()
+            if method == 'GET':
+                response = client.get(path(i))
+            else:
+                response = client.post(path(i), data=form(i))
+            samples.append((time.perf_counter() - start) * 1000)
+            if response.status_code >= 400:
+                raise RuntimeError('{} {} returned {}'.format(method, path(i),
+                                                              response.status_code))
+        elapsed = time.perf_counter() - started
+        results[name] = dict(summarize(samples), throughput=round(requests / elapsed, 1))
+    return results
+
+
+def free_port():
+    """ an unused local TCP port """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(argv, env):
+    """ start a server process on a free port and wait until it accepts connections """
+    port = free_port()
+    argv = [arg.format(port=port) for arg in argv]
+    process = subprocess.Popen(argv, env=dict(os.environ, **env))
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, port
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('{} did not start'.format(argv[2]))
+
+
+def server_env(path, use_cache):
+    """ environment pointing a server at the benchmark database """
+    return {'DATABASE_URL': 'sqlite:///' + path, 'WTF_CSRF_ENABLED': '0',
+            'CACHE_BACKEND': 'lru' if use_cache else 'null'}
+
+
+def gunicorn_argv(workers):
+    """ sync gunicorn command line, as in boot.sh """
+    return [sys.executable, '-m', 'gunicorn', '-w', str(workers), '-b', '127.0.0.1:{port}',
+            '--log-level', 'warning', 'contact:app']
+
+
+def drive(port, route_list, requests, concurrency):
+    """ send requests per route over concurrency keep-alive connections """
+    results = {}
+    for name, method, path_for, form in route_list:
+        def call(indexes):
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+            samples = []
+            for i in indexes:
+                body = urlencode(form(i)) if form else None
+                headers = {'Content-Type': 'application/x-www-form-urlencoded'} if form else {}
+                start = time.perf_counter()
+                connection.request(method, path_for(i), body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                samples.append((time.perf_counter() - start) * 1000)
+                if response.status >= 400:
+                    raise RuntimeError('{} {} returned {}'.format(method, path_for(i),
+                                                                  response.status))
+            connection.close()
+            return samples
+
+        batches = [range(worker, requests, concurrency) for worker in range(concurrency)]
+        started = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            samples = [sample for batch in pool.map(call, batches) for sample in batch]
+        elapsed = time.perf_counter() - started
+        results[name] = dict(summarize(samples), throughput=round(requests / elapsed, 1))
+    return results
+
+
+def bench_gunicorn(path, size, requests, workers, concurrency, use_cache):
+    """ run every route over HTTP against sync gunicorn workers """
+    process, port = start_server(gunicorn_argv(workers), server_env(path, use_cache))
+    try:
+        return drive(port, routes(size), requests, concurrency)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def git_commit():
+    """ current commit of the working tree, None outside git """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    """ benchmark entry point """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1000,100000,1000000',
+                        help='comma separated address book sizes')
+    parser.add_argument('--requests', type=int, default=200, help='requests per route')
+    parser.add_argument('--modes', default='client,gunicorn',
+                        help='comma separated subset of client,gunicorn')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent HTTP clients')
+    parser.add_argument('--cache', action='store_true', help='keep the page cache enabled')
+    parser.add_argument('--output', help='write JSON results to this file')
+    args = parser.parse_args()
+    modes = args.modes.split(',')
+
+    if not args.cache:
+        cache.backend = NullCache()
+    report = {'meta': {'commit': git_commit(), 'python': platform.python_version(),
+                       'timestamp': datetime.now(timezone.utc).isoformat(),
+                       'requests': args.requests, 'cache': args.cache,
+                       'workers': args.workers, 'concurrency': args.concurrency},
+              'results': {}}
+    for size in (int(size) for size in args.sizes.split(',')):
+        results = report['results'][str(size)] = {}
+        path = setup_database()
+        try:
+            seed(size)
+            if 'client' in modes:
+                results['client'] = bench_client(size, args.requests)
+            if 'gunicorn' in modes:
+                db.session.remove()
+                db.engine.dispose()
+                setup_database(path)
+                seed(size)
+                db.engine.dispose()
+                results['gunicorn'] = bench_gunicorn(path, size, args.requests, args.workers,
+                                                     args.concurrency, args.cache)
+        finally:
+            db.session.remove()
+            db.engine.dispose()
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+        for mode, routes_results in results.items():
+            for name, stats in routes_results.items():
+                print('{:>8} {:<9} {:<16} p50 {:>9.3f} ms  p95 {:>9.3f} ms  {:>8.1f} req/s'
+                      .format(size, mode, name, stats['p50'], stats['p95'], stats['throughput']))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+""" rows.py
+
+CPU time and peak memory per 10k rows of the listing and birthday reads, ORM
+models with eager loading against Core selects building slotted rows.
+
+    python -m benchmarks.rows --records 10000 --repeat 5
+"""
+import argparse
+import json
+import os
+import time
+import tracemalloc
+from datetime import date
+from sqlalchemy import select
+from book import app, db
+from book.listing import listing_query
+from book.models import Record, UpcomingBirthday
+from book.reads import contact_statement, contact_rows
+from book.upcoming import upcoming_statement
+from benchmarks.common import setup_database, seed, summarize
+
+PER_ROWS = 10000
+
+
+def orm_listing(limit):
+    """ Record models with their children eagerly loaded, as the listing did """
+    return listing_query().order_by(Record.name, Record.id).limit(limit).all()
+
+
+def core_listing(limit):
+    """ ContactRow objects from Core selects """
+    return contact_rows(db.session.connection(),
+                        contact_statement().order_by(Record.name, Record.id).limit(limit))
+
+
+def snapshot_listing(limit):
+    """ ContactRow objects from the snapshot column """
+    app.config['LISTING_SNAPSHOTS'] = True
+    try:
+        return core_listing(limit)
+    finally:
+        app.config['LISTING_SNAPSHOTS'] = False
+
+
+def orm_birthdays(limit):
+    """ (Record, next birthday) rows, as holidays_period did """
+    return db.session.execute(
+        select(Record, UpcomingBirthday.next_birthday)
+        .join(UpcomingBirthday, UpcomingBirthday.records_id == Record.id)
+        .order_by(UpcomingBirthday.next_birthday).limit(limit)).all()
+
+
+def core_birthdays(limit):
+    """ upcoming_statement rows """
+    return db.session.connection().execute(
+        upcoming_statement(366, date.today()).limit(limit)).all()
+
+
+READS = {'orm_listing': orm_listing, 'core_listing': core_listing,
+         'snapshot_listing': snapshot_listing, 'orm_birthdays': orm_birthdays,
+         'core_birthdays': core_birthdays}
+
+
+def run(read, limit, repeat):
+    """ CPU milliseconds and peak megabytes per PER_ROWS rows of one read """
+    cpu = []
+    for _ in range(repeat):
+        start = time.process_time()
+        rows = len(read(limit))
+        cpu.append((time.process_time() - start) * 1000 * PER_ROWS / rows)
+        db.session.remove()
+    tracemalloc.start()
+    rows = len(read(limit))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    db.session.remove()
+    return {'rows': rows, 'cpu_ms': summarize(cpu),
+            'peak_mb': round(peak / 1024 / 1024 * PER_ROWS / rows, 3)}
+
+
+def main():
+    """ benchmark entry point """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--records', type=int, default=PER_ROWS)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='write JSON results to this file')
+    args = parser.parse_args()
+
+    path = setup_database()
+    try:
+        seed(args.records)
+        results = {name: run(read, args.records, args.repeat) for name, read in READS.items()}
+    finally:
+        db.session.remove()
+        db.engine.dispose()
+        os.remove(path)
+
+    for name, result in results.items():
+        print('{:<18} {:>7} rows  cpu p50 {:>9.1f} ms  peak {:>7.1f} MB  per {} rows'.format(
+            name, result['rows'], result['cpu_ms']['p50'], result['peak_mb'], PER_ROWS))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'records': args.records, 'results': results}, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
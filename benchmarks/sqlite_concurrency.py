@@ -0,0 +1,129 @@
+""" sqlite_concurrency.py
+
+Throughput of N writer and M reader processes against one SQLite file, with
+the previous connection settings and with the tuned profile from Config.
+
+    python -m benchmarks.sqlite_concurrency --writers 4 --readers 4 --seconds 10
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import NullPool
+from config import Config
+
+
+PROFILES = {
+    'default': {
+        'SQLITE_BUSY_TIMEOUT': None,
+        'SQLITE_JOURNAL_MODE': 'DELETE',
+        'SQLITE_SYNCHRONOUS': 'FULL',
+        'SQLITE_CACHE_SIZE': None,
+        'SQLITE_MMAP_SIZE': None,
+        'SQLALCHEMY_ENGINE_OPTIONS': {'poolclass': NullPool},
+    },
+    'tuned': {
+        'SQLITE_BUSY_TIMEOUT': Config.SQLITE_BUSY_TIMEOUT,
+        'SQLITE_JOURNAL_MODE': Config.SQLITE_JOURNAL_MODE,
+        'SQLITE_SYNCHRONOUS': Config.SQLITE_SYNCHRONOUS,
+        'SQLITE_CACHE_SIZE': Config.SQLITE_CACHE_SIZE,
+        'SQLITE_MMAP_SIZE': Config.SQLITE_MMAP_SIZE,
+        'SQLALCHEMY_ENGINE_OPTIONS': Config.SQLALCHEMY_ENGINE_OPTIONS,
+    },
+}
+
+
+def configure(path, profile):
+    """ import the app inside a worker process with the given profile """
+    from book import app
+    app.config.update(PROFILES[profile])
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    return app
+
+
+def worker(role, number, path, profile, seconds, results):
+    """ run writes or listing reads until the deadline, report ops and errors """
+    app = configure(path, profile)
+    from book import db
+    from book.listing import listing_query
+    from book.models import Record, Phone
+    ops = errors = 0
+    deadline = time.monotonic() + seconds
+    with app.app_context():
+        while time.monotonic() < deadline:
+            try:
+                if role == 'writer':
+                    db.session.add(Record(name='{}-{}-{}'.format(profile, number, ops),
+                                          phones=[Phone(number='380000000000')]))
+                    db.session.commit()
+                else:
+                    listing_query().order_by(Record.name, Record.id).limit(8).all()
+                    db.session.rollback()
+                ops += 1
+            except OperationalError:
+                db.session.rollback()
+                errors += 1
+    results.put((role, ops, errors))
+
+
+def run(path, profile, writers, readers, seconds):
+    """ start all workers for one profile and aggregate their results """
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    processes = [context.Process(target=worker, args=(role, number, path, profile,
+                                                      seconds, results))
+                 for role, count in (('writer', writers), ('reader', readers))
+                 for number in range(count)]
+    for process in processes:
+        process.start()
+    totals = {'writer': [0, 0], 'reader': [0, 0]}
+    for _ in processes:
+        role, ops, errors = results.get()
+        totals[role][0] += ops
+        totals[role][1] += errors
+    for process in processes:
+        process.join()
+    return {'writes_per_second': round(totals['writer'][0] / seconds, 1),
+            'reads_per_second': round(totals['reader'][0] / seconds, 1),
+            'write_errors': totals['writer'][1],
+            'read_errors': totals['reader'][1]}
+
+
+def main():
+    """ benchmark entry point """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--records', type=int, default=10000)
+    parser.add_argument('--output', help='write JSON results to this file')
+    args = parser.parse_args()
+
+    from book import db
+    from benchmarks.common import setup_database, seed
+    path = setup_database()
+    try:
+        seed(args.records)
+        db.engine.dispose()
+        results = {'writers': args.writers, 'readers': args.readers}
+        for profile in PROFILES:
+            with db.engine.connect() as connection:
+                connection.exec_driver_sql('PRAGMA journal_mode={}'.format(
+                    PROFILES[profile]['SQLITE_JOURNAL_MODE']))
+            db.engine.dispose()
+            results[profile] = run(path, profile, args.writers, args.readers, args.seconds)
+            print('{:<8} {}'.format(profile, results[profile]))
+    finally:
+        db.engine.dispose()
+        for suffix in ('', '-wal', '-shm', '-journal'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
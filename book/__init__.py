@@ -11,5 +11,7 @@ app.config.from_object(Config)
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
 bootstrap = Bootstrap(app)
-from book import routes, models
+from book import routes, models, instrumentation
+from book.api import api
+app.register_blueprint(api)
 
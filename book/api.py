@@ -0,0 +1,443 @@
+""" api.py """
+from datetime import datetime
+from flask import Blueprint, jsonify, request, abort, make_response
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
+from sqlalchemy.orm.exc import StaleDataError
+from werkzeug.exceptions import HTTPException
+from wtforms.validators import ValidationError
+from book import app, db
+from book.forms import check_phone, unique_numbers
+from book.models import Record, Phone, Email, Address, Note, normalize_number
+from book.cache import cache, TABLES
+from book.changes import CursorExpired, changes_since, latest_seq
+from book.conditional import matching_etag
+from book.duplicates import find_duplicates, merge_records
+from book.editing import VersionConflict, check_version, replace_phones
+from book.listing import keyset_page
+from book.tags import tags_by_title
+from book.transfer import parse_birthday, taken_names
+from book.trash import trash_records, deleted_records, restore_records
+
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+FIELDS = ('name', 'birthday', 'phones', 'emails', 'addresses', 'notes', 'tags')
+CHILDREN = {'phones': (Phone, 'number'), 'emails': (Email, 'title'),
+            'addresses': (Address, 'title'), 'notes': (Note, 'title')}
+LOOKUP_CHUNK = 500
+
+
+class BatchError(Exception):
+    """ a batch operation that cannot be applied """
+
+    def __init__(self, op, index, message, status=422):
+        super().__init__(message)
+        self.error = {'op': op, 'index': index, 'error': message}
+        self.status = status
+
+
+def requested_fields():
+    """ fields named by ?fields=, every field when absent """
+    fields = request.args.get('fields')
+    if not fields:
+        return FIELDS
+    fields = tuple(field.strip() for field in fields.split(',') if field.strip())
+    unknown = set(fields) - set(FIELDS)
+    if unknown:
+        abort(400, 'Unknown fields: {}.'.format(', '.join(sorted(unknown))))
+    return fields
+
+
+def field_options(fields):
+    """ eager load only the collections that will be serialized """
+    options = [selectinload(getattr(Record, key)) for key in CHILDREN
+               if key in fields and key != 'notes']
+    if 'tags' in fields:
+        options.append(selectinload(Record.notes).selectinload(Note.tags))
+    elif 'notes' in fields:
+        options.append(selectinload(Record.notes))
+    return options
+
+
+def serialize(record, fields):
+    """ compact dict of a record restricted to fields """
+    contact = {'id': record.id}
+    for field in fields:
+        if field == 'name':
+            contact['name'] = record.name
+        elif field == 'birthday':
+            contact['birthday'] = record.birthday.isoformat() if record.birthday else None
+        elif field == 'tags':
+            contact['tags'] = [tag.title for note in record.notes for tag in note.tags]
+        else:
+            _, column = CHILDREN[field]
+            contact[field] = [getattr(child, column) for child in getattr(record, field)]
+    return contact
+
+
+def _strings(value, field):
+    """ list of strings of a multi-valued field """
+    if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+        raise ValidationError('{} must be a list of strings.'.format(field))
+    return value
+
+
+def clean(data, partial=False):
+    """ validated contact fields following the RecordForm rules """
+    if not isinstance(data, dict):
+        raise ValidationError('Contact must be an object.')
+    unknown = set(data) - set(FIELDS) - {'id', 'version'}
+    if unknown:
+        raise ValidationError('Unknown fields: {}.'.format(', '.join(sorted(unknown))))
+    contact = {}
+    if 'name' in data or not partial:
+        name = data.get('name')
+        if not isinstance(name, str) or not name.strip():
+            raise ValidationError('Name is required.')
+        contact['name'] = name.strip().capitalize()
+    if 'birthday' in data:
+        if data['birthday'] is not None and not isinstance(data['birthday'], str):
+            raise ValidationError('Invalid birthday {}.'.format(data['birthday']))
+        contact['birthday'] = parse_birthday(data['birthday'])
+    for field in FIELDS[2:]:
+        if field in data:
+            contact[field] = _strings(data[field], field)
+    for number in contact.get('phones', []):
+        check_phone(number)
+    if 'phones' in contact:
+        contact['phones'] = unique_numbers(contact['phones'])
+    return contact
+
+
+def _replace_children(record, contact):
+    """ replace the collections named in contact, keeping tags on the first note """
+    tags = contact.get('tags')
+    if 'notes' in contact or tags is not None:
+        if tags is None:
+            tags = [tag.title for note in record.notes for tag in note.tags]
+        for note in record.notes:
+            note.tags = []
+    for field, (model, column) in CHILDREN.items():
+        if field not in contact:
+            continue
+        if model is Phone:
+            replace_phones(record, [(None, number) for number in contact[field]])
+            continue
+        for child in list(getattr(record, field)):
+            db.session.delete(child)
+        setattr(record, field, [model(**{column: value}) for value in contact[field]])
+    if tags:
+        if not record.notes:
+            record.notes = [Note(title='')]
+        record.notes[0].tags = tags_by_title(tags)
+
+
+def apply_batch(creates, updates, deletes):
+    """ apply every operation in the current transaction, BatchError on the first failure """
+    changes = {'create': [], 'update': []}
+    for op, index, item in ([('create', i, item) for i, item in enumerate(creates)] +
+                            [('update', i, item) for i, item in enumerate(updates)]):
+        try:
+            changes[op].append(clean(item, partial=op == 'update'))
+        except ValidationError as error:
+            raise BatchError(op, index, str(error))
+        if op == 'update' and not isinstance(item.get('id'), int):
+            raise BatchError(op, index, 'id is required.')
+        if op == 'update' and not isinstance(item.get('version', 0), int):
+            raise BatchError(op, index, 'version must be an integer.')
+    for index, record_id in enumerate(deletes):
+        if not isinstance(record_id, int):
+            raise BatchError('delete', index, 'id must be an integer.')
+
+    ids = [item['id'] for item in updates]
+    for index, record_id in enumerate(deletes):
+        if record_id in ids:
+            raise BatchError('delete', index, 'Contact {} is also updated.'.format(record_id))
+    records = {}
+    if ids:
+        records.update((record.id, record) for record in Record.query.options(
+            selectinload(Record.notes).selectinload(Note.tags)).filter(Record.id.in_(ids)))
+    if deletes:
+        records.update((record.id, record)
+                       for record in Record.query.filter(Record.id.in_(deletes)))
+    for op, items in (('update', [item['id'] for item in updates]), ('delete', deletes)):
+        for index, record_id in enumerate(items):
+            if record_id not in records:
+                raise BatchError(op, index, 'Contact {} not found.'.format(record_id))
+    for index, item in enumerate(updates):
+        try:
+            check_version(records[item['id']], item.get('version'))
+        except VersionConflict as error:
+            raise BatchError('update', index, str(error), 409)
+
+    renamed = {record_id: contact['name'].lower() for record_id, contact in
+               zip((item['id'] for item in updates), changes['update']) if 'name' in contact}
+    names = [contact['name'] for contact in changes['create']] + list(renamed.values())
+    taken = taken_names(db.session.connection(), names) if names else set()
+    taken -= {records[record_id].name.lower() for record_id in set(renamed) | set(deletes)}
+    for op, contacts in (('create', changes['create']), ('update', changes['update'])):
+        for index, contact in enumerate(contacts):
+            if 'name' not in contact:
+                continue
+            name = contact['name'].lower()
+            if name in taken:
+                raise BatchError(op, index, 'Please use a different name.')
+            taken.add(name)
+
+    if app.config['SOFT_DELETE']:
+        trash_records([records[record_id] for record_id in deletes], datetime.utcnow())
+    else:
+        for record_id in deletes:
+            db.session.delete(records[record_id])
+    if deletes:
+        db.session.flush()
+    created = []
+    for contact in changes['create']:
+        record = Record(name=contact['name'], birthday=contact.get('birthday'))
+        _replace_children(record, contact)
+        db.session.add(record)
+        created.append(record)
+    updated = []
+    for item, contact in zip(updates, changes['update']):
+        record = records[item['id']]
+        if 'name' in contact:
+            record.name = contact['name']
+        if 'birthday' in contact:
+            record.birthday = contact['birthday']
+        _replace_children(record, contact)
+        updated.append(record)
+    db.session.flush()
+    return created, updated, list(deletes)
+
+
+def run_batch(creates, updates, deletes):
+    """ apply a batch in one transaction, return the JSON body and status """
+    if len(creates) + len(updates) + len(deletes) > app.config['API_BATCH_LIMIT']:
+        abort(413, 'At most {} operations per batch.'.format(app.config['API_BATCH_LIMIT']))
+    try:
+        created, updated, deleted = apply_batch(creates, updates, deletes)
+        db.session.commit()
+    except BatchError as error:
+        db.session.rollback()
+        return {'errors': [error.error]}, error.status
+    except (IntegrityError, StaleDataError):
+        db.session.rollback()
+        return {'errors': [{'error': 'Conflicting concurrent change, retry.'}]}, 409
+    return {'created': [record.id for record in created],
+            'updated': [record.id for record in updated],
+            'deleted': deleted}, 200
+
+
+def phone_owners(numbers):
+    """ {normalized number: [(id, name)]} of contacts owning numbers """
+    normalized = sorted({normalize_number(number) for number in numbers} - {None})
+    owners = {}
+    for start in range(0, len(normalized), LOOKUP_CHUNK):
+        rows = db.session.execute(
+            select(Phone.normalized, Record.id, Record.name)
+            .join(Record, Record.id == Phone.records_id)
+            .where(Phone.normalized.in_(normalized[start:start + LOOKUP_CHUNK]),
+                   Record.deleted_at.is_(None))
+            .order_by(Phone.normalized, Record.id))
+        for number, record_id, name in rows:
+            owners.setdefault(number, []).append({'id': record_id, 'name': name})
+    return owners
+
+
+def json_body():
+    """ request JSON object, 400 when missing or malformed """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(400, 'Expected a JSON object.')
+    return data
+
+
+@api.errorhandler(HTTPException)
+def api_error(error):
+    """ api_error """
+    return jsonify(errors=[{'error': error.description}]), error.code
+
+
+@api.route('/contacts')
+def list_contacts():
+    """ list_contacts """
+    fields = requested_fields()
+    limit = min(request.args.get('limit', app.config['API_PAGE_SIZE'], type=int),
+                app.config['API_BATCH_LIMIT'])
+    try:
+        page = keyset_page(Record.query.options(*field_options(fields)), max(limit, 1),
+                           after=request.args.get('after'), before=request.args.get('before'))
+    except ValueError:
+        abort(400, 'Invalid cursor.')
+    return {'items': [serialize(record, fields) for record in page.items],
+            'next': page.next_cursor, 'prev': page.prev_cursor}
+
+
+@api.route('/contacts/<int:record_id>')
+def get_contact(record_id):
+    """ get_contact """
+    fields = requested_fields()
+    record = Record.query.options(*field_options(fields)).get(record_id)
+    if record is None:
+        abort(404, 'Contact {} not found.'.format(record_id))
+    response = make_response(serialize(record, fields))
+    response.set_etag(str(record.version))
+    return response
+
+
+@api.route('/contacts', methods=['POST'])
+def create_contact():
+    """ create_contact """
+    body, status = run_batch([json_body()], [], [])
+    if status != 200:
+        return body, status
+    return {'id': body['created'][0]}, 201
+
+
+@api.route('/contacts/<int:record_id>', methods=['PATCH'])
+def update_contact(record_id):
+    """ update_contact """
+    item = dict(json_body(), id=record_id)
+    if request.if_match and not request.if_match.star_tag:
+        record = Record.query.get(record_id)
+        if record is not None:
+            # a compressed response carries the version with an encoding suffix
+            if not matching_etag(request.if_match, str(record.version)):
+                abort(412, 'Contact {} was changed by someone else.'.format(record_id))
+            item.setdefault('version', record.version)
+    body, status = run_batch([], [item], [])
+    if status != 200:
+        return body, status
+    response = make_response({'id': record_id})
+    response.set_etag(str(Record.query.get(record_id).version))
+    return response
+
+
+@api.route('/contacts/<int:record_id>', methods=['DELETE'])
+def delete_contact(record_id):
+    """ delete_contact """
+    body, status = run_batch([], [], [record_id])
+    if status != 200:
+        return body, status
+    return '', 204
+
+
+def json_ids():
+    """ ids list of the request body, 400 unless it is a list of integers """
+    ids = json_body().get('ids')
+    if not isinstance(ids, list) or not all(isinstance(item, int) for item in ids):
+        abort(400, 'ids must be a list of contact ids.')
+    return ids
+
+
+@api.route('/contacts/delete', methods=['POST'])
+def delete_contacts():
+    """ delete_contacts """
+    return run_batch([], [], json_ids())
+
+
+@api.route('/contacts/restore', methods=['POST'])
+def restore_contacts():
+    """ restore_contacts """
+    ids = json_ids()
+    if len(ids) > app.config['API_BATCH_LIMIT']:
+        abort(413, 'At most {} operations per batch.'.format(app.config['API_BATCH_LIMIT']))
+    records = deleted_records(ids, datetime.utcnow())
+    restore_records(records)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return {'errors': [{'error': 'A restored name is used by another contact.'}]}, 409
+    return {'restored': sorted(record.id for record in records)}
+
+
+@api.route('/contacts/batch', methods=['POST'])
+def batch_contacts():
+    """ batch_contacts """
+    data = json_body()
+    operations = [data.get(op, []) for op in ('create', 'update', 'delete')]
+    if not all(isinstance(items, list) for items in operations):
+        abort(400, 'create, update and delete must be lists.')
+    return run_batch(*operations)
+
+
+@api.route('/phones/<number>')
+def lookup_phone(number):
+    """ lookup_phone """
+    normalized = normalize_number(number)
+    return {'number': number, 'normalized': normalized,
+            'contacts': phone_owners([number]).get(normalized, [])}
+
+
+@api.route('/phones/lookup', methods=['POST'])
+def lookup_phones():
+    """ lookup_phones """
+    numbers = json_body().get('numbers')
+    if not isinstance(numbers, list) or not all(isinstance(item, str) for item in numbers):
+        abort(400, 'numbers must be a list of strings.')
+    if len(numbers) > app.config['PHONE_LOOKUP_LIMIT']:
+        abort(413, 'At most {} numbers per lookup.'.format(app.config['PHONE_LOOKUP_LIMIT']))
+    owners = phone_owners(numbers)
+    return {'items': [{'number': number, 'normalized': normalize_number(number),
+                       'contacts': owners.get(normalize_number(number), [])}
+                      for number in numbers]}
+
+
+@api.route('/duplicates')
+def list_duplicates():
+    """ list_duplicates """
+    limit = min(request.args.get('limit', app.config['API_PAGE_SIZE'], type=int),
+                app.config['API_BATCH_LIMIT'])
+    items, skipped = cache.fetch('duplicates', TABLES, (limit,),
+                                 lambda: find_duplicates(db.session.connection(), max(limit, 1)))
+    return {'items': items, 'skipped_blocks': skipped}
+
+
+@api.route('/contacts/<int:record_id>/merge', methods=['POST'])
+def merge_contacts(record_id):
+    """ merge_contacts """
+    ids = json_ids()
+    records = {record.id: record for record in Record.query.options(
+        *field_options(FIELDS)).filter(Record.id.in_([record_id] + ids))}
+    missing = [item for item in [record_id] + ids if item not in records]
+    if missing:
+        abort(404, 'Contact {} not found.'.format(missing[0]))
+    try:
+        merge_records(records[record_id], [records[item] for item in dict.fromkeys(ids)])
+        db.session.commit()
+    except ValueError as error:
+        db.session.rollback()
+        abort(422, str(error))
+    except IntegrityError:
+        db.session.rollback()
+        return {'errors': [{'error': 'Conflicting concurrent change, retry.'}]}, 409
+    return serialize(records[record_id], FIELDS)
+
+
+@api.route('/changes')
+def list_changes():
+    """ list_changes """
+    since = request.args.get('since', type=int)
+    if since is None:
+        return {'cursor': latest_seq(db.session.connection())}
+    fields = requested_fields()
+    limit = min(request.args.get('limit', app.config['API_PAGE_SIZE'], type=int),
+                app.config['API_BATCH_LIMIT'])
+    try:
+        page = changes_since(db.session.connection(), since, max(limit, 1))
+    except CursorExpired:
+        abort(410, 'Cursor {} expired, download the contacts again.'.format(since))
+    records = Record.query.options(*field_options(fields)) \
+        .filter(Record.id.in_(page.record_ids)).order_by(Record.id).all() \
+        if page.record_ids else []
+    live = {record.id for record in records}
+    return {
+        'changes': [{'seq': change.seq, 'table': change.table_name, 'id': change.row_id,
+                     'contact': change.records_id, 'op': change.operation}
+                    for change in page.changes],
+        'contacts': [serialize(record, fields) for record in records],
+        'deleted': [record_id for record_id in page.record_ids if record_id not in live],
+        'cursor': page.cursor, 'more': page.more}
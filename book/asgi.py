@@ -0,0 +1,279 @@
+""" asgi.py
+
+ASGI entry point: index, search and holidays_period run as coroutines on an
+async SQLAlchemy engine, every other route is served by the WSGI app on a
+worker thread. With STREAM_RESULTS search and holidays_period stream from the
+WSGI app too.
+
+    uvicorn book.asgi:application
+"""
+import io
+from datetime import date
+from asgiref.wsgi import WsgiToAsgi
+from flask import render_template, flash, redirect, url_for, request, abort, session, \
+    request_started
+from sqlalchemy import func, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from werkzeug.exceptions import HTTPException
+from book import app
+from book.cache import cache, TABLES
+from book.conditional import unchanged_async, not_modified
+from book.listing import keyset_statement, keyset_result, \
+    cached_record_count, remember_record_count
+from book.models import Record
+from book.reads import contact_statement, contact_rows
+from book.routes import birthday_lines
+from book.search import MATCH, SearchPage, match_parameters, ranked_page
+from book.streaming import page_size
+from book.tags import tagged_record_ids, tagged_count_statement
+from book.upcoming import refresh_due, upcoming_statement
+
+
+ASYNC_DRIVERS = {'sqlite': 'sqlite+aiosqlite', 'postgresql': 'postgresql+asyncpg'}
+
+
+def async_database_url(config):
+    """ ASYNC_DATABASE_URL, or the async driver for SQLALCHEMY_DATABASE_URI """
+    if config['ASYNC_DATABASE_URL']:
+        return config['ASYNC_DATABASE_URL']
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    return url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername))
+
+
+def create_engine(config):
+    """ async engine with the pool sizes of the sync engine """
+    options = config['SQLALCHEMY_ENGINE_OPTIONS']
+    return create_async_engine(async_database_url(config), poolclass=AsyncAdaptedQueuePool,
+                               pool_size=options.get('pool_size', 5),
+                               max_overflow=options.get('max_overflow', 10))
+
+
+async def render_index(db_session):
+    """ render_index """
+    per_page = app.config['RECORDS_PER_PAGE']
+    ttl = app.config['PAGINATION_COUNT_TTL']
+    after, before = request.args.get('after'), request.args.get('before')
+    tag = request.args.get('tag')
+    statement = contact_statement()
+    if tag:
+        statement = statement.where(Record.id.in_(tagged_record_ids(tag)))
+    try:
+        statement = keyset_statement(statement, per_page, after, before)
+    except ValueError:
+        abort(400)
+    rows = await db_session.run_sync(lambda sync: contact_rows(sync.connection(), statement))
+    total = None
+    if tag:
+        total = await db_session.scalar(tagged_count_statement(tag))
+    elif ttl:
+        total = cached_record_count()
+        if total is None:
+            count = await db_session.scalar(select(func.count()).select_from(Record))
+            total = remember_record_count(count, ttl)
+    records = keyset_result(rows, per_page, after, before, total)
+    return render_template('index.html', title='Home', records=records)
+
+
+async def index(db_session):
+    """ index """
+    args = (app.config['PAGINATION'], app.config['RECORDS_PER_PAGE'], request.full_path)
+    if await unchanged_async(db_session, 'index', TABLES, args):
+        return not_modified()
+    if '_flashes' in session:
+        return await render_index(db_session)
+    return await cache.fetch_async('index', TABLES, args, lambda: render_index(db_session))
+
+
+async def render_search(db_session, contact, page, per_page):
+    """ render_search """
+    page = max(page, 1)
+    dialect = db_session.bind.dialect.name
+    parameters = match_parameters(dialect, contact, page, per_page)
+    if parameters is None:
+        records = SearchPage(contact, page, per_page, [], False)
+    else:
+        ids = [row.rowid for row in await db_session.execute(MATCH[dialect], parameters)]
+        statement = contact_statement().where(Record.id.in_(ids[:per_page]))
+        found = await db_session.run_sync(
+            lambda sync: contact_rows(sync.connection(), statement))
+        records = ranked_page(contact, page, per_page, ids, found)
+    return render_template('search.html', records=records)
+
+
+async def search(db_session):
+    """ search """
+    if request.method == "POST":
+        contact = request.form['contact']
+        if not contact:
+            flash('Enter the name of contact')
+            return redirect(url_for('index'))
+        page = 1
+    else:
+        contact = request.args.get('q')
+        if not contact:
+            return render_template('search.html')
+        page = request.args.get('page', 1, type=int)
+    per_page = page_size()
+    args = (contact, page, per_page)
+    if await unchanged_async(db_session, 'search', TABLES, args):
+        return not_modified()
+    if '_flashes' in session:
+        return await render_search(db_session, contact, page, per_page)
+    return await cache.fetch_async('search', TABLES, args,
+                                   lambda: render_search(db_session, contact, page, per_page))
+
+
+async def holidays_period(db_session):
+    """ holidays_period """
+    period = request.form['period'] if request.method == "POST" else request.args.get('period')
+    if period is not None:
+        if not period.isdigit():
+            flash('Invalid data(only numbers allowed).')
+            return redirect(url_for('index'))
+        if int(period) > 365:
+            flash('Period cannot be more than 365')
+            return redirect(url_for('index'))
+        period = int(period)
+        today = date.today()
+        if await unchanged_async(db_session, 'holidays_period', ('records',), (period, today)):
+            return not_modified()
+
+        async def lines():
+            if await db_session.run_sync(lambda sync: refresh_due(sync.connection(), today)):
+                await db_session.commit()
+            connection = await db_session.connection()
+            result = await connection.execute(upcoming_statement(period, today))
+            return birthday_lines(result.all(), today)
+
+        result = await cache.fetch_async('holidays_period', ('records',), (period, today), lines)
+        return render_template('holidays_period.html', result=result)
+    return render_template('holidays_period.html')
+
+
+VIEWS = {'index': index, 'search': search, 'holidays_period': holidays_period}
+STREAMED = ('search', 'holidays_period')
+
+
+def build_environ(scope, body):
+    """ WSGI environ for an ASGI http scope """
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': io.StringIO(),
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        environ[name] = environ[name] + ',' + value if name in environ else value
+    environ['CONTENT_LENGTH'] = str(len(body))
+    return environ
+
+
+async def read_body(receive):
+    """ the complete request body """
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+class AsyncReads():
+    """ serve the read views on the event loop and delegate the rest to the WSGI app """
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.engine = None
+        self.sessions = None
+
+    def start(self):
+        """ create the async engine """
+        if self.engine is None:
+            self.engine = create_engine(self.app.config)
+            self.sessions = sessionmaker(self.engine, class_=AsyncSession,
+                                         expire_on_commit=False)
+
+    async def stop(self):
+        """ close pooled connections """
+        if self.engine is not None:
+            await self.engine.dispose()
+            self.engine = None
+
+    async def lifespan(self, receive, send):
+        """ open the engine on startup and dispose it on shutdown """
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def view(self, scope):
+        """ async view for the request, None for the WSGI app """
+        if scope['type'] != 'http':
+            return None
+        adapter = self.app.url_map.bind('localhost', script_name=scope.get('root_path', ''))
+        try:
+            endpoint, _ = adapter.match(scope['path'], method=scope['method'])
+        except HTTPException:
+            return None
+        if endpoint == 'index' and self.app.config['PAGINATION'] != 'keyset':
+            return None
+        # streamed pages render while the rows are fetched, the WSGI app does that
+        if endpoint in STREAMED and self.app.config['STREAM_RESULTS']:
+            return None
+        return VIEWS.get(endpoint)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        view = self.view(scope)
+        if view is None:
+            return await self.wsgi(scope, receive, send)
+        self.start()
+        environ = build_environ(scope, await read_body(receive))
+        with self.app.request_context(environ):
+            try:
+                try:
+                    self.app.try_trigger_before_first_request_functions()
+                    request_started.send(self.app)
+                    rv = self.app.preprocess_request()
+                    if rv is None:
+                        async with self.sessions() as db_session:
+                            rv = await view(db_session)
+                except Exception as error:
+                    rv = self.app.handle_user_exception(error)
+                response = self.app.finalize_request(rv)
+            except Exception as error:
+                response = self.app.handle_exception(error)
+        await send({'type': 'http.response.start', 'status': response.status_code,
+                    'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                for name, value in response.headers.items()]})
+        await send({'type': 'http.response.body', 'body': response.get_data()})
+        response.close()
+
+
+application = AsyncReads(app)
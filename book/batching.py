@@ -0,0 +1,111 @@
+""" batching.py """
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from book import app, db
+
+
+class GroupCommitter():
+    """ daemon thread applying the edits of concurrent requests in shared transactions """
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self.thread = None
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.stopped = threading.Event()
+        self.commits = 0
+        self.edits = 0
+
+    def submit(self, edit, *args):
+        """ queue edit(*args), the future resolves once the transaction holding it committed """
+        self.start()
+        future = Future()
+        self.queue.put((future, edit, args))
+        return future
+
+    def collect(self):
+        """ the oldest waiting edit and those queued within the window, up to the batch size """
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.app.config['GROUP_COMMIT_WINDOW_MS'] / 1000
+        while len(batch) < self.app.config['GROUP_COMMIT_MAX_BATCH']:
+            try:
+                batch.append(self.queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        return [item for item in batch if item is not None]
+
+    def apply(self, batch):
+        """ one transaction for batch, a savepoint per edit so a failing one is undone alone """
+        if not batch:
+            return
+        with self.app.app_context():
+            connection = db.session.connection()
+            if connection.dialect.name == 'sqlite':
+                # pysqlite begins on the first write, a SAVEPOINT before it would open the
+                # transaction itself and its RELEASE would commit every edit on its own
+                connection.exec_driver_sql('BEGIN IMMEDIATE')
+            applied = []
+            for future, edit, args in batch:
+                try:
+                    # flushed per edit, so version checks see the edits before them
+                    with db.session.begin_nested():
+                        result = edit(*args)
+                except Exception as error:
+                    future.set_exception(error)
+                else:
+                    applied.append((future, result))
+            if not applied:
+                db.session.rollback()
+                return
+            try:
+                db.session.commit()
+            except Exception as error:
+                db.session.rollback()
+                for future, _ in applied:
+                    future.set_exception(error)
+                return
+            self.commits += 1
+            self.edits += len(applied)
+        for future, result in applied:
+            future.set_result(result)
+
+    def run(self):
+        """ apply batches until stopped """
+        while not self.stopped.is_set():
+            batch = self.collect()
+            try:
+                self.apply(batch)
+            except Exception as error:
+                self.app.logger.exception('Group commit failed')
+                for future, _, _ in batch:
+                    if not future.done():
+                        future.set_exception(error)
+
+    def start(self):
+        """ start the thread once per process """
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='group-commit',
+                                               daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        """ stop the thread after the batch in progress """
+        self.stopped.set()
+        self.queue.put(None)
+
+
+committer = GroupCommitter(app)
+
+
+def commit_edit(edit, *args):
+    """ edit(*args) committed, through the group committer when GROUP_COMMIT is on """
+    if not app.config['GROUP_COMMIT']:
+        result = edit(*args)
+        db.session.commit()
+        return result
+    # the request session only read, the edit runs in the committer session
+    db.session.rollback()
+    return committer.submit(edit, *args).result()
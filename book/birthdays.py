@@ -0,0 +1,16 @@
+""" birthdays.py """
+from datetime import date
+
+
+def next_birthday(birthday, today):
+    """ date of the next birthday on or after today, Feb 29 falls on Mar 1 in common years """
+    year = today.year
+    while True:
+        try:
+            candidate = date(year, birthday.month, birthday.day)
+        except ValueError:
+            candidate = date(year, 3, 1)
+        if candidate >= today:
+            return candidate
+        year += 1
+
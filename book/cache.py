@@ -0,0 +1,228 @@
+""" cache.py """
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import event
+from book import app, db
+
+
+TABLES = ('records', 'phones', 'emails', 'addresses', 'notes', 'tags', 'note_tags')
+CASCADES = {'records': TABLES, 'notes': ('notes', 'note_tags'), 'tags': ('tags', 'note_tags')}
+COLLECTIONS = {'notes': ('note_tags',), 'tags': ('note_tags',)}
+
+
+class NullCache():
+    """ backend that stores nothing """
+
+    def get(self, key):
+        """ always a miss """
+        return None
+
+    def set(self, key, value, ttl=None):
+        """ discard the value """
+
+    def clear(self):
+        """ nothing to clear """
+
+    def generations(self, names):
+        """ generation counters never move """
+        return [0] * len(names)
+
+    def bump(self, names):
+        """ nothing to invalidate """
+
+    def __len__(self):
+        return 0
+
+
+class LRUCache():
+    """ in-process backend with least recently used and TTL eviction """
+
+    def __init__(self, max_entries=1024, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """ value of a live entry, None when missing or expired """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """ store a value, evicting the least recently used entries over max_entries """
+        with self.lock:
+            self.entries[key] = (time.monotonic() + (ttl or self.ttl), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """ drop every entry, generation counters keep counting """
+        with self.lock:
+            self.entries.clear()
+
+    def generations(self, names):
+        """ current generation of each name """
+        with self.lock:
+            return [self.counters.get(name, 0) for name in names]
+
+    def bump(self, names):
+        """ move the generation of each name, orphaning entries built on the old one """
+        with self.lock:
+            for name in names:
+                self.counters[name] = self.counters.get(name, 0) + 1
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class RedisCache():
+    """ shared backend for several worker processes, needs the redis package """
+
+    def __init__(self, url, ttl=300, prefix='contacts:'):
+        try:
+            import redis
+        except ImportError as error:
+            raise RuntimeError('CACHE_BACKEND redis needs the redis package') from error
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        """ value of a live entry, None when missing or expired """
+        value = self.client.get(self.prefix + key)
+        return None if value is None else pickle.loads(value)
+
+    def set(self, key, value, ttl=None):
+        """ store a value, redis maxmemory policy handles size eviction """
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=ttl or self.ttl)
+
+    def clear(self):
+        """ drop every entry under the prefix, generation counters keep counting """
+        for key in self.client.scan_iter(self.prefix + 'page:*'):
+            self.client.delete(key)
+
+    def generations(self, names):
+        """ current generation of each name """
+        values = self.client.mget([self.prefix + 'generation:' + name for name in names])
+        return [int(value or 0) for value in values]
+
+    def bump(self, names):
+        """ move the generation of each name, orphaning entries built on the old one """
+        pipeline = self.client.pipeline()
+        for name in names:
+            pipeline.incr(self.prefix + 'generation:' + name)
+        pipeline.execute()
+
+    def __len__(self):
+        return sum(1 for _ in self.client.scan_iter(self.prefix + 'page:*'))
+
+
+def create_backend(config):
+    """ cache backend named by CACHE_BACKEND """
+    backend = config['CACHE_BACKEND']
+    if backend == 'null':
+        return NullCache()
+    if backend == 'lru':
+        return LRUCache(config['CACHE_MAX_ENTRIES'], config['CACHE_TTL'])
+    if backend == 'redis':
+        return RedisCache(config['CACHE_URL'], config['CACHE_TTL'])
+    raise ValueError('Unknown CACHE_BACKEND {}'.format(backend))
+
+
+class Cache():
+    """ query result and page cache keyed on the generations of the tables it reads """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, name, tables, args):
+        """ entry key for args under the current generations of tables """
+        generations = self.backend.generations(tables)
+        return 'page:{}:{}:{}'.format(name, '.'.join(map(str, generations)), repr(args))
+
+    def lookup(self, key):
+        """ cached value of key, counting the hit or miss """
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def fetch(self, name, tables, args, produce):
+        """ cached value of produce() for args, rebuilt when any of tables changed """
+        key = self.key(name, tables, args)
+        value = self.lookup(key)
+        if value is None:
+            value = produce()
+            self.backend.set(key, value)
+        return value
+
+    async def fetch_async(self, name, tables, args, produce):
+        """ fetch for a coroutine function produce """
+        key = self.key(name, tables, args)
+        value = self.lookup(key)
+        if value is None:
+            value = await produce()
+            self.backend.set(key, value)
+        return value
+
+    def invalidate(self, tables):
+        """ invalidate every entry reading any of tables """
+        self.backend.bump(sorted(tables))
+
+    def clear(self):
+        """ drop every entry """
+        self.backend.clear()
+
+    def stats(self):
+        """ hit and miss counters """
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.backend)}
+
+
+cache = Cache(create_backend(app.config))
+
+
+def changed_tables(session):
+    """ tables the current flush writes, including rows removed by ON DELETE CASCADE """
+    changed = set()
+    for obj in list(session.new) + list(session.dirty):
+        changed.add(obj.__table__.name)
+        changed.update(COLLECTIONS.get(obj.__table__.name, ()))
+    for obj in session.deleted:
+        changed.update(CASCADES.get(obj.__table__.name, (obj.__table__.name,)))
+    return changed
+
+
+@event.listens_for(db.session, 'after_flush')
+def collect_changed_tables(session, flush_context):
+    """ remember which tables a flush wrote until the commit """
+    session.info.setdefault('changed_tables', set()).update(changed_tables(session))
+
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_changed_tables(session):
+    """ invalidate cached entries once the writes are committed """
+    changed = session.info.pop('changed_tables', None)
+    if changed:
+        cache.invalidate(changed)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_changed_tables(session):
+    """ rolled back writes invalidate nothing """
+    session.info.pop('changed_tables', None)
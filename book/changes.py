@@ -0,0 +1,120 @@
+""" changes.py """
+from datetime import datetime
+from itertools import chain, takewhile
+from sqlalchemy import delete, event, func, insert, literal, select
+from book import db
+from book.models import Record, Phone, Email, Address, Note, Tag, Change, note_tags, \
+    row_record_ids
+
+
+MODELS = (Record, Phone, Email, Address, Note, Tag)
+CHUNK = 500
+OPERATIONS = ('insert', 'update', 'delete')
+COLUMNS = ('table_name', 'row_id', 'records_id', 'operation', 'changed_at')
+# key of the advisory lock that orders change log writers on PostgreSQL
+CHANGE_LOG_LOCK = 0x6368616e
+
+
+class CursorExpired(Exception):
+    """ a sync cursor older than the oldest retained change """
+
+
+def _tag_record_ids(connection, tag):
+    """ ids of the records with a note tagged tag, before and after the flush """
+    return row_record_ids(tag) | set(connection.execute(
+        select(Note.records_id).join(note_tags, note_tags.c.notes_id == Note.id)
+        .where(note_tags.c.tags_id == tag.id)).scalars())
+
+
+def lock_change_log(connection):
+    """ on PostgreSQL, keep other change log writers waiting until this transaction ends """
+    # a SERIAL seq is taken at insert and seen at commit, without the lock a later seq could
+    # be seen first and a sync in between would move its cursor past the earlier one
+    if connection.dialect.name == 'postgresql':
+        connection.execute(select(func.pg_advisory_xact_lock(CHANGE_LOG_LOCK)))
+
+
+@event.listens_for(db.session, 'before_flush')
+def lock_flushed_changes(session, flush_context, instances):
+    """ take the change log lock before the flush writes, so no row lock is held waiting """
+    if any(isinstance(obj, MODELS)
+           for obj in chain(session.new, session.dirty, session.deleted)):
+        lock_change_log(session.connection())
+
+
+@event.listens_for(db.session, 'after_flush')
+def log_changes(session, flush_context):
+    """ append a change per flushed row and record it belongs to """
+    now = datetime.utcnow()
+    rows = []
+    for operation, objects in zip(OPERATIONS, (session.new, session.dirty, session.deleted)):
+        for obj in objects:
+            if not isinstance(obj, MODELS) or \
+                    operation == 'update' and not session.is_modified(obj):
+                continue
+            if isinstance(obj, Tag):
+                record_ids = _tag_record_ids(session.connection(), obj)
+            else:
+                record_ids = row_record_ids(obj)
+            record_ids.discard(None)
+            rows += [dict(zip(COLUMNS, (obj.__tablename__, obj.id, record_id, operation, now)))
+                     for record_id in sorted(record_ids) or [None]]
+    if rows:
+        session.connection().execute(insert(Change.__table__), rows)
+
+
+def log_records(connection, record_ids, operation):
+    """ log records written with Core, with their phones, emails, addresses and notes """
+    now = datetime.utcnow()
+    record_ids = sorted(record_ids)
+    for start in range(0, len(record_ids), CHUNK):
+        chunk = record_ids[start:start + CHUNK]
+        for model in MODELS[:-1]:
+            owner = model.id if model is Record else model.records_id
+            connection.execute(insert(Change.__table__).from_select(COLUMNS, select(
+                literal(model.__tablename__), model.id, owner, literal(operation),
+                literal(now)).where(owner.in_(chunk)).order_by(model.id)))
+
+
+def latest_seq(connection):
+    """ sequence number of the newest change, 0 before the first one """
+    return connection.execute(select(func.max(Change.seq))).scalar() or 0
+
+
+class ChangePage():
+    """ changes after a cursor, the cursor of the last one and whether more follow """
+
+    def __init__(self, changes, more, since):
+        self.changes = changes
+        self.more = more
+        self.cursor = changes[-1].seq if changes else since
+        self.record_ids = sorted({change.records_id for change in changes
+                                  if change.records_id is not None})
+
+
+def changes_since(connection, since, limit):
+    """ page of up to limit changes after since, CursorExpired once it was pruned """
+    oldest = connection.execute(select(func.min(Change.seq))).scalar()
+    if oldest is not None and since + 1 < oldest:
+        raise CursorExpired(since)
+    changes = connection.execute(select(Change.__table__).where(Change.seq > since)
+                                 .order_by(Change.seq).limit(limit + 1)).all()
+    return ChangePage(changes[:limit], len(changes) > limit, since)
+
+
+def prune_changes(before, batch):
+    """ delete changes older than before, batch per short transaction, keeping the newest """
+    pruned = 0
+    while True:
+        with db.engine.begin() as connection:
+            newest = latest_seq(connection)
+            rows = connection.execute(select(Change.seq, Change.changed_at)
+                                      .order_by(Change.seq).limit(batch)).all()
+            # sequence numbers follow time, the old changes are a prefix of the log
+            seqs = [row.seq for row in takewhile(
+                lambda row: row.changed_at < before and row.seq < newest, rows)]
+            if seqs:
+                connection.execute(delete(Change.__table__).where(Change.seq.in_(seqs)))
+        pruned += len(seqs)
+        if len(seqs) < batch:
+            return pruned
@@ -0,0 +1,139 @@
+""" conditional.py """
+import gzip
+import hashlib
+from datetime import datetime, timedelta, timezone
+from flask import g, request, session
+from sqlalchemy import event, insert, select, update
+from book import app, db
+from book.cache import TABLES, changed_tables
+from book.models import CollectionVersion
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+CONDITIONAL_METHODS = ('GET', 'HEAD')
+COMPRESSIBLE = ('text/html', 'text/calendar', 'text/csv', 'application/json')
+BROTLI_QUALITY = 5
+
+# preferred first, brotli only when the package is installed
+ENCODERS = {}
+if brotli is not None:
+    ENCODERS['br'] = lambda data: brotli.compress(data, quality=BROTLI_QUALITY)
+ENCODERS['gzip'] = lambda data: gzip.compress(data, app.config['COMPRESS_LEVEL'])
+ETAG_SUFFIXES = [''] + ['-' + encoding for encoding in ENCODERS]
+
+
+@event.listens_for(CollectionVersion.__table__, 'after_create')
+def seed_collection_versions(target, connection, **kw):
+    """ one row per tracked table, so bumps are plain updates """
+    connection.execute(insert(target), [{'name': name, 'version': 0,
+                                         'changed_at': datetime.utcnow()} for name in TABLES])
+
+
+def bump_versions(connection, tables):
+    """ move the version of tables inside the writing transaction """
+    # sorted, so concurrent writers lock the rows in the same order
+    connection.execute(update(CollectionVersion.__table__)
+                       .where(CollectionVersion.name.in_(sorted(tables)))
+                       .values(version=CollectionVersion.version + 1,
+                               changed_at=datetime.utcnow()))
+
+
+@event.listens_for(db.session, 'after_flush')
+def bump_flushed_versions(session, flush_context):
+    """ move the version of every table the flush wrote """
+    tables = changed_tables(session)
+    if tables:
+        bump_versions(session.connection(), tables)
+
+
+def collection_versions(connection, tables):
+    """ (name, version, changed_at) of tables """
+    return [tuple(row) for row in connection.execute(
+        select(CollectionVersion.name, CollectionVersion.version, CollectionVersion.changed_at)
+        .where(CollectionVersion.name.in_(tables)).order_by(CollectionVersion.name))]
+
+
+def matching_etag(etags, etag):
+    """ the variant of etag, plain or of a compressed encoding, found in etags """
+    return next((etag + suffix for suffix in ETAG_SUFFIXES if etags.contains(etag + suffix)),
+                None)
+
+
+def fresh(name, args, versions):
+    """ set the validators of a page built from versions, True when the client copy is current """
+    if request.method not in CONDITIONAL_METHODS or '_flashes' in session:
+        return False
+    key = repr((app.config['RELEASE'], name, args,
+                [(table, version) for table, version, _ in versions]))
+    etag = hashlib.blake2b(key.encode(), digest_size=12).hexdigest()
+    changed = max((changed_at for _, _, changed_at in versions), default=None)
+    g.validators = (etag, changed)
+    if request.if_none_match:
+        matched = matching_etag(request.if_none_match, etag)
+        if matched:
+            # the 304 names the variant the client holds
+            g.validators = (matched, changed)
+        return matched is not None
+    since = request.if_modified_since
+    return changed is not None and since is not None and \
+        changed.replace(tzinfo=timezone.utc, microsecond=0) <= since
+
+
+def unchanged(name, tables, args):
+    """ fresh for a page reading tables through the request session """
+    # read on every request, the cache generations only see this process' commits
+    return fresh(name, args, collection_versions(db.session.connection(), tables))
+
+
+async def unchanged_async(db_session, name, tables, args):
+    """ unchanged for a page reading tables through an async session """
+
+    def read(sync_session):
+        return collection_versions(sync_session.connection(), tables)
+
+    return fresh(name, args, await db_session.run_sync(read))
+
+
+def not_modified():
+    """ empty 304, the validators are added after the request """
+    return app.response_class(status=304)
+
+
+@app.after_request
+def compress(response):
+    """ gzip or brotli for large text responses the client accepts it for """
+    if response.status_code != 200 or response.direct_passthrough or response.is_streamed \
+            or 'Content-Encoding' in response.headers \
+            or response.mimetype not in COMPRESSIBLE:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(list(ENCODERS))
+    data = response.get_data()
+    if encoding is None or len(data) < app.config['COMPRESS_MIN_SIZE']:
+        return response
+    response.set_data(ENCODERS[encoding](data))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        # a strong ETag names the exact bytes, so every encoding gets its own
+        response.set_etag(etag + '-' + encoding)
+    return response
+
+
+@app.after_request
+def set_validators(response):
+    """ ETag and Last-Modified of pages that went through fresh """
+    validators = g.get('validators')
+    if validators is None or response.status_code not in (200, 304):
+        return response
+    etag, changed = validators
+    response.set_etag(etag)
+    # a change in the current second could be followed by another one in the same
+    # second, If-Modified-Since could not tell them apart
+    if changed is not None and changed <= datetime.utcnow() - timedelta(seconds=1):
+        response.last_modified = changed.replace(tzinfo=timezone.utc)
+    response.cache_control.no_cache = True
+    return response
@@ -0,0 +1,105 @@
+""" duplicates.py """
+from itertools import combinations, groupby
+from sqlalchemy import func, select
+from book import db
+from book.models import Record, Phone, Email
+
+
+MAX_BLOCK = 20
+CHUNK = 500
+WEIGHTS = {'phone': 3, 'email': 3, 'name': 2, 'birthday': 1}
+MIN_SCORE = 3
+MERGED = (('phones', lambda phone: phone.normalized),
+          ('emails', lambda email: _fold(email.title)),
+          ('addresses', lambda address: _fold(address.title)))
+BLOCKS = (
+    ('phone', select(Phone.normalized, Phone.records_id)
+     .where(Phone.normalized.isnot(None)).order_by(Phone.normalized, Phone.records_id)),
+    ('email', select(func.lower(Email.title), Email.records_id)
+     .where(Email.title.isnot(None), Email.title != '')
+     .order_by(func.lower(Email.title), Email.records_id)),
+    ('name', select(Record.name_key, Record.id, Record.birthday)
+     .where(Record.name_key.isnot(None)).order_by(Record.name_key, Record.id)),
+)
+
+
+def _birth_year(row):
+    """ second blocking key of a name row, 0 without a birthday """
+    return row[2].year if row[2] else 0
+
+
+def candidate_pairs(connection, max_block=MAX_BLOCK):
+    """ {(id, id): reasons} of records sharing a blocking key, one sorted scan per key,
+    and the number of blocks left out for having more than max_block records """
+    pairs, skipped = {}, 0
+    for reason, statement in BLOCKS:
+        for _, rows in groupby(connection.execute(statement), key=lambda row: row[0]):
+            blocks = [list(rows)]
+            if reason == 'name' and len(blocks[0]) > max_block:
+                # a common name, split on the birth year so only namesakes born alike pair up
+                blocks = [list(group) for _, group in
+                          groupby(sorted(blocks[0], key=_birth_year), key=_birth_year)]
+            for block in blocks:
+                ids = sorted({row[1] for row in block})
+                if len(ids) > max_block:
+                    skipped += 1
+                    continue
+                for pair in combinations(ids, 2):
+                    pairs.setdefault(pair, set()).add(reason)
+    return pairs, skipped
+
+
+def find_duplicates(connection, limit=None, max_block=MAX_BLOCK):
+    """ merge suggestions, best scored first, and the number of skipped blocks """
+    pairs, skipped = candidate_pairs(connection, max_block)
+    ids = sorted({record_id for pair in pairs for record_id in pair})
+    birthdays = {}
+    for start in range(0, len(ids), CHUNK):
+        birthdays.update(connection.execute(select(Record.id, Record.birthday).where(
+            Record.id.in_(ids[start:start + CHUNK]), Record.deleted_at.is_(None))).all())
+    suggestions = []
+    for (first, second), reasons in pairs.items():
+        if first not in birthdays or second not in birthdays:
+            continue
+        if birthdays[first] is not None and birthdays[first] == birthdays[second]:
+            reasons.add('birthday')
+        score = sum(WEIGHTS[reason] for reason in reasons)
+        if score >= MIN_SCORE:
+            suggestions.append({'records': [first, second], 'score': score,
+                                'reasons': [reason for reason in WEIGHTS if reason in reasons]})
+    suggestions.sort(key=lambda item: (-item['score'], item['records']))
+    return (suggestions[:limit] if limit else suggestions), skipped
+
+
+def _fold(value):
+    """ comparison form of a child value """
+    return ' '.join((value or '').lower().split())
+
+
+def merge_records(target, sources):
+    """ move the child rows of sources onto target and delete sources, in the session """
+    sources = [source for source in sources if source is not target]
+    if not sources:
+        raise ValueError('Nothing to merge.')
+    seen = {field: {key(child) for child in getattr(target, field)} for field, key in MERGED}
+    notes = {_fold(note.title): note for note in target.notes}
+    for source in sources:
+        for field, key in MERGED:
+            for child in list(getattr(source, field)):
+                if key(child) in seen[field]:
+                    db.session.delete(child)
+                else:
+                    seen[field].add(key(child))
+                    child.records = target
+        for note in list(source.notes):
+            kept = notes.get(_fold(note.title))
+            if kept is None:
+                notes[_fold(note.title)] = note
+                note.records = target
+            else:
+                kept.tags.extend(tag for tag in note.tags if tag not in kept.tags)
+                db.session.delete(note)
+        if target.birthday is None and source.birthday is not None:
+            target.birthday = source.birthday
+        db.session.delete(source)
+    return target
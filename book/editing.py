@@ -0,0 +1,123 @@
+""" editing.py """
+from book import db
+from book.listing import listing_options
+from book.models import Record, Phone, Email, Address, Note, Tag, normalize_number
+from book.tags import normalize_title, tags_by_title, rename_tag, retag_note
+
+
+CHILDREN = (('phones', Phone, 'number'), ('emails', Email, 'title'),
+            ('addresses', Address, 'title'), ('notes', Note, 'title'))
+
+
+class VersionConflict(Exception):
+    """ the record changed since the editor loaded it """
+
+
+def check_version(record, version):
+    """ VersionConflict unless the record is still at the version the editor saw """
+    if version is not None and record.version != version:
+        raise VersionConflict('Contact {} was changed by someone else.'.format(record.id))
+
+
+def contact_data(record):
+    """ ContactForm data of a record, with an empty row of each kind for additions """
+    data = {'version': record.version, 'name': record.name, 'birthday': record.birthday}
+    for field, _, column in CHILDREN:
+        data[field] = [{'ref': child.id, 'value': getattr(child, column)}
+                       for child in getattr(record, field)] + [{'ref': None, 'value': ''}]
+    for row, note in zip(data['notes'], record.notes):
+        row['tags'] = ', '.join(tag.title for tag in note.tags)
+    return data
+
+
+def replace_phones(record, rows):
+    """ set the phones of a record from (ref, number) rows, left out phones are deleted """
+    # a number the contact already has keeps its row wherever it was entered, so no insert or
+    # update clashes with the unique number per contact before the row it came from is gone
+    existing = {phone.normalized: phone for phone in record.phones}
+    by_id = {phone.id: phone for phone in record.phones}
+    rows = [(ref, number) for ref, number in rows if number]
+    claimed = {existing[normalize_number(number)].id for _, number in rows
+               if normalize_number(number) in existing}
+    phones = []
+    for ref, number in rows:
+        phone = existing.get(normalize_number(number))
+        if phone is None:
+            phone = by_id.get(ref)
+            if phone is None or phone.id in claimed:
+                phone = Phone()
+            claimed.add(phone.id)
+        if phone.number != number:
+            phone.number = number
+        if phone not in phones:
+            phones.append(phone)
+    for phone in record.phones:
+        if phone not in phones:
+            db.session.delete(phone)
+    record.phones = phones
+
+
+def update_contact(record, data):
+    """ apply ContactForm data to a record and its child rows, emptied rows are deleted """
+    with db.session.no_autoflush:
+        record.name = data['name']
+        record.birthday = data['birthday']
+        rows = [(row['ref'], (row['value'] or '').strip()) for row in data['phones']]
+        # phones the form did not send are kept as they are
+        refs = {ref for ref, _ in rows}
+        replace_phones(record, rows + [(phone.id, phone.number) for phone in record.phones
+                                       if phone.id not in refs])
+        for field, model, column in CHILDREN[1:]:
+            children = getattr(record, field)
+            existing = {child.id: child for child in children}
+            for row in data[field]:
+                value = (row['value'] or '').strip()
+                tags = row.get('tags') or ''
+                child = existing.get(row['ref'])
+                if not value and not tags.strip():
+                    if child is not None:
+                        children.remove(child)
+                        db.session.delete(child)
+                    continue
+                if child is None:
+                    child = model(**{column: value})
+                    children.append(child)
+                elif getattr(child, column) != value:
+                    setattr(child, column, value)
+                if field == 'notes':
+                    titles = [title for title in map(normalize_title, tags.split(',')) if title]
+                    if [tag.title for tag in child.tags] != titles:
+                        child.tags = tags_by_title(titles)
+    return record
+
+
+def update_row(model, row_id, values):
+    """ set columns of the row of model with row_id, one deleted meanwhile is left alone """
+    row = model.query.get(row_id)
+    if row is not None:
+        for column, value in values.items():
+            setattr(row, column, value)
+
+
+def tag_note(note_id, title):
+    """ add the tag titled title to a note """
+    note = Note.query.get(note_id)
+    note.tags.extend(tag for tag in tags_by_title([title]) if tag not in note.tags)
+
+
+def retitle_tag(tag_id, note_id, title):
+    """ rename a tag everywhere, or on one note when note_id is given """
+    tag = Tag.query.get(tag_id)
+    if note_id is None:
+        rename_tag(tag, title)
+    else:
+        retag_note(Note.query.get(note_id), tag, title)
+
+
+def save_contact(record_id, data):
+    """ update_contact of the record with record_id at the version the editor saw """
+    record = Record.query.options(*listing_options()).get(record_id)
+    if record is None:
+        raise VersionConflict('Contact {} was deleted by someone else.'.format(record_id))
+    check_version(record, data['version'])
+    update_contact(record, data)
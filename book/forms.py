@@ -1,9 +1,38 @@
 """ forms.py """
 from datetime import date
 from flask_wtf import FlaskForm
-from wtforms import StringField, SubmitField, DateField, EmailField
-from wtforms.validators import ValidationError, DataRequired
-from book.models import Record
+from wtforms import Form, StringField, SubmitField, DateField, EmailField, IntegerField, \
+    FieldList, FormField
+from wtforms.validators import ValidationError, DataRequired, Optional
+from wtforms.widgets import HiddenInput
+from sqlalchemy import func
+from book import db
+from book.models import Record, Phone, normalize_number
+
+
+def name_taken(name):
+    """ check the name against the case-insensitive unique index """
+    return db.session.query(
+        Record.query.filter(func.lower(Record.name) == func.lower(name)).exists()).scalar()
+
+
+def check_phone(number):
+    """ phone numbers are exactly 12 digits """
+    if len(number) != 12:
+        raise ValidationError('Invalid phone number(at least 12 digits).')
+    if not number.isdigit():
+        raise ValidationError('Invalid phone number(only numbers allowed).')
+
+
+def unique_numbers(numbers):
+    """ numbers without repeats of the same normalized number, first one kept """
+    seen = set()
+    result = []
+    for number in numbers:
+        if normalize_number(number) not in seen:
+            seen.add(normalize_number(number))
+            result.append(number)
+    return result
 
 
 class RecordForm(FlaskForm):
@@ -18,16 +47,12 @@ class RecordForm(FlaskForm):
 
     def validate_name(self, name):
         """ validate name """
-        user = Record.query.filter_by(name=name.data).first()
-        if user is not None:
+        if name_taken(name.data.capitalize()):
             raise ValidationError('Please use a different name.')
 
     def validate_phone(self, phone):
         """ validate phone """
-        if len(phone.data) != 12:
-            raise ValidationError('Invalid phone number(at least 12 digits).')
-        if not phone.data.isdigit():
-            raise ValidationError('Invalid phone number(only numbers allowed).')
+        check_phone(phone.data)
 
 
 class EditRecordForm(FlaskForm):
@@ -36,18 +61,32 @@ class EditRecordForm(FlaskForm):
     birthday = DateField('Birthday')
     submit = SubmitField('Edit')
 
+    def __init__(self, original_name, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.original_name = original_name
+
+    def validate_name(self, name):
+        """ validate name """
+        if name.data.lower() != (self.original_name or '').lower() and name_taken(name.data):
+            raise ValidationError('Please use a different name.')
+
 
 class EditPhoneForm(FlaskForm):
     """ EditPhoneForm """
     number = StringField('Number')
     submit = SubmitField('Edit')
 
+    def __init__(self, phone=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.phone = phone
+
     def validate_number(self, number):
         """ validate number """
-        if len(number.data) != 12:
-            raise ValidationError('Invalid phone number(at least 12 digits).')
-        if not number.data.isdigit():
-            raise ValidationError('Invalid phone number(only numbers allowed).')
+        check_phone(number.data)
+        if self.phone is not None and db.session.query(Phone.query.filter(
+                Phone.records_id == self.phone.records_id, Phone.id != self.phone.id,
+                Phone.normalized == normalize_number(number.data)).exists()).scalar():
+            raise ValidationError('The contact already has this number.')
 
 
 class EditEmailForm(FlaskForm):
@@ -74,6 +113,46 @@ class AddTagForm(FlaskForm):
     submit = SubmitField('Submit')
 
 
+class ChildForm(Form):
+    """ one phone, email, address or note row of ContactForm """
+    ref = IntegerField(widget=HiddenInput(), validators=[Optional()])
+    value = StringField()
+
+
+class NoteRowForm(ChildForm):
+    """ NoteRowForm """
+    tags = StringField('Tags')
+
+
+class ContactForm(FlaskForm):
+    """ ContactForm """
+    version = IntegerField(widget=HiddenInput(), validators=[Optional()])
+    name = StringField('Name', validators=[DataRequired()])
+    birthday = DateField('Birthday', validators=[Optional()])
+    phones = FieldList(FormField(ChildForm))
+    emails = FieldList(FormField(ChildForm))
+    addresses = FieldList(FormField(ChildForm))
+    notes = FieldList(FormField(NoteRowForm))
+    submit = SubmitField('Save')
+
+    def __init__(self, original_name, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.original_name = original_name
+
+    def validate_name(self, name):
+        """ validate name """
+        if name.data.lower() != (self.original_name or '').lower() and name_taken(name.data):
+            raise ValidationError('Please use a different name.')
+
+    def validate_phones(self, phones):
+        """ validate phones """
+        numbers = [entry.value.data.strip() for entry in phones if entry.value.data.strip()]
+        for number in numbers:
+            check_phone(number)
+        if len(unique_numbers(numbers)) != len(numbers):
+            raise ValidationError('The contact already has this number.')
+
+
 class DeleteForm(FlaskForm):
     """ DeleteForm """
     submit = SubmitField('Yes')
@@ -0,0 +1,168 @@
+""" instrumentation.py """
+import threading
+import time
+from flask import g, has_request_context, request, request_started, request_finished, \
+    before_render_template, template_rendered, Response, abort
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from book import app
+from book.cache import cache
+
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float('inf'))
+
+
+class Metrics():
+    """ per endpoint request, SQL and render totals with a latency histogram """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def record(self, endpoint, status, total, queries, sql, render):
+        """ add one finished request """
+        with self.lock:
+            stats = self.endpoints.setdefault(endpoint, {
+                'requests': {}, 'seconds': 0.0, 'queries': 0, 'sql_seconds': 0.0,
+                'render_seconds': 0.0, 'buckets': [0] * len(BUCKETS)})
+            stats['requests'][status] = stats['requests'].get(status, 0) + 1
+            stats['seconds'] += total
+            stats['queries'] += queries
+            stats['sql_seconds'] += sql
+            stats['render_seconds'] += render
+            for i, bound in enumerate(BUCKETS):
+                if total <= bound:
+                    stats['buckets'][i] += 1
+
+    def reset(self):
+        """ forget everything recorded so far """
+        with self.lock:
+            self.endpoints.clear()
+
+    def render(self):
+        """ Prometheus text exposition of the recorded metrics and cache counters """
+        lines = []
+
+        def family(name, kind, text):
+            lines.append('# HELP {} {}'.format(name, text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+
+        with self.lock:
+            endpoints = sorted(self.endpoints.items())
+            family('contacts_requests_total', 'counter', 'Requests handled.')
+            for endpoint, stats in endpoints:
+                for status, count in sorted(stats['requests'].items()):
+                    lines.append('contacts_requests_total{{endpoint="{}",status="{}"}} {}'
+                                 .format(endpoint, status, count))
+            family('contacts_request_duration_seconds', 'histogram', 'Request latency.')
+            for endpoint, stats in endpoints:
+                for bound, count in zip(BUCKETS, stats['buckets']):
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('contacts_request_duration_seconds_bucket'
+                                 '{{endpoint="{}",le="{}"}} {}'.format(endpoint, le, count))
+                lines.append('contacts_request_duration_seconds_sum{{endpoint="{}"}} {:.6f}'
+                             .format(endpoint, stats['seconds']))
+                lines.append('contacts_request_duration_seconds_count{{endpoint="{}"}} {}'
+                             .format(endpoint, stats['buckets'][-1]))
+            for name, key, text in (
+                    ('contacts_sql_queries_total', 'queries', 'SQL statements executed.'),
+                    ('contacts_sql_seconds_total', 'sql_seconds', 'Time spent in SQL.'),
+                    ('contacts_render_seconds_total', 'render_seconds',
+                     'Time spent rendering templates.')):
+                family(name, 'counter', text)
+                for endpoint, stats in endpoints:
+                    lines.append('{}{{endpoint="{}"}} {}'.format(name, endpoint, stats[key]))
+        stats = cache.stats()
+        family('contacts_cache_hits_total', 'counter', 'Cache hits.')
+        lines.append('contacts_cache_hits_total {}'.format(stats['hits']))
+        family('contacts_cache_misses_total', 'counter', 'Cache misses.')
+        lines.append('contacts_cache_misses_total {}'.format(stats['misses']))
+        family('contacts_cache_entries', 'gauge', 'Entries held by the cache backend.')
+        lines.append('contacts_cache_entries {}'.format(stats['entries']))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+@request_started.connect_via(app)
+def start_request(sender, **extra):
+    """ reset the per request counters """
+    g.request_start = time.perf_counter()
+    g.query_count = 0
+    g.sql_time = 0.0
+    g.render_time = 0.0
+    g.render_start = []
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query(conn, cursor, statement, parameters, context, executemany):
+    """ remember when a statement started """
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def finish_query(conn, cursor, statement, parameters, context, executemany):
+    """ count and time SQL statements issued while handling a request, log slow ones """
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    threshold = app.config['SLOW_QUERY_MS']
+    if threshold is not None and elapsed * 1000 >= threshold:
+        app.logger.warning('Slow query (%.1f ms) in %s: %s', elapsed * 1000,
+                           request.endpoint if has_request_context() else None, statement)
+    if has_request_context() and 'query_count' in g:
+        g.query_count += 1
+        g.sql_time += elapsed
+
+
+@event.listens_for(Engine, "handle_error")
+def fail_query(context):
+    """ forget the start of a statement that raised, after_cursor_execute never comes """
+    if context.connection is not None and context.connection.info.get('query_start'):
+        context.connection.info['query_start'].pop()
+
+
+@before_render_template.connect_via(app)
+def start_render(sender, template, context, **extra):
+    """ remember when a template started rendering """
+    if has_request_context() and 'render_start' in g:
+        g.render_start.append(time.perf_counter())
+
+
+@template_rendered.connect_via(app)
+def finish_render(sender, template, context, **extra):
+    """ add the template render time to the request """
+    if has_request_context() and g.get('render_start'):
+        g.render_time += time.perf_counter() - g.render_start.pop()
+
+
+@request_finished.connect_via(app)
+def finish_request(sender, response, **extra):
+    """ add timing headers and record the request in the metrics once the body is sent """
+    if 'request_start' not in g:
+        return
+    total = time.perf_counter() - g.request_start
+    response.headers['X-Query-Count'] = str(g.query_count)
+    if app.config['SERVER_TIMING']:
+        response.headers['Server-Timing'] = ', '.join((
+            'sql;desc="{} queries";dur={:.3f}'.format(g.query_count, g.sql_time * 1000),
+            'render;dur={:.3f}'.format(g.render_time * 1000),
+            'total;dur={:.3f}'.format(total * 1000)))
+    if request.endpoint == 'metrics_endpoint':
+        return
+    # a streamed body is generated after this signal, its queries land on the same g
+    timings = g._get_current_object()
+    endpoint, status = request.endpoint or 'unmatched', response.status_code
+
+    def record():
+        metrics.record(endpoint, status, time.perf_counter() - timings.request_start,
+                       timings.query_count, timings.sql_time, timings.render_time)
+
+    response.call_on_close(record)
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """ metrics """
+    if not app.config['METRICS_ENDPOINT']:
+        abort(404)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,115 @@
+""" listing.py """
+import base64
+import json
+import time
+from sqlalchemy import event, inspect, tuple_
+from sqlalchemy.orm import selectinload
+from book import db
+from book.models import Record, Note
+
+
+def listing_options():
+    """ eager load every collection rendered in a contact row """
+    return (selectinload(Record.phones),
+            selectinload(Record.emails),
+            selectinload(Record.addresses),
+            selectinload(Record.notes).selectinload(Note.tags))
+
+
+def listing_query():
+    """ records query with phones, emails, addresses, notes and tags preloaded """
+    return Record.query.options(*listing_options())
+
+
+def encode_cursor(record):
+    """ opaque cursor for the (name, id) key of a record """
+    key = json.dumps([record.name, record.id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """ (name, id) key of a cursor, ValueError when it is malformed """
+    try:
+        name, record_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (TypeError, ValueError, UnicodeError) as error:
+        raise ValueError('Invalid cursor') from error
+    if not isinstance(name, str) or not isinstance(record_id, int):
+        raise ValueError('Invalid cursor')
+    return name, record_id
+
+
+class KeysetPage():
+    """ one page of records seeked on the indexed (name, id) key """
+
+    def __init__(self, items, has_prev, has_next, total=None):
+        self.items = items
+        self.has_prev = has_prev and bool(items)
+        self.has_next = has_next and bool(items)
+        self.total = total
+        self.prev_cursor = encode_cursor(items[0]) if self.has_prev else None
+        self.next_cursor = encode_cursor(items[-1]) if self.has_next else None
+
+
+def keyset_statement(query, per_page, after=None, before=None):
+    """ query or select seeked past cursor after, or before cursor before, one row extra """
+    key = tuple_(Record.name, Record.id)
+    if before is not None:
+        return query.filter(key < decode_cursor(before)) \
+            .order_by(Record.name.desc(), Record.id.desc()).limit(per_page + 1)
+    if after is not None:
+        query = query.filter(key > decode_cursor(after))
+    return query.order_by(Record.name, Record.id).limit(per_page + 1)
+
+
+def keyset_result(rows, per_page, after=None, before=None, total=None):
+    """ page from the rows fetched by keyset_statement """
+    if before is not None:
+        return KeysetPage(rows[:per_page][::-1], len(rows) > per_page, True, total)
+    return KeysetPage(rows[:per_page], after is not None, len(rows) > per_page, total)
+
+
+def keyset_page(query, per_page, after=None, before=None, total=None):
+    """ the page of query following cursor after, or preceding cursor before """
+    rows = keyset_statement(query, per_page, after, before).all()
+    return keyset_result(rows, per_page, after, before, total)
+
+
+_count = {}
+
+
+def cached_record_count():
+    """ cached number of records, None once it expired """
+    return _count['value'] if _count.get('expires', 0) > time.monotonic() else None
+
+
+def remember_record_count(value, ttl):
+    """ cache the number of records for ttl seconds """
+    _count['value'] = value
+    _count['expires'] = time.monotonic() + ttl
+    return value
+
+
+def record_count(ttl):
+    """ number of records, cached for ttl seconds and dropped on inserts and deletes """
+    count = cached_record_count()
+    if count is None:
+        count = remember_record_count(Record.query.count(), ttl)
+    return count
+
+
+def forget_record_count():
+    """ drop the cached record count """
+    _count.clear()
+
+
+@event.listens_for(db.session, 'after_flush')
+def forget_flushed_record_count(session, flush_context):
+    """ inserted, deleted or restored records invalidate the cached count """
+    for obj in list(session.new) + list(session.deleted):
+        if isinstance(obj, Record):
+            forget_record_count()
+            return
+    for obj in session.dirty:
+        if isinstance(obj, Record) and inspect(obj).attrs.deleted_at.history.has_changes():
+            forget_record_count()
+            return
@@ -1,14 +1,99 @@
 """ models.py """
+from itertools import chain
 from sqlalchemy.engine import Engine
-from sqlalchemy import event
-from book import db
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.orm import Session, validates, with_loader_criteria
+from sqlalchemy.orm.attributes import flag_modified
+from book import app, db
 
 
-@event.listens_for(Engine, "connect")
-def set_sqlite_pragma(dbapi_connection, connection_record):
+SQLITE_PRAGMAS = (
+    ('busy_timeout', 'SQLITE_BUSY_TIMEOUT'),
+    ('journal_mode', 'SQLITE_JOURNAL_MODE'),
+    ('synchronous', 'SQLITE_SYNCHRONOUS'),
+    ('cache_size', 'SQLITE_CACHE_SIZE'),
+    ('mmap_size', 'SQLITE_MMAP_SIZE'),
+)
+
+
+POSTGRES_SETTINGS = (
+    ('statement_timeout', 'POSTGRES_STATEMENT_TIMEOUT'),
+    ('lock_timeout', 'POSTGRES_LOCK_TIMEOUT'),
+)
+
+
+def set_sqlite_pragma(dbapi_connection):
     cursor = dbapi_connection.cursor()
     cursor.execute("PRAGMA foreign_keys=ON")
+    for pragma, option in SQLITE_PRAGMAS:
+        value = app.config.get(option)
+        if value is not None:
+            cursor.execute("PRAGMA {}={}".format(pragma, value))
+    cursor.close()
+
+
+def set_postgres_settings(dbapi_connection):
+    """ session settings, applied outside a transaction so they outlive rollbacks """
+    autocommit = dbapi_connection.autocommit
+    dbapi_connection.autocommit = True
+    cursor = dbapi_connection.cursor()
+    for setting, option in POSTGRES_SETTINGS:
+        value = app.config.get(option)
+        if value is not None:
+            cursor.execute("SET {} = {}".format(setting, int(value)))
     cursor.close()
+    dbapi_connection.autocommit = autocommit
+
+
+CONNECT_HOOKS = {'sqlite': set_sqlite_pragma, 'postgresql': set_postgres_settings}
+
+
+@event.listens_for(Engine, "do_connect")
+def connect(dialect, connection_record, cargs, cparams):
+    """ open a DBAPI connection and run the connect hook of its dialect """
+    dbapi_connection = dialect.connect(*cargs, **cparams)
+    hook = CONNECT_HOOKS.get(dialect.name)
+    if hook is not None:
+        hook(dbapi_connection)
+    return dbapi_connection
+
+
+SOUNDEX = {char: code for code, chars in (('1', 'BFPV'), ('2', 'CGJKQSXZ'), ('3', 'DT'),
+                                         ('4', 'L'), ('5', 'MN'), ('6', 'R'))
+           for char in chars}
+
+
+def name_key(name):
+    """ Soundex of the letters of a name, the lowercased letters for non Latin names """
+    letters = [char for char in (name or '').upper() if char.isalpha()]
+    if not letters:
+        return None
+    if not 'A' <= letters[0] <= 'Z':
+        return ''.join(letters).lower()
+    key, last = letters[0], SOUNDEX.get(letters[0])
+    for char in letters[1:]:
+        code = SOUNDEX.get(char)
+        if code and code != last:
+            key += code
+            if len(key) == 4:
+                break
+        if char not in 'HW':
+            last = code
+    return key.ljust(4, '0')
+
+
+def normalize_number(number):
+    """ phone number in +<country><number> form, trunk prefixed ones get PHONE_COUNTRY_CODE """
+    digits = ''.join(char for char in number or '' if char.isdigit())
+    if not digits:
+        return None
+    if (number or '').lstrip().startswith('+'):
+        return '+' + digits
+    if digits.startswith('00'):
+        return '+' + digits[2:]
+    if digits.startswith('0'):
+        return '+' + app.config['PHONE_COUNTRY_CODE'] + digits[1:]
+    return '+' + digits
 
 
 class Phone(db.Model):
@@ -16,8 +101,26 @@ class Phone(db.Model):
     __tablename__ = "phones"
     id = db.Column(db.Integer, primary_key=True)
     number = db.Column(db.String)
-    records_id = db.Column(db.Integer, db.ForeignKey('records.id', ondelete='CASCADE'))
+    normalized = db.Column(db.String)
+    records_id = db.Column(db.Integer, db.ForeignKey('records.id', ondelete='CASCADE'),
+                           index=True)
     records = db.relationship("Record", back_populates="phones")
+    __table_args__ = (db.Index('uq_phones_normalized_records_id', normalized, records_id,
+                               unique=True),)
+
+    @validates('number')
+    def validate_number(self, key, number):
+        """ keep normalized in step with number """
+        self.normalized = normalize_number(number)
+        return number
+
+
+note_tags = db.Table(
+    'note_tags',
+    db.Column('notes_id', db.Integer, db.ForeignKey('notes.id', ondelete='CASCADE'),
+              primary_key=True),
+    db.Column('tags_id', db.Integer, db.ForeignKey('tags.id', ondelete='CASCADE'),
+              primary_key=True, index=True))
 
 
 class Note(db.Model):
@@ -25,18 +128,20 @@ class Note(db.Model):
     __tablename__ = "notes"
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String)
-    records_id = db.Column(db.Integer, db.ForeignKey('records.id', ondelete='CASCADE'))
+    records_id = db.Column(db.Integer, db.ForeignKey('records.id', ondelete='CASCADE'),
+                           index=True)
     records = db.relationship("Record", back_populates="notes")
-    tags = db.relationship("Tag", back_populates="notes", passive_deletes='all')
+    tags = db.relationship("Tag", secondary=note_tags, back_populates="notes",
+                           order_by="Tag.id", passive_deletes=True)
 
 
 class Tag(db.Model):
     """ Tag """
     __tablename__ = "tags"
     id = db.Column(db.Integer, primary_key=True)
-    title = db.Column(db.String)
-    notes_id = db.Column(db.Integer, db.ForeignKey('notes.id', ondelete='CASCADE'))
-    notes = db.relationship("Note", back_populates="tags")
+    title = db.Column(db.String, index=True, unique=True)
+    notes = db.relationship("Note", secondary=note_tags, back_populates="tags",
+                            passive_deletes=True)
 
 
 class Address(db.Model):
@@ -44,7 +149,8 @@ class Address(db.Model):
     __tablename__ = "addresses"
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String)
-    records_id = db.Column(db.Integer, db.ForeignKey('records.id', ondelete='CASCADE'))
+    records_id = db.Column(db.Integer, db.ForeignKey('records.id', ondelete='CASCADE'),
+                           index=True)
     records = db.relationship("Record", back_populates="addresses")
 
 
@@ -53,8 +159,10 @@ class Email(db.Model):
     __tablename__ = "emails"
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String)
-    records_id = db.Column(db.Integer, db.ForeignKey('records.id', ondelete='CASCADE'))
+    records_id = db.Column(db.Integer, db.ForeignKey('records.id', ondelete='CASCADE'),
+                           index=True)
     records = db.relationship("Record", back_populates="emails")
+    __table_args__ = (db.Index('ix_emails_title_lower', func.lower(title), records_id),)
 
 
 class Record(db.Model):
@@ -63,7 +171,110 @@ class Record(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String)
     birthday = db.Column(db.Date)
+    name_key = db.Column(db.String, index=True)
+    deleted_at = db.Column(db.DateTime, index=True)
+    version = db.Column(db.Integer, nullable=False, server_default='1')
+    # children serialized for the listing, kept up to date by book.snapshots
+    snapshot = db.deferred(db.Column(db.Text))
     phones = db.relationship("Phone", back_populates="records", passive_deletes='all')
     notes = db.relationship("Note", back_populates="records", passive_deletes='all')
     addresses = db.relationship("Address", back_populates="records", passive_deletes='all')
     emails = db.relationship("Email", back_populates="records", passive_deletes='all')
+    __table_args__ = (db.Index('ix_records_name_id', name, id),
+                      db.Index('uq_records_name_lower', func.lower(name), unique=True,
+                               sqlite_where=deleted_at.is_(None),
+                               postgresql_where=deleted_at.is_(None)))
+    __mapper_args__ = {'version_id_col': version}
+
+    @validates('name')
+    def validate_name(self, key, name):
+        """ keep name_key in step with name """
+        self.name_key = name_key(name)
+        return name
+
+
+class UpcomingBirthday(db.Model):
+    """ next birthday of a record after the day it was computed """
+    __tablename__ = "upcoming_birthdays"
+    records_id = db.Column(db.Integer, db.ForeignKey('records.id', ondelete='CASCADE'),
+                           primary_key=True)
+    next_birthday = db.Column(db.Date, index=True)
+
+
+class CollectionVersion(db.Model):
+    """ version of a table, moved by every transaction writing it """
+    __tablename__ = "collection_versions"
+    name = db.Column(db.String, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    changed_at = db.Column(db.DateTime, nullable=False)
+
+
+class Change(db.Model):
+    """ append-only log entry of an inserted, updated or deleted row """
+    __tablename__ = "changes"
+    seq = db.Column(db.Integer, primary_key=True)
+    table_name = db.Column(db.String, nullable=False)
+    row_id = db.Column(db.Integer, nullable=False)
+    records_id = db.Column(db.Integer)
+    operation = db.Column(db.String, nullable=False)
+    changed_at = db.Column(db.DateTime, nullable=False)
+    __table_args__ = {'sqlite_autoincrement': True}
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def hide_deleted_records(orm_execute_state):
+    """ leave soft deleted records out of ORM selects unless include_deleted is set """
+    if orm_execute_state.is_select and \
+            not orm_execute_state.execution_options.get('include_deleted', False):
+        orm_execute_state.statement = orm_execute_state.statement.options(
+            with_loader_criteria(Record, Record.deleted_at.is_(None), include_aliases=True))
+
+
+@event.listens_for(db.session, 'before_flush')
+def bump_record_versions(session, flush_context, instances):
+    """ changed phones, emails, addresses and notes move the version of their record """
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if not isinstance(obj, (Phone, Email, Address, Note)) or \
+                obj not in session.deleted and not session.is_modified(obj):
+            continue
+        record = obj.records
+        if record is None and obj.records_id is not None:
+            record = session.get(Record, obj.records_id)
+        if record is not None and record not in session.new and \
+                record not in session.deleted and \
+                not session.is_modified(record, include_collections=False):
+            flag_modified(record, 'name')
+
+
+def _history_values(state, key):
+    """ current and replaced values of an attribute, without loading it """
+    history = state.attrs[key].history
+    return set(history.sum()) | {state.dict.get(key)}
+
+
+def row_record_ids(obj):
+    """ ids of the records a flushed row belongs to, before and after the flush """
+    state = inspect(obj)
+    if isinstance(obj, Record):
+        return {obj.id}
+    if isinstance(obj, Tag):
+        return {note.records_id for note in state.attrs.notes.history.sum()}
+    return _history_values(state, 'records_id') | \
+        {record.id for record in _history_values(state, 'records') if record is not None}
+
+
+def touched_record_ids(session):
+    """ ids of records whose row or child rows are part of the current flush """
+    record_ids, tag_ids = set(), set()
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, Tag):
+            tag_ids.add(obj.id)
+        record_ids |= row_record_ids(obj)
+    tag_ids.discard(None)
+    if tag_ids:
+        rows = session.connection().execute(
+            select(Note.records_id).join(note_tags, note_tags.c.notes_id == Note.id)
+            .where(note_tags.c.tags_id.in_(tag_ids)))
+        record_ids.update(row.records_id for row in rows)
+    record_ids.discard(None)
+    return record_ids
@@ -0,0 +1,88 @@
+""" reads.py """
+import json
+from collections import namedtuple
+from flask import abort
+from flask_sqlalchemy import Pagination
+from sqlalchemy import func, select
+from book import app
+from book.models import Record, Phone, Email, Address, Note, Tag, note_tags
+
+
+CHILDREN = (('phones', Phone, Phone.number), ('emails', Email, Email.title),
+            ('addresses', Address, Address.title))
+
+PhoneRow = namedtuple('PhoneRow', 'id number')
+TitleRow = namedtuple('TitleRow', 'id title')
+NoteRow = namedtuple('NoteRow', 'id title tags')
+
+
+class ContactRow():
+    """ read-only listing row of a record, no identity map or change tracking """
+    __slots__ = ('id', 'name', 'birthday', 'phones', 'emails', 'addresses', 'notes')
+
+    def __init__(self, record_id, name, birthday, parts):
+        self.id = record_id
+        self.name = name
+        self.birthday = birthday
+        self.phones = [PhoneRow(*phone) for phone in parts['phones']]
+        self.emails = [TitleRow(*email) for email in parts['emails']]
+        self.addresses = [TitleRow(*address) for address in parts['addresses']]
+        self.notes = [NoteRow(note_id, title, [TitleRow(*tag) for tag in tags])
+                      for note_id, title, tags in parts['notes']]
+
+
+def children(connection, record_ids):
+    """ phones, emails, addresses and notes with tags of each of record_ids as lists """
+    parts = {record_id: {'phones': [], 'emails': [], 'addresses': [], 'notes': []}
+             for record_id in record_ids}
+    if not parts:
+        return parts
+    for name, model, column in CHILDREN:
+        for row in connection.execute(select(model.records_id, model.id, column)
+                                      .where(model.records_id.in_(record_ids))
+                                      .order_by(model.id)):
+            parts[row[0]][name].append([row[1], row[2]])
+    notes = {}
+    for row in connection.execute(select(Note.records_id, Note.id, Note.title)
+                                  .where(Note.records_id.in_(record_ids)).order_by(Note.id)):
+        notes[row.id] = [row.id, row.title, []]
+        parts[row.records_id]['notes'].append(notes[row.id])
+    for row in connection.execute(
+            select(note_tags.c.notes_id, Tag.id, Tag.title)
+            .join(Tag, Tag.id == note_tags.c.tags_id)
+            .join(Note, Note.id == note_tags.c.notes_id)
+            .where(Note.records_id.in_(record_ids)).order_by(Tag.id)):
+        notes[row.notes_id][2].append([row.id, row.title])
+    return parts
+
+
+def contact_statement():
+    """ Core select of live records with the columns a listing row is built from """
+    columns = [Record.id, Record.name, Record.birthday]
+    if app.config['LISTING_SNAPSHOTS']:
+        columns.append(Record.snapshot)
+    return select(*columns).where(Record.deleted_at.is_(None))
+
+
+def contact_rows(connection, statement):
+    """ ContactRow per row of a contact_statement, children from snapshots when selected """
+    rows = connection.execute(statement).all()
+    parts = {row.id: json.loads(row.snapshot) for row in rows
+             if getattr(row, 'snapshot', None)}
+    parts.update(children(connection, [row.id for row in rows if row.id not in parts]))
+    return [ContactRow(row.id, row.name, row.birthday, parts[row.id]) for row in rows]
+
+
+def offset_page(connection, statement, page, per_page):
+    """ Query.paginate for a contact_statement, 404 outside the pages """
+    if page < 1:
+        abort(404)
+    items = contact_rows(connection, statement.limit(per_page).offset((page - 1) * per_page))
+    if not items and page != 1:
+        abort(404)
+    if page == 1 and len(items) < per_page:
+        total = len(items)
+    else:
+        total = connection.execute(select(func.count()).select_from(
+            statement.order_by(None).subquery())).scalar()
+    return Pagination(None, page, per_page, total, items)
@@ -1,19 +1,88 @@
 """ routes.py """
-from datetime import datetime, timedelta
-from flask import render_template, flash, redirect, url_for, request
+import io
+from datetime import date, datetime
+from flask import render_template, flash, redirect, url_for, request, abort, jsonify, \
+    Response, stream_with_context, session
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
 from book import app, db
 from book.forms import RecordForm, EditRecordForm, EditPhoneForm, EditEmailForm, \
-    EditAddressForm, EditNoteForm, AddTagForm, DeleteForm
+    EditAddressForm, EditNoteForm, AddTagForm, DeleteForm, ContactForm
 from book.models import Record, Phone, Email, Address, Note, Tag
+from book.cache import cache, TABLES
+from book.conditional import unchanged, not_modified
+from book.batching import commit_edit
+from book.editing import VersionConflict, contact_data, save_contact, update_row, tag_note, \
+    retitle_tag
+from book.listing import listing_options, keyset_statement, keyset_result, record_count
+from book.search import search_records
+from book.reads import contact_statement, contact_rows, offset_page
+from book.streaming import page_size, streaming, stream_template
+from book.transfer import FORMATS, EXPORTERS, export_contacts, guess_format, \
+    import_contacts
+from book.tags import tagged_record_ids, tagged_count_statement, tag_counts, complete_tags
+from book.trash import trash_records, deleted_records, restore_records
+from book.upcoming import MAX_DAYS, upcoming_birthdays, feed_items, calendar
+
+
+def cached_page(name, tables, args, produce):
+    """ rendered page from the cache unless flash messages are waiting to be shown """
+    if '_flashes' in session:
+        return produce()
+    return cache.fetch(name, tables, args, produce)
+
+
+def child_or_404(model, row_id):
+    """ phone, email, address or note of a live record, 404 otherwise """
+    row = model.query.get(row_id)
+    # the lazy load of a soft deleted record is filtered like any record select
+    if row is None or row.records is None:
+        abort(404)
+    return row
+
+
+def render_index():
+    """ render_index """
+    per_page = app.config['RECORDS_PER_PAGE']
+    tag = request.args.get('tag')
+    after, before = request.args.get('after'), request.args.get('before')
+    statement = contact_statement()
+    if tag:
+        statement = statement.where(Record.id.in_(tagged_record_ids(tag)))
+    connection = db.session.connection()
+    if app.config['PAGINATION'] == 'keyset':
+        ttl = app.config['PAGINATION_COUNT_TTL']
+        if tag:
+            total = db.session.scalar(tagged_count_statement(tag))
+        else:
+            total = record_count(ttl) if ttl else None
+        try:
+            statement = keyset_statement(statement, per_page, after, before)
+        except ValueError:
+            abort(400)
+        records = keyset_result(contact_rows(connection, statement), per_page, after, before,
+                                total)
+    else:
+        page = request.args.get('page', 1, type=int)
+        records = offset_page(connection, statement.order_by(Record.name, Record.id), page,
+                              per_page)
+    return render_template('index.html', title='Home', records=records)
 
 
 @app.route('/')
 @app.route('/index')
 def index():
     """ index """
-    page = request.args.get('page', 1, type=int)
-    records = Record.query.paginate(page=page, per_page=8)
-    return render_template('index.html', title='Home', records=records)
+    args = (app.config['PAGINATION'], app.config['RECORDS_PER_PAGE'], request.full_path)
+    if unchanged('index', TABLES, args):
+        return not_modified()
+    return cached_page('index', TABLES, args, render_index)
+
+
+def render_search(contact, page, per_page):
+    """ render_search """
+    records = search_records(contact, page, per_page)
+    return render_template('search.html', records=records)
 
 
 @app.route('/search', methods=['GET', 'POST'])
@@ -24,51 +93,89 @@ def search():
         if not contact:
             flash('Enter the name of contact')
             return redirect(url_for('index'))
-        records = Record.query.filter(Record.name == contact.capitalize())
-        return render_template('search.html', records=records)
-    return render_template('search.html')
+        page = 1
+    else:
+        contact = request.args.get('q')
+        if not contact:
+            return render_template('search.html')
+        page = request.args.get('page', 1, type=int)
+    per_page = page_size()
+    args = (contact, page, per_page)
+    if unchanged('search', TABLES, args):
+        return not_modified()
+    if streaming():
+        return stream_template('search.html', records=search_records(
+            contact, page, per_page, app.config['STREAM_YIELD_PER']))
+    return cached_page('search', TABLES, args, lambda: render_search(contact, page, per_page))
+
 
+def birthday_line(row, today):
+    """ birthday_line """
+    days = (row.next_birthday - today).days
+    return f"{row.name} {row.birthday} | {days} days left till next birthday"
 
-def days_to_birthday(birthday):
-    """ days_to_birthday """
-    current_date = datetime.today().date()
-    birthday = datetime.strptime(birthday, "%Y-%m-%d").replace(year=current_date.year).date()
-    if birthday < current_date:
-        birthday = birthday.replace(year=birthday.year + 1)
-    days = (birthday - current_date).days
-    return f"{days} days left till next birthday"
+
+def birthday_lines(rows, today):
+    """ birthday_lines """
+    return [birthday_line(row, today) for row in rows]
 
 
 @app.route('/holidays_period', methods=['GET', 'POST'])
 def holidays_period():
     """ holidays_period """
-    if request.method == "POST":
-        period = request.form['period']
+    period = request.form['period'] if request.method == "POST" else request.args.get('period')
+    if period is not None:
         if not period.isdigit():
             flash('Invalid data(only numbers allowed).')
             return redirect(url_for('index'))
         if int(period) > 365:
             flash('Period cannot be more than 365')
             return redirect(url_for('index'))
-        records = Record.query.all()
-        day_today = datetime.now()
-        day_today_year = day_today.year
-        end_period = day_today + timedelta(days=int(period)+1)
-        result = []
-        for i in records:
-            date = datetime.strptime(str(i.birthday), '%Y-%m-%d').replace(year=end_period.year)
-            if day_today_year < end_period.year:
-                if day_today <= date.replace(year=day_today_year) or date <= end_period:
-                    result.append(f"{i.name} {i.birthday} | {days_to_birthday(str(i.birthday))}")
-            else:
-                if day_today <= date.replace(year=day_today_year) <= end_period:
-                    result.append(f"{i.name} {i.birthday} | {days_to_birthday(str(i.birthday))}")
-        if not result:
-            result.append('No contacts with birthdays for this period.')
+        period = int(period)
+        today = date.today()
+        if unchanged('holidays_period', ('records',), (period, today)):
+            return not_modified()
+        if streaming():
+            rows = upcoming_birthdays(period, today, app.config['STREAM_YIELD_PER'])
+            return stream_template('holidays_period.html',
+                                   result=(birthday_line(row, today) for row in rows))
+        result = cache.fetch('holidays_period', ('records',), (period, today),
+                             lambda: birthday_lines(upcoming_birthdays(period, today), today))
         return render_template('holidays_period.html', result=result)
     return render_template('holidays_period.html')
 
 
+@app.route('/upcoming.<fmt>')
+def upcoming_feed(fmt):
+    """ upcoming_feed """
+    if fmt not in ('json', 'ics'):
+        abort(404)
+    days = min(request.args.get('days', 30, type=int), MAX_DAYS)
+    today = date.today()
+    items = cache.fetch('upcoming', ('records',), (days, today),
+                        lambda: feed_items(upcoming_birthdays(days, today), today))
+    if fmt == 'json':
+        return jsonify(items=items)
+    return Response(calendar(items), mimetype='text/calendar',
+                    headers={'Content-Disposition': 'inline; filename=birthdays.ics'})
+
+
+@app.route('/tags')
+def tags():
+    """ tags """
+    items = cache.fetch('tags', ('notes', 'tags', 'note_tags'), (),
+                        lambda: [{'title': title, 'contacts': contacts}
+                                 for title, contacts in tag_counts()])
+    return jsonify(items=items)
+
+
+@app.route('/tags/complete')
+def complete_tag():
+    """ complete_tag """
+    limit = min(request.args.get('limit', 10, type=int), 100)
+    return jsonify(items=complete_tags(request.args.get('q', ''), limit))
+
+
 @app.route('/add_record', methods=['GET', 'POST'])
 def add_record():
     """ add_record """
@@ -90,24 +197,49 @@ def add_record():
 def edit_record(id_record):
     """ edit_record """
     record = Record.query.get(id_record)
-    form = EditRecordForm(obj=record)
+    if record is None:
+        abort(404)
+    form = EditRecordForm(record.name, obj=record)
     if form.validate_on_submit():
-        record.name = form.name.data
-        record.birthday = form.birthday.data
-        db.session.commit()
+        commit_edit(update_row, Record, record.id,
+                    {'name': form.name.data, 'birthday': form.birthday.data})
         flash('Your changes have been saved.')
         return redirect(url_for('index'))
     return render_template('edit.html', title='Edit record', form=form)
 
 
+@app.route('/contact/<id_record>', methods=['GET', 'POST'])
+def edit_contact(id_record):
+    """ edit_contact """
+    record = Record.query.options(*listing_options()).get(id_record)
+    if record is None:
+        abort(404)
+    form = ContactForm(record.name, data=contact_data(record))
+    if form.validate_on_submit():
+        try:
+            commit_edit(save_contact, record.id, form.data)
+        except (VersionConflict, StaleDataError, IntegrityError):
+            # the form checks its own numbers, a clash left is a concurrent change
+            db.session.rollback()
+            record = Record.query.options(*listing_options()).get(id_record)
+            if record is None:
+                abort(404)
+            flash('Someone else changed this contact, check their changes and save again.')
+            form = ContactForm(record.name, formdata=None, data=contact_data(record))
+            return render_template('contact.html', title='Edit contact', form=form,
+                                   record=record), 409
+        flash('Your changes have been saved.')
+        return redirect(url_for('edit_contact', id_record=id_record))
+    return render_template('contact.html', title='Edit contact', form=form, record=record)
+
+
 @app.route('/edit_phone/<id_phone>', methods=['GET', 'POST'])
 def edit_phone(id_phone):
     """ edit_phone """
-    phone = Phone.query.get(id_phone)
-    form = EditPhoneForm(obj=phone)
+    phone = child_or_404(Phone, id_phone)
+    form = EditPhoneForm(phone, obj=phone)
     if form.validate_on_submit():
-        phone.number = form.number.data
-        db.session.commit()
+        commit_edit(update_row, Phone, phone.id, {'number': form.number.data})
         flash('Your changes have been saved.')
         return redirect(url_for('index'))
     return render_template('edit.html', title='Edit phone', form=form)
@@ -116,11 +248,10 @@ def edit_phone(id_phone):
 @app.route('/edit_email/<id_email>', methods=['GET', 'POST'])
 def edit_email(id_email):
     """ edit_email """
-    email = Email.query.get(id_email)
+    email = child_or_404(Email, id_email)
     form = EditEmailForm(obj=email)
     if form.validate_on_submit():
-        email.title = form.title.data
-        db.session.commit()
+        commit_edit(update_row, Email, email.id, {'title': form.title.data})
         flash('Your changes have been saved.')
         return redirect(url_for('index'))
     return render_template('edit.html', title='Edit email', form=form)
@@ -129,11 +260,10 @@ def edit_email(id_email):
 @app.route('/edit_address/<id_address>', methods=['GET', 'POST'])
 def edit_address(id_address):
     """ edit_address """
-    address = Address.query.get(id_address)
+    address = child_or_404(Address, id_address)
     form = EditAddressForm(obj=address)
     if form.validate_on_submit():
-        address.title = form.title.data
-        db.session.commit()
+        commit_edit(update_row, Address, address.id, {'title': form.title.data})
         flash('Your changes have been saved.')
         return redirect(url_for('index'))
     return render_template('edit.html', title='Edit address', form=form)
@@ -142,11 +272,10 @@ def edit_address(id_address):
 @app.route('/edit_note/<id_note>', methods=['GET', 'POST'])
 def edit_note(id_note):
     """ edit_note """
-    note = Note.query.get(id_note)
+    note = child_or_404(Note, id_note)
     form = EditNoteForm(obj=note)
     if form.validate_on_submit():
-        note.title = form.title.data
-        db.session.commit()
+        commit_edit(update_row, Note, note.id, {'title': form.title.data})
         flash('Your changes have been saved.')
         return redirect(url_for('index'))
     return render_template('edit.html', title='Edit note', form=form)
@@ -155,12 +284,10 @@ def edit_note(id_note):
 @app.route('/add_tag/<id_note>', methods=['GET', 'POST'])
 def add_tag(id_note):
     """ add_tag """
-    note = Note.query.get(id_note)
+    note = child_or_404(Note, id_note)
     form = AddTagForm()
     if form.validate_on_submit():
-        tag = Tag(title=form.title.data, notes_id=note.id)
-        db.session.add(tag)
-        db.session.commit()
+        commit_edit(tag_note, note.id, form.title.data)
         flash('Record have been saved!')
         return redirect(url_for('index'))
     return render_template('add.html', title='record', form=form)
@@ -169,11 +296,13 @@ def add_tag(id_note):
 @app.route('/edit_tag/<id_tag>', methods=['GET', 'POST'])
 def edit_tag(id_tag):
     """ edit_tag """
-    tag = Tag.query.get(id_tag)
+    tag = Tag.query.get_or_404(id_tag)
+    note_id = request.args.get('note', type=int)
+    if note_id is not None:
+        child_or_404(Note, note_id)
     form = AddTagForm(obj=tag)
     if form.validate_on_submit():
-        tag.title = form.title.data
-        db.session.commit()
+        commit_edit(retitle_tag, tag.id, note_id, form.title.data)
         flash('Your changes have been saved.')
         return redirect(url_for('index'))
     return render_template('edit.html', title='Edit tag', form=form)
@@ -182,12 +311,66 @@ def edit_tag(id_tag):
 @app.route('/delete_record/<id_record>', methods=['GET', 'POST'])
 def delete_record(id_record):
     """ delete_record """
-    record = Record.query.get(id_record)
+    record = Record.query.get_or_404(id_record)
     form = DeleteForm()
     if request.method == 'POST':
         if form.validate_on_submit():
-            db.session.delete(record)
-            db.session.commit()
-            flash(f'Your delete contact: {record.name}')
+            if app.config['SOFT_DELETE']:
+                trash_records([record], datetime.utcnow())
+                db.session.commit()
+                session['undo'] = record.id
+                flash(f'Your delete contact: {record.name}', 'undo')
+            else:
+                db.session.delete(record)
+                db.session.commit()
+                flash(f'Your delete contact: {record.name}')
             return redirect(url_for('index'))
     return render_template('delete.html', title='Delete record', form=form, record=record)
+
+
+@app.route('/restore_record/<id_record>', methods=['GET', 'POST'])
+def restore_record(id_record):
+    """ restore_record """
+    records = deleted_records([id_record], datetime.utcnow())
+    if not records:
+        flash('The contact can no longer be restored.')
+        return redirect(url_for('index'))
+    form = DeleteForm()
+    if form.validate_on_submit():
+        restore_records(records)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            flash(f'Another contact is already named {records[0].name}.')
+            return redirect(url_for('index'))
+        flash(f'Your restore contact: {records[0].name}')
+        return redirect(url_for('index'))
+    return render_template('restore.html', title='Restore record', form=form, record=records[0])
+
+
+@app.route('/export')
+def export_records():
+    """ export_records """
+    fmt = request.args.get('format', 'csv')
+    if fmt not in FORMATS:
+        abort(400)
+    _, mimetype, filename = EXPORTERS[fmt]
+    return Response(stream_with_context(export_contacts(fmt)), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+
+@app.route('/import', methods=['POST'])
+def import_records():
+    """ import_records """
+    upload = request.files.get('file')
+    fmt = request.args.get('format') or request.form.get('format')
+    if upload is not None:
+        fmt = fmt or guess_format(upload.filename)
+        stream = upload.stream
+    else:
+        stream = request.stream
+    if fmt not in FORMATS:
+        return jsonify(error=f'Unknown format, use one of {", ".join(FORMATS)}.'), 400
+    result = import_contacts(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''), fmt)
+    return jsonify(result.as_dict())
@@ -0,0 +1,163 @@
+""" search.py """
+from sqlalchemy import DDL, bindparam, event, text
+from book import db
+from book.models import Record, touched_record_ids
+from book.reads import contact_statement, contact_rows
+
+
+CREATE_INDEX = DDL(
+    "CREATE VIRTUAL TABLE IF NOT EXISTS contact_search USING fts5("
+    "name, phones, emails, addresses, notes, tags, prefix='2 3')")
+RANK_WEIGHTS = DDL(
+    "INSERT INTO contact_search(contact_search, rank) "
+    "VALUES ('rank', 'bm25(10.0, 5.0, 5.0, 2.0, 1.0, 2.0)')")
+# postgresql keeps a weighted tsvector per record, the weights follow the bm25 ones
+CREATE_DOCUMENTS = DDL(
+    "CREATE TABLE IF NOT EXISTS contact_search ("
+    "rowid INTEGER PRIMARY KEY, document TSVECTOR NOT NULL)")
+CREATE_DOCUMENTS_INDEX = DDL(
+    "CREATE INDEX IF NOT EXISTS ix_contact_search_document "
+    "ON contact_search USING gin (document)")
+DROP_INDEX = DDL("DROP TABLE IF EXISTS contact_search")
+
+event.listen(db.metadata, 'after_create', CREATE_INDEX.execute_if(dialect='sqlite'))
+event.listen(db.metadata, 'after_create', RANK_WEIGHTS.execute_if(dialect='sqlite'))
+event.listen(db.metadata, 'after_create', CREATE_DOCUMENTS.execute_if(dialect='postgresql'))
+event.listen(db.metadata, 'after_create',
+             CREATE_DOCUMENTS_INDEX.execute_if(dialect='postgresql'))
+event.listen(db.metadata, 'after_drop',
+             DROP_INDEX.execute_if(dialect=('sqlite', 'postgresql')))
+
+DOCUMENTS = {'sqlite': """
+    INSERT INTO contact_search(rowid, name, phones, emails, addresses, notes, tags)
+    SELECT records.id, records.name,
+        (SELECT group_concat(number, ' ') FROM phones WHERE records_id = records.id),
+        (SELECT group_concat(title, ' ') FROM emails WHERE records_id = records.id),
+        (SELECT group_concat(title, ' ') FROM addresses WHERE records_id = records.id),
+        (SELECT group_concat(title, ' ') FROM notes WHERE records_id = records.id),
+        (SELECT group_concat(tags.title, ' ') FROM tags
+            JOIN note_tags ON note_tags.tags_id = tags.id
+            JOIN notes ON notes.id = note_tags.notes_id WHERE notes.records_id = records.id)
+    FROM records WHERE records.deleted_at IS NULL
+""", 'postgresql': """
+    INSERT INTO contact_search(rowid, document)
+    SELECT records.id,
+        setweight(to_tsvector('simple', coalesce(records.name, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce((SELECT string_agg(number, ' ')
+            FROM phones WHERE records_id = records.id), '')), 'B') ||
+        setweight(to_tsvector('simple', coalesce((SELECT string_agg(title, ' ')
+            FROM emails WHERE records_id = records.id), '')), 'B') ||
+        setweight(to_tsvector('simple', coalesce((SELECT string_agg(title, ' ')
+            FROM addresses WHERE records_id = records.id), '')), 'C') ||
+        setweight(to_tsvector('simple', coalesce((SELECT string_agg(title, ' ')
+            FROM notes WHERE records_id = records.id), '')), 'D') ||
+        setweight(to_tsvector('simple', coalesce((SELECT string_agg(tags.title, ' ')
+            FROM tags JOIN note_tags ON note_tags.tags_id = tags.id
+            JOIN notes ON notes.id = note_tags.notes_id
+            WHERE notes.records_id = records.id), '')), 'C')
+    FROM records WHERE records.deleted_at IS NULL
+"""}
+INSERT_DOCUMENTS = {dialect: text(documents + " AND records.id IN :ids").bindparams(
+    bindparam('ids', expanding=True)) for dialect, documents in DOCUMENTS.items()}
+DELETE_DOCUMENTS = text("DELETE FROM contact_search WHERE rowid IN :ids").bindparams(
+    bindparam('ids', expanding=True))
+MATCH = {'sqlite': text("SELECT rowid FROM contact_search WHERE contact_search MATCH :match "
+                        "ORDER BY rank LIMIT :limit OFFSET :offset"),
+         'postgresql': text("SELECT rowid FROM contact_search, "
+                            "to_tsquery('simple', :match) AS query WHERE document @@ query "
+                            "ORDER BY ts_rank(document, query) DESC, rowid "
+                            "LIMIT :limit OFFSET :offset")}
+
+CHUNK = 500
+
+
+def reindex(connection, record_ids):
+    """ rebuild the search documents of the given records """
+    record_ids = sorted(record_ids)
+    for start in range(0, len(record_ids), CHUNK):
+        chunk = record_ids[start:start + CHUNK]
+        connection.execute(DELETE_DOCUMENTS, {'ids': chunk})
+        connection.execute(INSERT_DOCUMENTS[connection.dialect.name], {'ids': chunk})
+
+
+def rebuild(connection):
+    """ rebuild the whole search index """
+    connection.execute(text("DELETE FROM contact_search"))
+    connection.execute(text(DOCUMENTS[connection.dialect.name]))
+
+
+@event.listens_for(db.session, 'after_flush')
+def sync_search_index(session, flush_context):
+    """ keep search documents in step with flushed records and child rows """
+    record_ids = touched_record_ids(session)
+    if record_ids:
+        reindex(session.connection(), record_ids)
+
+
+def match_expression(terms):
+    """ FTS5 query matching every whitespace separated term as a prefix """
+    return ' '.join('"{}"*'.format(term.replace('"', '""')) for term in terms.split())
+
+
+def tsquery_expression(terms):
+    """ to_tsquery text matching every whitespace separated term as a prefix """
+    return ' & '.join("'{}':*".format(term.replace('\\', '\\\\').replace("'", "''"))
+                      for term in terms.split())
+
+
+MATCH_EXPRESSIONS = {'sqlite': match_expression, 'postgresql': tsquery_expression}
+
+
+class SearchPage():
+    """ one page of ranked search results """
+
+    def __init__(self, terms, page, per_page, items, has_next):
+        self.terms = terms
+        self.page = page
+        self.per_page = per_page
+        self.items = items
+        self.has_next = has_next
+        self.has_prev = page > 1
+        self.next_num = page + 1
+        self.prev_num = page - 1
+
+
+def match_parameters(dialect, terms, page, per_page):
+    """ MATCH parameters for one page of terms, None when there is nothing to match """
+    match = MATCH_EXPRESSIONS[dialect](terms)
+    if not match:
+        return None
+    return {'match': match, 'limit': per_page + 1, 'offset': (page - 1) * per_page}
+
+
+def ranked_page(terms, page, per_page, ids, records):
+    """ page of records in the rank order of ids, fetched one past per_page """
+    records = {record.id: record for record in records}
+    items = [records[i] for i in ids[:per_page] if i in records]
+    return SearchPage(terms, page, per_page, items, len(ids) > per_page)
+
+
+def ranked_records(ids, chunk):
+    """ records of ids in rank order, loaded chunk at a time while iterated """
+    for start in range(0, len(ids), chunk):
+        ranked = ids[start:start + chunk]
+        records = {record.id: record for record in contact_rows(
+            db.session.connection(), contact_statement().where(Record.id.in_(ranked)))}
+        yield from (records[i] for i in ranked if i in records)
+
+
+def search_records(terms, page, per_page, chunk=None):
+    """ records matching terms in name, phones, emails, addresses, notes or tags, best first """
+    # with chunk the items are a generator loading chunk records per query
+    page = max(page, 1)
+    dialect = db.engine.dialect.name
+    parameters = match_parameters(dialect, terms, page, per_page)
+    if parameters is None:
+        return SearchPage(terms, page, per_page, [], False)
+    ids = [row.rowid for row in db.session.execute(MATCH[dialect], parameters)]
+    if chunk:
+        return SearchPage(terms, page, per_page, ranked_records(ids[:per_page], chunk),
+                          len(ids) > per_page)
+    records = contact_rows(db.session.connection(),
+                           contact_statement().where(Record.id.in_(ids[:per_page])))
+    return ranked_page(terms, page, per_page, ids, records)
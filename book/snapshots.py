@@ -0,0 +1,64 @@
+""" snapshots.py """
+import json
+from sqlalchemy import bindparam, event, select, update
+from book import db
+from book.models import Record, touched_record_ids
+from book.reads import children
+
+
+CHUNK = 500
+
+
+def snapshots(connection, record_ids):
+    """ serialized phones, emails, addresses and notes with tags of each of record_ids """
+    return {record_id: json.dumps(part, separators=(',', ':'))
+            for record_id, part in children(connection, record_ids).items()}
+
+
+def refresh_snapshots(connection, record_ids):
+    """ rewrite the snapshots of the given records """
+    record_ids = sorted(record_ids)
+    statement = update(Record.__table__).where(Record.id == bindparam('record_id')) \
+        .values(snapshot=bindparam('value'))
+    for start in range(0, len(record_ids), CHUNK):
+        chunk = record_ids[start:start + CHUNK]
+        values = snapshots(connection, chunk)
+        connection.execute(statement, [{'record_id': record_id, 'value': value}
+                                       for record_id, value in values.items()])
+
+
+def _record_id_chunks(connection):
+    """ ids of every record, soft deleted ones included, CHUNK at a time """
+    last = 0
+    while True:
+        chunk = connection.execute(select(Record.id).where(Record.id > last)
+                                   .order_by(Record.id).limit(CHUNK)).scalars().all()
+        if not chunk:
+            return
+        yield chunk
+        last = chunk[-1]
+
+
+def rebuild_snapshots(connection):
+    """ rewrite every snapshot """
+    for chunk in _record_id_chunks(connection):
+        refresh_snapshots(connection, chunk)
+
+
+def stale_snapshots(connection):
+    """ ids of records whose stored snapshot differs from their child rows """
+    stale = []
+    for chunk in _record_id_chunks(connection):
+        stored = dict(connection.execute(select(Record.id, Record.snapshot)
+                                         .where(Record.id.in_(chunk))).all())
+        stale += [record_id for record_id, value in snapshots(connection, chunk).items()
+                  if stored[record_id] != value]
+    return stale
+
+
+@event.listens_for(db.session, 'after_flush')
+def sync_snapshots(session, flush_context):
+    """ keep snapshots in step with flushed records and child rows """
+    record_ids = touched_record_ids(session)
+    if record_ids:
+        refresh_snapshots(session.connection(), record_ids)
@@ -0,0 +1,24 @@
+""" streaming.py """
+from flask import Response, request, session, stream_with_context
+from book import app
+
+
+def page_size():
+    """ per_page of the request, RECORDS_PER_PAGE by default and at most MAX_PER_PAGE """
+    per_page = request.args.get('per_page', app.config['RECORDS_PER_PAGE'], type=int)
+    return min(max(per_page, 1), app.config['MAX_PER_PAGE'])
+
+
+def streaming():
+    """ whether result pages stream, never with flash messages to pop """
+    # a streamed page renders after the session cookie went out, popped messages
+    # would come back on the next page
+    return app.config['STREAM_RESULTS'] and '_flashes' not in session
+
+
+def stream_template(template_name, **context):
+    """ response sending the template while it renders, rows are fetched as it goes """
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering()
+    return Response(stream_with_context(stream))
@@ -0,0 +1,100 @@
+""" tags.py """
+from sqlalchemy import exists, func, select
+from sqlalchemy.dialects import postgresql, sqlite
+from book import db
+from book.models import Record, Note, Tag, note_tags
+
+
+INSERTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+
+def normalize_title(title):
+    """ tag title with surrounding and repeated whitespace removed """
+    return ' '.join((title or '').split())
+
+
+def insert_tags(connection, titles):
+    """ create the tags that do not exist yet, without racing the unique title index """
+    rows = [{'title': title} for title in dict.fromkeys(titles)]
+    if rows:
+        insert = INSERTS[connection.dialect.name](Tag.__table__)
+        connection.execute(insert.on_conflict_do_nothing(index_elements=['title']), rows)
+
+
+def tag_ids(connection, titles):
+    """ id of each title, creating missing tags """
+    insert_tags(connection, titles)
+    return dict(connection.execute(select(Tag.title, Tag.id).where(Tag.title.in_(titles))).all())
+
+
+def tags_by_title(titles):
+    """ Tag instances for normalized titles in the given order, creating missing tags """
+    titles = [title for title in dict.fromkeys(map(normalize_title, titles)) if title]
+    if not titles:
+        return []
+    insert_tags(db.session.connection(), titles)
+    tags = {tag.title: tag for tag in Tag.query.filter(Tag.title.in_(titles))}
+    return [tags[title] for title in titles]
+
+
+def tagged_record_ids(title):
+    """ select of the ids of records with a note tagged title """
+    return select(Note.records_id) \
+        .join(note_tags, note_tags.c.notes_id == Note.id) \
+        .join(Tag, Tag.id == note_tags.c.tags_id) \
+        .where(Tag.title == normalize_title(title))
+
+
+def tagged_count_statement(title):
+    """ select of the number of records with a note tagged title """
+    return select(func.count(func.distinct(Note.records_id))) \
+        .join(note_tags, note_tags.c.notes_id == Note.id) \
+        .join(Tag, Tag.id == note_tags.c.tags_id) \
+        .join(Record, Record.id == Note.records_id) \
+        .where(Tag.title == normalize_title(title), Record.deleted_at.is_(None))
+
+
+def tag_counts(limit=None):
+    """ (title, contacts) of tags in use, most used first """
+    contacts = func.count(func.distinct(Note.records_id))
+    statement = select(Tag.title, contacts.label('contacts')) \
+        .join(note_tags, note_tags.c.tags_id == Tag.id) \
+        .join(Note, Note.id == note_tags.c.notes_id) \
+        .join(Record, Record.id == Note.records_id) \
+        .where(Record.deleted_at.is_(None)) \
+        .group_by(Tag.id).order_by(contacts.desc(), Tag.title)
+    if limit:
+        statement = statement.limit(limit)
+    return db.session.execute(statement).all()
+
+
+def complete_tags(prefix, limit=10):
+    """ titles of tags in use starting with prefix, seeked on the title index """
+    prefix = normalize_title(prefix)
+    statement = select(Tag.title).where(exists().where(note_tags.c.tags_id == Tag.id))
+    if prefix:
+        statement = statement.where(Tag.title >= prefix, Tag.title < prefix + '\U0010ffff')
+    return db.session.execute(statement.order_by(Tag.title).limit(limit)).scalars().all()
+
+
+def rename_tag(tag, title):
+    """ rename a tag on every note, merging it into an existing tag of that title """
+    title = normalize_title(title)
+    other = Tag.query.filter(Tag.title == title, Tag.id != tag.id).first()
+    if other is None:
+        tag.title = title
+        return tag
+    for note in tag.notes:
+        if other not in note.tags:
+            note.tags.append(other)
+    db.session.delete(tag)
+    return other
+
+
+def retag_note(note, tag, title):
+    """ replace tag by the tag titled title on one note """
+    if tag in note.tags:
+        note.tags.remove(tag)
+    for new in tags_by_title([title]):
+        if new not in note.tags:
+            note.tags.append(new)
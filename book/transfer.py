@@ -0,0 +1,360 @@
+""" transfer.py """
+import csv
+import io
+import json
+from datetime import date, datetime
+from sqlalchemy import func, insert, select
+from wtforms.validators import ValidationError
+from book import db
+from book.forms import check_phone, unique_numbers
+from book.models import Record, Phone, Email, Address, Note, Tag, note_tags, \
+    name_key, normalize_number
+from book.cache import cache, TABLES
+from book.changes import lock_change_log, log_records
+from book.conditional import bump_versions
+from book.listing import forget_record_count
+from book.search import reindex
+from book.snapshots import refresh_snapshots
+from book.tags import normalize_title, tag_ids
+from book.upcoming import refresh_records
+
+
+FORMATS = ('csv', 'json', 'vcard')
+EXTENSIONS = {'.csv': 'csv', '.json': 'json', '.jsonl': 'json', '.ndjson': 'json',
+              '.vcf': 'vcard', '.vcard': 'vcard'}
+FIELDS = ('name', 'birthday', 'phones', 'emails', 'addresses', 'notes', 'tags')
+SINGULAR = {'phones': 'phone', 'emails': 'email', 'addresses': 'address', 'notes': 'note',
+            'tags': 'tag'}
+CHILDREN = (('phones', Phone.records_id, Phone.number),
+            ('emails', Email.records_id, Email.title),
+            ('addresses', Address.records_id, Address.title),
+            ('notes', Note.records_id, Note.title))
+CHUNK = 500
+MAX_ERRORS = 100
+
+
+def guess_format(filename):
+    """ transfer format from a file extension """
+    for extension, fmt in EXTENSIONS.items():
+        if filename and filename.lower().endswith(extension):
+            return fmt
+    return None
+
+
+def _values(value, field):
+    """ list of stripped non-empty strings from a list or a ';' separated string """
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = value.split(';')
+    if not isinstance(value, list) or \
+            not all(isinstance(item, (str, int)) for item in value if item is not None):
+        raise ValidationError('{} must be a list of strings.'.format(field))
+    return [str(item).strip() for item in value if item is not None and str(item).strip()]
+
+
+def _contact(fields):
+    """ contact dict from a mapping using either plural or RecordForm field names """
+    # raw values, validate_contact checks them so a bad row is rejected on its own
+    contact = {'name': fields.get('name'), 'birthday': fields.get('birthday')}
+    for plural, singular in SINGULAR.items():
+        contact[plural] = (fields.get(plural), fields.get(singular))
+    return contact
+
+
+def parse_csv(stream):
+    """ contacts from a CSV stream with a header row """
+    for fields in csv.DictReader(stream):
+        yield _contact(fields)
+
+
+def parse_json(stream):
+    """ contacts from a JSON lines stream, one object per line """
+    for line in stream:
+        line = line.strip()
+        if line:
+            value = json.loads(line)
+            # anything but an object is left to validate_contact to reject as its row
+            yield _contact(value) if isinstance(value, dict) else value
+
+
+def _vcard_unescape(value):
+    """ undo vCard text escaping """
+    return value.replace('\\n', '\n').replace('\\N', '\n').replace('\\,', ',') \
+        .replace('\\;', ';').replace('\\\\', '\\')
+
+
+def _vcard_lines(stream):
+    """ unfolded vCard content lines """
+    current = None
+    for line in stream:
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t') and current is not None:
+            current += line[1:]
+            continue
+        if current is not None:
+            yield current
+        current = line
+    if current is not None:
+        yield current
+
+
+def parse_vcard(stream):
+    """ contacts from a vCard stream """
+    fields = None
+    for line in _vcard_lines(stream):
+        prop, _, value = line.partition(':')
+        prop = prop.split(';')[0].split('.')[-1].upper()
+        if prop == 'BEGIN':
+            fields = {plural: [] for plural in FIELDS[2:]}
+        elif prop == 'END' and fields is not None:
+            yield _contact(fields)
+            fields = None
+        elif fields is None:
+            continue
+        elif prop == 'FN':
+            fields['name'] = _vcard_unescape(value)
+        elif prop == 'BDAY':
+            fields['birthday'] = value
+        elif prop == 'TEL':
+            fields['phones'].append(''.join(char for char in value if char.isdigit()))
+        elif prop == 'EMAIL':
+            fields['emails'].append(value)
+        elif prop == 'ADR':
+            parts = [_vcard_unescape(part).strip() for part in value.split(';')]
+            fields['addresses'].append(', '.join(part for part in parts if part))
+        elif prop == 'NOTE':
+            fields['notes'].append(_vcard_unescape(value))
+        elif prop == 'CATEGORIES':
+            fields['tags'].extend(_vcard_unescape(tag) for tag in value.split(','))
+
+
+PARSERS = {'csv': parse_csv, 'json': parse_json, 'vcard': parse_vcard}
+
+
+def parse_birthday(value):
+    """ date from ISO or basic vCard form """
+    if not value:
+        return None
+    if isinstance(value, date):
+        return value
+    if not isinstance(value, str):
+        raise ValidationError('Invalid birthday {}.'.format(value))
+    for pattern in ('%Y-%m-%d', '%Y%m%d'):
+        try:
+            return datetime.strptime(value.strip(), pattern).date()
+        except ValueError:
+            pass
+    raise ValidationError('Invalid birthday {}.'.format(value))
+
+
+def validate_contact(contact):
+    """ normalized contact following the RecordForm rules """
+    if not isinstance(contact, dict):
+        raise ValidationError('Contact must be an object.')
+    if contact['name'] is not None and not isinstance(contact['name'], str):
+        raise ValidationError('Name must be a string.')
+    if not (contact['name'] or '').strip():
+        raise ValidationError('Name is required.')
+    contact['name'] = contact['name'].strip().capitalize()
+    contact['birthday'] = parse_birthday(contact['birthday'])
+    for plural, singular in SINGULAR.items():
+        values, more = contact[plural]
+        contact[plural] = _values(values, plural) + _values(more, singular)
+    for number in contact['phones']:
+        check_phone(number)
+    contact['phones'] = unique_numbers(contact['phones'])
+    return contact
+
+
+class ImportResult():
+    """ counts of an import and the first MAX_ERRORS rejected rows """
+
+    def __init__(self):
+        self.imported = 0
+        self.rejected = 0
+        self.errors = []
+
+    def reject(self, row, message):
+        """ record a rejected row """
+        self.rejected += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append({'row': row, 'error': message})
+
+    def as_dict(self):
+        """ JSON friendly summary """
+        return {'imported': self.imported, 'rejected': self.rejected, 'errors': self.errors}
+
+
+def taken_names(connection, names):
+    """ lowercased names already used, matched like the unique lower(name) index """
+    rows = connection.execute(select(Record.name).where(
+        func.lower(Record.name).in_([func.lower(name) for name in names]),
+        Record.deleted_at.is_(None)))
+    return {row.name.lower() for row in rows}
+
+
+def insert_contacts(connection, contacts):
+    """ insert validated contacts with batched executemany, return their record ids """
+    connection.execute(insert(Record.__table__), [
+        {'name': contact['name'], 'birthday': contact['birthday'],
+         'name_key': name_key(contact['name'])}
+        for contact in contacts])
+    # a soft deleted record may still carry one of the names
+    ids = dict(connection.execute(select(Record.name, Record.id).where(
+        Record.name.in_([contact['name'] for contact in contacts]),
+        Record.deleted_at.is_(None))).all())
+    for model, column, key in ((Phone, 'number', 'phones'), (Email, 'title', 'emails'),
+                               (Address, 'title', 'addresses'), (Note, 'title', 'notes')):
+        rows = [{'records_id': ids[contact['name']], column: value}
+                for contact in contacts for value in contact[key]]
+        if model is Phone:
+            for row in rows:
+                row['normalized'] = normalize_number(row['number'])
+        if model is Note:
+            rows += [{'records_id': ids[contact['name']], column: ''}
+                     for contact in contacts if contact['tags'] and not contact['notes']]
+        if rows:
+            connection.execute(insert(model.__table__), rows)
+    tagged = [contact for contact in contacts if contact['tags']]
+    if tagged:
+        first_notes = dict(connection.execute(
+            select(Note.records_id, func.min(Note.id))
+            .where(Note.records_id.in_([ids[contact['name']] for contact in tagged]))
+            .group_by(Note.records_id)).all())
+        pairs = {(first_notes[ids[contact['name']]], normalize_title(tag))
+                 for contact in tagged for tag in contact['tags']}
+        titles = tag_ids(connection, sorted({title for _, title in pairs if title}))
+        connection.execute(insert(note_tags), [
+            {'notes_id': note_id, 'tags_id': titles[title]}
+            for note_id, title in sorted(pairs) if title])
+    return list(ids.values())
+
+
+def _import_chunk(chunk, result):
+    """ insert one chunk in its own transaction, rejecting rows whose names are taken """
+    with db.engine.begin() as connection:
+        lock_change_log(connection)
+        taken = taken_names(connection, [contact['name'] for _, contact in chunk])
+        accepted = []
+        for row, contact in chunk:
+            if contact['name'].lower() in taken:
+                result.reject(row, 'Please use a different name.')
+                continue
+            taken.add(contact['name'].lower())
+            accepted.append(contact)
+        if accepted:
+            record_ids = insert_contacts(connection, accepted)
+            log_records(connection, record_ids, 'insert')
+            bump_versions(connection, TABLES)
+            reindex(connection, record_ids)
+            refresh_snapshots(connection, record_ids)
+            refresh_records(connection, record_ids, date.today())
+            result.imported += len(accepted)
+    forget_record_count()
+    cache.invalidate(TABLES)
+
+
+def import_contacts(stream, fmt, chunk_size=CHUNK):
+    """ stream contacts from a text stream into the database chunk by chunk """
+    result = ImportResult()
+    chunk = []
+    try:
+        for row, contact in enumerate(PARSERS[fmt](stream), start=1):
+            try:
+                chunk.append((row, validate_contact(contact)))
+            except ValidationError as error:
+                result.reject(row, str(error))
+            if len(chunk) >= chunk_size:
+                _import_chunk(chunk, result)
+                chunk = []
+    except (ValueError, csv.Error) as error:
+        result.reject(None, 'Malformed {} input: {}'.format(fmt, error))
+    if chunk:
+        _import_chunk(chunk, result)
+    return result
+
+
+def iter_contacts(chunk_size=CHUNK):
+    """ contacts as dicts in id order, loaded one chunk at a time """
+    last = 0
+    while True:
+        records = db.session.execute(
+            select(Record.id, Record.name, Record.birthday)
+            .where(Record.id > last).order_by(Record.id).limit(chunk_size)).all()
+        if not records:
+            return
+        ids = [record.id for record in records]
+        contacts = {record.id: {'name': record.name, 'birthday': record.birthday,
+                                'phones': [], 'emails': [], 'addresses': [],
+                                'notes': [], 'tags': []} for record in records}
+        for key, parent, value in CHILDREN:
+            rows = db.session.execute(
+                select(parent, value).where(parent.in_(ids)).order_by(value.table.c.id))
+            for record_id, title in rows:
+                if title:
+                    contacts[record_id][key].append(title)
+        rows = db.session.execute(
+            select(Note.records_id, Tag.title)
+            .join(note_tags, note_tags.c.notes_id == Note.id)
+            .join(Tag, Tag.id == note_tags.c.tags_id)
+            .where(Note.records_id.in_(ids)).order_by(Note.id, Tag.id))
+        for record_id, title in rows:
+            if title:
+                contacts[record_id]['tags'].append(title)
+        yield from contacts.values()
+        last = ids[-1]
+
+
+def export_csv(contacts):
+    """ CSV lines, multi-valued fields joined with ';' """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(FIELDS)
+    for contact in contacts:
+        writer.writerow([contact['name'], contact['birthday'] or ''] +
+                        [';'.join(contact[key]) for key in FIELDS[2:]])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export_json(contacts):
+    """ JSON lines, one object per contact """
+    for contact in contacts:
+        contact['birthday'] = contact['birthday'].isoformat() if contact['birthday'] else None
+        yield json.dumps(contact, ensure_ascii=False, separators=(',', ':')) + '\n'
+
+
+def _vcard_escape(value):
+    """ vCard text escaping """
+    return value.replace('\\', '\\\\').replace(',', '\\,').replace(';', '\\;') \
+        .replace('\n', '\\n')
+
+
+def export_vcard(contacts):
+    """ vCard 3.0 entries """
+    for contact in contacts:
+        lines = ['BEGIN:VCARD', 'VERSION:3.0', 'FN:' + _vcard_escape(contact['name'] or ''),
+                 'N:' + _vcard_escape(contact['name'] or '') + ';;;;']
+        if contact['birthday']:
+            lines.append('BDAY:' + contact['birthday'].isoformat())
+        lines += ['TEL:+' + number for number in contact['phones']]
+        lines += ['EMAIL:' + email for email in contact['emails']]
+        lines += ['ADR:;;' + _vcard_escape(address) + ';;;;' for address in contact['addresses']]
+        lines += ['NOTE:' + _vcard_escape(note) for note in contact['notes']]
+        if contact['tags']:
+            lines.append('CATEGORIES:' + ','.join(_vcard_escape(tag) for tag in contact['tags']))
+        lines.append('END:VCARD')
+        yield '\r\n'.join(lines) + '\r\n'
+
+
+EXPORTERS = {'csv': (export_csv, 'text/csv', 'contacts.csv'),
+             'json': (export_json, 'application/x-ndjson', 'contacts.jsonl'),
+             'vcard': (export_vcard, 'text/vcard', 'contacts.vcf')}
+
+
+def export_contacts(fmt, chunk_size=CHUNK):
+    """ generator of text fragments for the whole address book """
+    return EXPORTERS[fmt][0](iter_contacts(chunk_size))
@@ -0,0 +1,93 @@
+""" trash.py """
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import delete, select
+from book import app, db
+from book.changes import lock_change_log, log_records
+from book.models import Record
+from book.search import DELETE_DOCUMENTS
+
+
+def undo_deadline(now):
+    """ records deleted before this moment can no longer be restored """
+    return now - timedelta(seconds=app.config['DELETE_UNDO_SECONDS'])
+
+
+def trash_records(records, now):
+    """ soft delete records, their rows stay until the purge after the undo window """
+    for record in records:
+        record.deleted_at = now
+
+
+def deleted_records(ids, now):
+    """ soft deleted records among ids that are still inside the undo window """
+    return Record.query.execution_options(include_deleted=True).filter(
+        Record.id.in_(ids), Record.deleted_at >= undo_deadline(now)).all()
+
+
+def restore_records(records):
+    """ undo a soft delete """
+    for record in records:
+        record.deleted_at = None
+
+
+def purge_deleted(now, batch):
+    """ delete records past the undo window, batch records per short transaction """
+    purged = 0
+    while True:
+        with db.engine.begin() as connection:
+            lock_change_log(connection)
+            ids = connection.execute(
+                select(Record.id).where(Record.deleted_at < undo_deadline(now))
+                .order_by(Record.deleted_at).limit(batch)).scalars().all()
+            if ids:
+                log_records(connection, ids, 'delete')
+                connection.execute(DELETE_DOCUMENTS, {'ids': ids})
+                connection.execute(delete(Record.__table__).where(Record.id.in_(ids)))
+        if not ids:
+            return purged
+        purged += len(ids)
+
+
+class Purger():
+    """ daemon thread purging soft deleted records every PURGE_INTERVAL seconds """
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def purge(self):
+        """ one purge run, errors are logged and retried on the next run """
+        try:
+            with self.app.app_context():
+                purged = purge_deleted(datetime.utcnow(), self.app.config['PURGE_BATCH'])
+            if purged:
+                self.app.logger.info('Purged %d deleted contacts', purged)
+        except Exception:
+            self.app.logger.exception('Purging deleted contacts failed')
+
+    def run(self):
+        """ purge every interval until stopped """
+        while not self.stopped.wait(self.app.config['PURGE_INTERVAL']):
+            self.purge()
+
+    def start(self):
+        """ start the thread once per process """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='purge-deleted', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """ stop the thread """
+        self.stopped.set()
+
+
+purger = Purger(app)
+
+
+@app.before_first_request
+def start_purger():
+    """ start the background purge in serving processes """
+    if app.config['SOFT_DELETE'] and app.config['PURGE_INTERVAL'] and not app.testing:
+        purger.start()
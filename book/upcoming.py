@@ -0,0 +1,214 @@
+""" upcoming.py """
+import threading
+from datetime import date, datetime, timedelta, timezone
+from sqlalchemy import Date, Integer, bindparam, case, cast, delete, event, extract, func, \
+    inspect, insert, select, update
+from book import app, db
+from book.birthdays import next_birthday
+from book.models import Record, UpcomingBirthday
+
+
+CHUNK = 500
+MAX_DAYS = 366
+UPDATE_DUE = update(UpcomingBirthday.__table__).where(
+    UpcomingBirthday.records_id == bindparam('record_id')).values(
+    next_birthday=bindparam('next_date'))
+
+
+def next_after(birthday, day):
+    """ first birthday strictly after day """
+    return next_birthday(birthday, day + timedelta(days=1))
+
+
+def next_after_clause(birthday, day):
+    """ SQL next_after for postgresql, month and day offsets put Feb 29 on Mar 1 """
+    start = day + timedelta(days=1)
+
+    def on(year):
+        return cast(func.make_date(year, 1, 1) + func.make_interval(
+            0, cast(extract('month', birthday), Integer) - 1, 0,
+            cast(extract('day', birthday), Integer) - 1), Date)
+    return case((on(start.year) >= start, on(start.year)), else_=on(start.year + 1))
+
+
+def _insert_statement(where, today):
+    """ postgresql INSERT ... SELECT of the upcoming birthdays of matching records """
+    return insert(UpcomingBirthday.__table__).from_select(
+        ['records_id', 'next_birthday'],
+        select(Record.id, next_after_clause(Record.birthday, today))
+        .where(Record.birthday.isnot(None), Record.deleted_at.is_(None), *where))
+
+
+def _insert_rows(connection, rows, today):
+    """ insert upcoming birthdays for (id, birthday) rows """
+    values = [{'records_id': record_id, 'next_birthday': next_after(birthday, today)}
+              for record_id, birthday in rows if birthday is not None]
+    if values:
+        connection.execute(insert(UpcomingBirthday.__table__), values)
+
+
+def refresh_records(connection, record_ids, today):
+    """ recompute the upcoming birthdays of the given records """
+    record_ids = sorted(record_ids)
+    for start in range(0, len(record_ids), CHUNK):
+        chunk = record_ids[start:start + CHUNK]
+        connection.execute(delete(UpcomingBirthday.__table__)
+                           .where(UpcomingBirthday.records_id.in_(chunk)))
+        if connection.dialect.name == 'postgresql':
+            connection.execute(_insert_statement([Record.id.in_(chunk)], today))
+            continue
+        _insert_rows(connection, connection.execute(
+            select(Record.id, Record.birthday)
+            .where(Record.id.in_(chunk), Record.deleted_at.is_(None))), today)
+
+
+def rebuild_upcoming(connection, today):
+    """ recompute every upcoming birthday """
+    connection.execute(delete(UpcomingBirthday.__table__))
+    if connection.dialect.name == 'postgresql':
+        connection.execute(_insert_statement([], today))
+        return
+    last = 0
+    while True:
+        rows = connection.execute(select(Record.id, Record.birthday, Record.deleted_at)
+                                  .where(Record.id > last)
+                                  .order_by(Record.id).limit(CHUNK * 20)).all()
+        if not rows:
+            return
+        _insert_rows(connection, [(row.id, row.birthday) for row in rows
+                                  if row.deleted_at is None], today)
+        last = rows[-1].id
+
+
+def refresh_due(connection, today):
+    """ move birthdays that are not after today to the next year, return how many moved """
+    if connection.dialect.name == 'postgresql':
+        return connection.execute(
+            update(UpcomingBirthday.__table__)
+            .where(UpcomingBirthday.records_id == Record.id,
+                   UpcomingBirthday.next_birthday <= today)
+            .values(next_birthday=next_after_clause(Record.birthday, today))).rowcount
+    rows = connection.execute(
+        select(Record.id, Record.birthday)
+        .join(UpcomingBirthday, UpcomingBirthday.records_id == Record.id)
+        .where(UpcomingBirthday.next_birthday <= today)).all()
+    if rows:
+        connection.execute(UPDATE_DUE, [{'record_id': record_id,
+                                         'next_date': next_after(birthday, today)}
+                                        for record_id, birthday in rows])
+    return len(rows)
+
+
+def upcoming_statement(period, today):
+    """ live records with their next birthday in the next period days, soonest first """
+    return select(Record.id, Record.name, Record.birthday, UpcomingBirthday.next_birthday) \
+        .join(UpcomingBirthday, UpcomingBirthday.records_id == Record.id) \
+        .where(Record.deleted_at.is_(None), UpcomingBirthday.next_birthday > today,
+               UpcomingBirthday.next_birthday <= today + timedelta(days=period + 1)) \
+        .order_by(UpcomingBirthday.next_birthday, Record.name, Record.id)
+
+
+def upcoming_birthdays(period, today, yield_per=None):
+    """ upcoming_statement rows, refreshing due rows first """
+    # with yield_per the rows come as a result fetching yield_per rows at a time
+    if refresh_due(db.session.connection(), today):
+        db.session.commit()
+    statement = upcoming_statement(period, today)
+    if yield_per:
+        return db.session.connection().execute(statement.execution_options(
+            stream_results=True, max_row_buffer=yield_per))
+    return db.session.connection().execute(statement).all()
+
+
+@event.listens_for(db.session, 'after_flush')
+def sync_upcoming_birthdays(session, flush_context):
+    """ recompute upcoming birthdays of added, deleted or restored records and new birthdays """
+    record_ids = {obj.id for obj in session.new if isinstance(obj, Record)}
+    record_ids |= {obj.id for obj in session.dirty if isinstance(obj, Record)
+                   and (inspect(obj).attrs.birthday.history.has_changes() or
+                        inspect(obj).attrs.deleted_at.history.has_changes())}
+    if record_ids:
+        refresh_records(session.connection(), record_ids, date.today())
+
+
+def _ics_escape(value):
+    """ iCalendar text escaping """
+    return value.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,') \
+        .replace('\n', '\\n')
+
+
+def feed_items(rows, today):
+    """ JSON friendly upcoming birthdays """
+    return [{'id': row.id, 'name': row.name, 'birthday': row.birthday.isoformat(),
+             'date': row.next_birthday.isoformat(), 'days': (row.next_birthday - today).days}
+            for row in rows]
+
+
+def calendar(items):
+    """ iCalendar document with an all-day event per feed item """
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//contacts//upcoming birthdays//EN',
+             'CALSCALE:GREGORIAN', 'X-WR-CALNAME:Birthdays']
+    for item in items:
+        next_date = date.fromisoformat(item['date'])
+        lines += ['BEGIN:VEVENT',
+                  'UID:birthday-{}-{:%Y%m%d}@contacts'.format(item['id'], next_date),
+                  'DTSTAMP:' + stamp,
+                  'DTSTART;VALUE=DATE:{:%Y%m%d}'.format(next_date),
+                  'DTEND;VALUE=DATE:{:%Y%m%d}'.format(next_date + timedelta(days=1)),
+                  'SUMMARY:' + _ics_escape('{} birthday'.format(item['name'])),
+                  'TRANSP:TRANSPARENT',
+                  'END:VEVENT']
+    lines.append('END:VCALENDAR')
+    return '\r\n'.join(lines) + '\r\n'
+
+
+def seconds_until_midnight(now):
+    """ seconds from now to the next local midnight """
+    tomorrow = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+    return (tomorrow - now).total_seconds()
+
+
+class Scheduler():
+    """ daemon thread refreshing due upcoming birthdays once a day, just after midnight """
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def refresh(self):
+        """ one refresh run, errors are logged and retried the next day """
+        try:
+            with self.app.app_context(), db.engine.begin() as connection:
+                moved = refresh_due(connection, date.today())
+            self.app.logger.info('Refreshed %d upcoming birthdays', moved)
+        except Exception:
+            self.app.logger.exception('Upcoming birthdays refresh failed')
+
+    def run(self):
+        """ refresh now, then after every midnight until stopped """
+        while not self.stopped.is_set():
+            self.refresh()
+            self.stopped.wait(seconds_until_midnight(datetime.now()) + 1)
+
+    def start(self):
+        """ start the thread once per process """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='upcoming-birthdays',
+                                           daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """ stop the thread """
+        self.stopped.set()
+
+
+scheduler = Scheduler(app)
+
+
+@app.before_first_request
+def start_scheduler():
+    """ start the daily refresh in serving processes """
+    if app.config['UPCOMING_SCHEDULER'] and not app.testing:
+        scheduler.start()
@@ -1,5 +1,10 @@
 #!/bin/bash
 source venv/bin/activate
+if [[ "${WEB_CONCURRENCY:-1}" -gt 1 && "${CACHE_BACKEND:-lru}" == "lru" ]]; then
+    # the lru cache lives in each worker, edits in one would not invalidate the others
+    echo "WEB_CONCURRENCY=${WEB_CONCURRENCY} needs CACHE_BACKEND=redis or null" >&2
+    exit 1
+fi
 while true; do
     flask db upgrade
     if [[ "$?" == "0" ]]; then
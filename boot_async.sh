@@ -0,0 +1,16 @@
+#!/bin/bash
+source venv/bin/activate
+if [[ "${WEB_CONCURRENCY:-1}" -gt 1 && "${CACHE_BACKEND:-lru}" == "lru" ]]; then
+    # the lru cache lives in each worker, edits in one would not invalidate the others
+    echo "WEB_CONCURRENCY=${WEB_CONCURRENCY} needs CACHE_BACKEND=redis or null" >&2
+    exit 1
+fi
+while true; do
+    flask db upgrade
+    if [[ "$?" == "0" ]]; then
+        break
+    fi
+    echo Deploy command failed, retrying in 5 secs...
+    sleep 5
+done
+exec uvicorn --host 0.0.0.0 --port 5000 --workers ${WEB_CONCURRENCY:-1} book.asgi:application
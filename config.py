@@ -1,11 +1,87 @@
 """ config.py """
 import os
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool, StaticPool
 basedir = os.path.abspath(os.path.dirname(__file__))
 
 
+def database_url(url):
+    """ DATABASE_URL with the postgres:// scheme of hosted databases spelled for SQLAlchemy """
+    if url and url.startswith('postgres://'):
+        return 'postgresql://' + url[len('postgres://'):]
+    return url
+
+
+def memory_database(url):
+    """ whether url is an in-memory SQLite database, private to each connection """
+    url = make_url(url)
+    return url.get_backend_name() == 'sqlite' and \
+        (url.database in (None, '', ':memory:') or url.query.get('mode') == 'memory')
+
+
+def engine_options(url):
+    """ pool settings, with connect arguments and liveness checks for the database of url """
+    if memory_database(url):
+        # every pooled connection would open its own empty database, share the one
+        return {'poolclass': StaticPool, 'connect_args': {'check_same_thread': False}}
+    options = {
+        'poolclass': QueuePool,
+        'pool_size': int(os.environ.get('DATABASE_POOL_SIZE') or 5),
+        'max_overflow': int(os.environ.get('DATABASE_MAX_OVERFLOW') or 10),
+        'pool_timeout': int(os.environ.get('DATABASE_POOL_TIMEOUT') or 30),
+    }
+    if url.startswith('sqlite'):
+        options['connect_args'] = {'check_same_thread': False}
+    else:
+        options['pool_pre_ping'] = os.environ.get('DATABASE_POOL_PRE_PING', '1') != '0'
+        options['pool_recycle'] = int(os.environ.get('DATABASE_POOL_RECYCLE') or 1800)
+    return options
+
+
 class Config():
     """ config """
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
-    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
+    SQLALCHEMY_DATABASE_URI = database_url(os.environ.get('DATABASE_URL')) or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
+    ASYNC_DATABASE_URL = os.environ.get('ASYNC_DATABASE_URL')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    WTF_CSRF_ENABLED = os.environ.get('WTF_CSRF_ENABLED', '1') != '0'
+    RECORDS_PER_PAGE = 8
+    MAX_PER_PAGE = int(os.environ.get('MAX_PER_PAGE') or 1000)
+    STREAM_RESULTS = os.environ.get('STREAM_RESULTS', '0') != '0'
+    STREAM_YIELD_PER = int(os.environ.get('STREAM_YIELD_PER') or 100)
+    PAGINATION = os.environ.get('PAGINATION') or 'keyset'
+    PAGINATION_COUNT_TTL = int(os.environ.get('PAGINATION_COUNT_TTL') or 60)
+    LISTING_SNAPSHOTS = os.environ.get('LISTING_SNAPSHOTS', '0') != '0'
+    API_PAGE_SIZE = int(os.environ.get('API_PAGE_SIZE') or 100)
+    API_BATCH_LIMIT = int(os.environ.get('API_BATCH_LIMIT') or 1000)
+    PHONE_COUNTRY_CODE = os.environ.get('PHONE_COUNTRY_CODE') or '380'
+    PHONE_LOOKUP_LIMIT = int(os.environ.get('PHONE_LOOKUP_LIMIT') or 5000)
+    CACHE_BACKEND = os.environ.get('CACHE_BACKEND') or 'lru'
+    CACHE_URL = os.environ.get('CACHE_URL')
+    CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES') or 1024)
+    CACHE_TTL = int(os.environ.get('CACHE_TTL') or 300)
+    RELEASE = os.environ.get('RELEASE') or ''
+    COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE') or 1024)
+    COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL') or 6)
+    UPCOMING_SCHEDULER = os.environ.get('UPCOMING_SCHEDULER', '1') != '0'
+    SOFT_DELETE = os.environ.get('SOFT_DELETE', '1') != '0'
+    DELETE_UNDO_SECONDS = int(os.environ.get('DELETE_UNDO_SECONDS') or 600)
+    PURGE_INTERVAL = int(os.environ.get('PURGE_INTERVAL') or 60)
+    PURGE_BATCH = int(os.environ.get('PURGE_BATCH') or 200)
+    GROUP_COMMIT = os.environ.get('GROUP_COMMIT', '0') != '0'
+    GROUP_COMMIT_WINDOW_MS = float(os.environ.get('GROUP_COMMIT_WINDOW_MS') or 2)
+    GROUP_COMMIT_MAX_BATCH = int(os.environ.get('GROUP_COMMIT_MAX_BATCH') or 64)
+    CHANGES_RETENTION_DAYS = int(os.environ.get('CHANGES_RETENTION_DAYS') or 30)
+    SERVER_TIMING = os.environ.get('SERVER_TIMING', '1') != '0'
+    METRICS_ENDPOINT = os.environ.get('METRICS_ENDPOINT', '0') != '0'
+    SLOW_QUERY_MS = float(os.environ['SLOW_QUERY_MS']) if os.environ.get('SLOW_QUERY_MS') \
+        else None
+    SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT') or 5000)
+    SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE') or 'WAL'
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS') or 'NORMAL'
+    SQLITE_CACHE_SIZE = int(os.environ.get('SQLITE_CACHE_SIZE') or -16000)
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE') or 256 * 1024 * 1024)
+    POSTGRES_STATEMENT_TIMEOUT = int(os.environ.get('POSTGRES_STATEMENT_TIMEOUT') or 30000)
+    POSTGRES_LOCK_TIMEOUT = int(os.environ.get('POSTGRES_LOCK_TIMEOUT') or 5000)
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI)
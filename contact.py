@@ -1,8 +1,129 @@
 """ contact.py """
+from datetime import date, datetime, timedelta
+import json
+import click
 from book import app, db
+from book.changes import prune_changes
+from book.duplicates import MAX_BLOCK, find_duplicates, merge_records
+from book.models import Record
+from book.search import rebuild
+from book.snapshots import rebuild_snapshots, stale_snapshots
+from book.upcoming import rebuild_upcoming
+from book.trash import purge_deleted
+from book.transfer import FORMATS, CHUNK, export_contacts, guess_format, import_contacts
 
 
 @app.shell_context_processor
 def make_shell_context():
     """ make shell context """
     return {'db': db}
+
+
+@app.cli.command('reindex')
+def reindex_command():
+    """ rebuild the contact search index """
+    with db.engine.begin() as connection:
+        rebuild(connection)
+
+
+@app.cli.command('upcoming')
+def upcoming_command():
+    """ recompute the upcoming birthdays calendar """
+    with db.engine.begin() as connection:
+        rebuild_upcoming(connection, date.today())
+
+
+@app.cli.command('snapshots')
+@click.option('--check', is_flag=True, help='only list contacts whose snapshot is stale')
+def snapshots_command(check):
+    """ rebuild the listing snapshots, or check them against the child rows """
+    if not check:
+        with db.engine.begin() as connection:
+            rebuild_snapshots(connection)
+        return
+    with db.engine.connect() as connection:
+        stale = stale_snapshots(connection)
+    for record_id in stale:
+        click.echo(f'contact {record_id}: stale snapshot', err=True)
+    click.echo(f'{len(stale)} stale snapshots.')
+    if stale:
+        raise click.exceptions.Exit(1)
+
+
+@app.cli.command('purge')
+@click.option('--batch', default=None, type=int, help='contacts deleted per transaction')
+def purge_command(batch):
+    """ delete soft deleted contacts past the undo window """
+    purged = purge_deleted(datetime.utcnow(), batch or app.config['PURGE_BATCH'])
+    click.echo(f'Purged {purged} contacts.')
+
+
+@app.cli.command('prune-changes')
+@click.option('--days', default=None, type=int, help='days of changes kept for syncing')
+@click.option('--batch', default=1000, show_default=True, help='changes deleted per transaction')
+def prune_changes_command(days, batch):
+    """ delete sync changes older than the retention period """
+    days = app.config['CHANGES_RETENTION_DAYS'] if days is None else days
+    pruned = prune_changes(datetime.utcnow() - timedelta(days=days), batch)
+    click.echo(f'Pruned {pruned} changes.')
+
+
+@app.cli.group()
+def contacts():
+    """ bulk contact import and export """
+
+
+@contacts.command('import')
+@click.argument('source', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS),
+              help='input format, guessed from the file extension by default')
+@click.option('--chunk-size', default=CHUNK, show_default=True,
+              help='contacts inserted per transaction')
+def import_command(source, fmt, chunk_size):
+    """ import contacts from a CSV, JSON lines or vCard file """
+    fmt = fmt or guess_format(source.name)
+    if fmt is None:
+        raise click.UsageError('Cannot guess the format, pass --format.')
+    result = import_contacts(source, fmt, chunk_size)
+    click.echo(f'Imported {result.imported} contacts, rejected {result.rejected}.')
+    for error in result.errors:
+        click.echo(f'row {error["row"]}: {error["error"]}', err=True)
+
+
+@contacts.command('export')
+@click.argument('target', type=click.File('w', encoding='utf-8'), default='-')
+@click.option('--format', 'fmt', type=click.Choice(FORMATS),
+              help='output format, guessed from the file extension by default')
+def export_command(target, fmt):
+    """ export all contacts to a CSV, JSON lines or vCard file """
+    fmt = fmt or guess_format(target.name) or 'csv'
+    for fragment in export_contacts(fmt):
+        target.write(fragment)
+
+
+@contacts.command('duplicates')
+@click.argument('target', type=click.File('w', encoding='utf-8'), default='-')
+@click.option('--limit', type=int, help='only the best scored suggestions')
+def duplicates_command(target, limit):
+    """ write merge suggestions as JSON lines, best scored first """
+    with db.engine.connect() as connection:
+        suggestions, skipped = find_duplicates(connection, limit)
+    for suggestion in suggestions:
+        target.write(json.dumps(suggestion) + '\n')
+    if skipped:
+        click.echo(f'Skipped {skipped} blocks of more than {MAX_BLOCK} contacts.', err=True)
+
+
+@contacts.command('merge')
+@click.argument('record_id', type=int)
+@click.argument('ids', type=int, nargs=-1, required=True)
+def merge_command(record_id, ids):
+    """ merge the contacts IDS into RECORD_ID """
+    records = {record.id: record for record in
+               Record.query.filter(Record.id.in_((record_id,) + ids))}
+    missing = [item for item in (record_id,) + ids if item not in records]
+    if missing:
+        raise click.UsageError(f'Contact {missing[0]} not found.')
+    merge_records(records[record_id], [records[item] for item in dict.fromkeys(ids)])
+    db.session.commit()
+    click.echo(f'Merged {len(ids)} contacts into {records[record_id].name}.')
@@ -0,0 +1,62 @@
+"""upcoming birthdays
+
+Revision ID: 0d4905f712fd
+Revises: 43f1e1b99560
+Create Date: 2026-10-18 13:20:44.318530
+
+"""
+from datetime import date
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0d4905f712fd'
+down_revision = '43f1e1b99560'
+branch_labels = None
+depends_on = None
+
+
+records = sa.table('records',
+    sa.column('id', sa.Integer),
+    sa.column('birthday', sa.Date)
+)
+upcoming_birthdays = sa.table('upcoming_birthdays',
+    sa.column('records_id', sa.Integer),
+    sa.column('next_birthday', sa.Date)
+)
+
+
+def next_after(birthday, day):
+    year = day.year
+    while True:
+        try:
+            candidate = date(year, birthday.month, birthday.day)
+        except ValueError:
+            candidate = date(year, 3, 1)
+        if candidate > day:
+            return candidate
+        year += 1
+
+
+def upgrade():
+    op.create_table('upcoming_birthdays',
+    sa.Column('records_id', sa.Integer(), nullable=False),
+    sa.Column('next_birthday', sa.Date(), nullable=True),
+    sa.ForeignKeyConstraint(['records_id'], ['records.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('records_id')
+    )
+    op.create_index(op.f('ix_upcoming_birthdays_next_birthday'), 'upcoming_birthdays',
+                    ['next_birthday'], unique=False)
+    today = date.today()
+    rows = op.get_bind().execute(
+        sa.select(records.c.id, records.c.birthday).where(records.c.birthday.isnot(None)))
+    values = [{'records_id': row.id, 'next_birthday': next_after(row.birthday, today)}
+              for row in rows]
+    if values:
+        op.bulk_insert(upcoming_birthdays, values)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_upcoming_birthdays_next_birthday'), table_name='upcoming_birthdays')
+    op.drop_table('upcoming_birthdays')
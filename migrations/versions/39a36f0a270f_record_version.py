@@ -0,0 +1,25 @@
+"""record version
+
+Revision ID: 39a36f0a270f
+Revises: 83cdd591ae17
+Create Date: 2026-10-18 17:31:44.580116
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '39a36f0a270f'
+down_revision = '83cdd591ae17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('records', sa.Column('version', sa.Integer(), server_default='1',
+                                       nullable=False))
+
+
+def downgrade():
+    op.drop_column('records', 'version')
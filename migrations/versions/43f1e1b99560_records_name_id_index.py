@@ -0,0 +1,26 @@
+"""records name id index
+
+Revision ID: 43f1e1b99560
+Revises: 8e19d326b656
+Create Date: 2026-10-18 12:31:05.114062
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '43f1e1b99560'
+down_revision = '8e19d326b656'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_records_name_id', 'records', ['name', 'id'], unique=False)
+    op.drop_index('ix_records_name', table_name='records')
+
+
+def downgrade():
+    op.create_index('ix_records_name', 'records', ['name'], unique=False)
+    op.drop_index('ix_records_name_id', table_name='records')
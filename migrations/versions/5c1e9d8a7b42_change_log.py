@@ -0,0 +1,33 @@
+"""change log
+
+Revision ID: 5c1e9d8a7b42
+Revises: 39a36f0a270f
+Create Date: 2026-10-18 18:12:07.315904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1e9d8a7b42'
+down_revision = '39a36f0a270f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('changes',
+    sa.Column('seq', sa.Integer(), nullable=False),
+    sa.Column('table_name', sa.String(), nullable=False),
+    sa.Column('row_id', sa.Integer(), nullable=False),
+    sa.Column('records_id', sa.Integer(), nullable=True),
+    sa.Column('operation', sa.String(), nullable=False),
+    sa.Column('changed_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('seq'),
+    sqlite_autoincrement=True
+    )
+
+
+def downgrade():
+    op.drop_table('changes')
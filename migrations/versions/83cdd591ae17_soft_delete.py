@@ -0,0 +1,37 @@
+"""soft delete
+
+Revision ID: 83cdd591ae17
+Revises: 907272fc2742
+Create Date: 2026-10-18 16:48:09.271553
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '83cdd591ae17'
+down_revision = '907272fc2742'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('records', sa.Column('deleted_at', sa.DateTime(), nullable=True))
+    op.create_index(op.f('ix_records_deleted_at'), 'records', ['deleted_at'], unique=False)
+    op.drop_index('uq_records_name_lower', table_name='records')
+    op.create_index('uq_records_name_lower', 'records', [sa.text('lower(name)')], unique=True,
+                    sqlite_where=sa.text('deleted_at IS NULL'),
+                    postgresql_where=sa.text('deleted_at IS NULL'))
+
+
+def downgrade():
+    # soft deleted records may share a name with a live one, they go before the full
+    # unique index comes back
+    op.execute("DELETE FROM contact_search WHERE rowid IN "
+               "(SELECT id FROM records WHERE deleted_at IS NOT NULL)")
+    op.execute("DELETE FROM records WHERE deleted_at IS NOT NULL")
+    op.drop_index('uq_records_name_lower', table_name='records')
+    op.create_index('uq_records_name_lower', 'records', [sa.text('lower(name)')], unique=True)
+    op.drop_index(op.f('ix_records_deleted_at'), table_name='records')
+    op.drop_column('records', 'deleted_at')
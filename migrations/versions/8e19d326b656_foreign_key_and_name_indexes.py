@@ -0,0 +1,56 @@
+"""foreign key and name indexes
+
+Revision ID: 8e19d326b656
+Revises: cf3c42a8908b
+Create Date: 2026-10-18 11:40:52.731934
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e19d326b656'
+down_revision = 'cf3c42a8908b'
+branch_labels = None
+depends_on = None
+
+
+records = sa.table('records',
+    sa.column('id', sa.Integer),
+    sa.column('name', sa.String)
+)
+
+FOREIGN_KEYS = [
+    ('phones', 'records_id'),
+    ('emails', 'records_id'),
+    ('addresses', 'records_id'),
+    ('notes', 'records_id'),
+    ('tags', 'notes_id'),
+]
+
+
+def rename_duplicate_names():
+    """ suffix case-insensitive duplicate names with the record id """
+    bind = op.get_bind()
+    first = sa.select(sa.func.min(records.c.id)).group_by(sa.func.lower(records.c.name))
+    duplicates = bind.execute(sa.select(records).where(
+        records.c.name.isnot(None), records.c.id.notin_(first))).fetchall()
+    for record in duplicates:
+        bind.execute(records.update().where(records.c.id == record.id).values(
+            name='{} ({})'.format(record.name, record.id)))
+
+
+def upgrade():
+    for table, column in FOREIGN_KEYS:
+        op.create_index(op.f('ix_{}_{}'.format(table, column)), table, [column], unique=False)
+    op.create_index(op.f('ix_records_name'), 'records', ['name'], unique=False)
+    rename_duplicate_names()
+    op.create_index('uq_records_name_lower', 'records', [sa.text('lower(name)')], unique=True)
+
+
+def downgrade():
+    op.drop_index('uq_records_name_lower', table_name='records')
+    op.drop_index(op.f('ix_records_name'), table_name='records')
+    for table, column in reversed(FOREIGN_KEYS):
+        op.drop_index(op.f('ix_{}_{}'.format(table, column)), table_name=table)
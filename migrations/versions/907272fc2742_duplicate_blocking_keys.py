@@ -0,0 +1,74 @@
+"""duplicate blocking keys
+
+Revision ID: 907272fc2742
+Revises: fb3cefdfaf1a
+Create Date: 2026-10-18 16:02:51.904417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '907272fc2742'
+down_revision = 'fb3cefdfaf1a'
+branch_labels = None
+depends_on = None
+
+
+records = sa.table('records',
+    sa.column('id', sa.Integer),
+    sa.column('name', sa.String),
+    sa.column('name_key', sa.String)
+)
+
+CHUNK = 1000
+SOUNDEX = {char: code for code, chars in (('1', 'BFPV'), ('2', 'CGJKQSXZ'), ('3', 'DT'),
+                                         ('4', 'L'), ('5', 'MN'), ('6', 'R'))
+           for char in chars}
+
+
+def name_key(name):
+    # frozen copy of book.models.name_key at this revision
+    letters = [char for char in (name or '').upper() if char.isalpha()]
+    if not letters:
+        return None
+    if not 'A' <= letters[0] <= 'Z':
+        return ''.join(letters).lower()
+    key, last = letters[0], SOUNDEX.get(letters[0])
+    for char in letters[1:]:
+        code = SOUNDEX.get(char)
+        if code and code != last:
+            key += code
+            if len(key) == 4:
+                break
+        if char not in 'HW':
+            last = code
+    return key.ljust(4, '0')
+
+
+def upgrade():
+    op.add_column('records', sa.Column('name_key', sa.String(), nullable=True))
+    connection = op.get_bind()
+    last_id = 0
+    while True:
+        rows = connection.execute(sa.select(records.c.id, records.c.name)
+                                  .where(records.c.id > last_id)
+                                  .order_by(records.c.id).limit(CHUNK)).all()
+        if not rows:
+            break
+        connection.execute(records.update().where(records.c.id == sa.bindparam('record_id'))
+                           .values(name_key=sa.bindparam('value')),
+                           [{'record_id': row.id, 'value': name_key(row.name)} for row in rows])
+        last_id = rows[-1].id
+    op.create_index(op.f('ix_records_name_key'), 'records', ['name_key'], unique=False)
+    op.create_index('ix_emails_title_lower', 'emails', [sa.text('lower(title)'), 'records_id'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_emails_title_lower', table_name='emails')
+    op.drop_index(op.f('ix_records_name_key'), table_name='records')
+    # a batch rebuild of records would cascade into every child table and lose the
+    # expression index, the column is unindexed by now so a plain drop is enough
+    op.drop_column('records', 'name_key')
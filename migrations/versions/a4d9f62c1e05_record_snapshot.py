@@ -0,0 +1,67 @@
+"""record snapshot
+
+Revision ID: a4d9f62c1e05
+Revises: e27b4c90d6a3
+Create Date: 2026-10-18 19:47:26.103958
+
+"""
+import json
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4d9f62c1e05'
+down_revision = 'e27b4c90d6a3'
+branch_labels = None
+depends_on = None
+
+
+records = sa.table('records',
+    sa.column('id', sa.Integer),
+    sa.column('snapshot', sa.Text)
+)
+children = {name: sa.table(name,
+    sa.column('id', sa.Integer),
+    sa.column('records_id', sa.Integer),
+    sa.column(column, sa.String)
+) for name, column in (('phones', 'number'), ('emails', 'title'), ('addresses', 'title'),
+                       ('notes', 'title'))}
+tags = sa.table('tags',
+    sa.column('id', sa.Integer),
+    sa.column('title', sa.String)
+)
+note_tags = sa.table('note_tags',
+    sa.column('notes_id', sa.Integer),
+    sa.column('tags_id', sa.Integer)
+)
+
+
+def upgrade():
+    op.add_column('records', sa.Column('snapshot', sa.Text(), nullable=True))
+    connection = op.get_bind()
+    parts = {row.id: {'phones': [], 'emails': [], 'addresses': [], 'notes': []}
+             for row in connection.execute(sa.select(records.c.id))}
+    notes = {}
+    for name, table in children.items():
+        for row in connection.execute(sa.select(table).where(table.c.records_id.isnot(None))
+                                      .order_by(table.c.id)):
+            child = [row.id, row[2]] if name != 'notes' else [row.id, row[2], []]
+            parts[row.records_id][name].append(child)
+            if name == 'notes':
+                notes[row.id] = child
+    for row in connection.execute(
+            sa.select(note_tags.c.notes_id, tags.c.id, tags.c.title)
+            .join(tags, tags.c.id == note_tags.c.tags_id).order_by(tags.c.id)):
+        if row.notes_id in notes:
+            notes[row.notes_id][2].append([row.id, row.title])
+    if parts:
+        connection.execute(
+            records.update().where(records.c.id == sa.bindparam('record_id'))
+            .values(snapshot=sa.bindparam('value')),
+            [{'record_id': record_id, 'value': json.dumps(part, separators=(',', ':'))}
+             for record_id, part in parts.items()])
+
+
+def downgrade():
+    op.drop_column('records', 'snapshot')
@@ -0,0 +1,67 @@
+"""note tags
+
+Revision ID: a85f2def0157
+Revises: 0d4905f712fd
+Create Date: 2026-10-18 14:05:12.640271
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a85f2def0157'
+down_revision = '0d4905f712fd'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # tags is rebuilt by batch mode below, and with foreign keys on dropping it
+    # would cascade into note_tags, so the links are parked in a plain table first
+    op.execute("UPDATE tags SET title = trim(title)")
+    op.execute("DELETE FROM tags WHERE title IS NULL OR title = ''")
+    op.execute("""
+        CREATE TABLE tag_links AS
+        SELECT DISTINCT tags.notes_id AS notes_id, kept.id AS tags_id FROM tags
+        JOIN (SELECT title, min(id) AS id FROM tags GROUP BY title) AS kept
+            ON kept.title = tags.title
+        WHERE tags.notes_id IN (SELECT id FROM notes)
+    """)
+    op.execute("DELETE FROM tags WHERE id NOT IN (SELECT min(id) FROM tags GROUP BY title)")
+    op.drop_index(op.f('ix_tags_notes_id'), table_name='tags')
+    with op.batch_alter_table('tags') as batch_op:
+        batch_op.drop_column('notes_id')
+        batch_op.create_index(batch_op.f('ix_tags_title'), ['title'], unique=True)
+    op.create_table('note_tags',
+    sa.Column('notes_id', sa.Integer(), nullable=False),
+    sa.Column('tags_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['notes_id'], ['notes.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['tags_id'], ['tags.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('notes_id', 'tags_id')
+    )
+    op.create_index(op.f('ix_note_tags_tags_id'), 'note_tags', ['tags_id'], unique=False)
+    op.execute("INSERT INTO note_tags (notes_id, tags_id) SELECT notes_id, tags_id FROM tag_links")
+    op.drop_table('tag_links')
+
+
+def downgrade():
+    op.execute("""
+        CREATE TABLE tag_links AS
+        SELECT note_tags.notes_id AS notes_id, tags.title AS title FROM note_tags
+        JOIN tags ON tags.id = note_tags.tags_id
+    """)
+    op.drop_index(op.f('ix_note_tags_tags_id'), table_name='note_tags')
+    op.drop_table('note_tags')
+    op.execute("DELETE FROM tags")
+    with op.batch_alter_table('tags') as batch_op:
+        batch_op.drop_index(batch_op.f('ix_tags_title'))
+        batch_op.add_column(sa.Column('notes_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('fk_tags_notes_id_notes', 'notes', ['notes_id'], ['id'],
+                                    ondelete='CASCADE')
+    op.execute("""
+        INSERT INTO tags (title, notes_id)
+        SELECT title, notes_id FROM tag_links ORDER BY notes_id, title
+    """)
+    op.drop_table('tag_links')
+    op.create_index(op.f('ix_tags_notes_id'), 'tags', ['notes_id'], unique=False)
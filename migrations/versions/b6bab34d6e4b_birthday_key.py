@@ -0,0 +1,36 @@
+"""birthday key
+
+Revision ID: b6bab34d6e4b
+Revises: 113caf282114
+Create Date: 2026-10-18 10:12:41.503117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6bab34d6e4b'
+down_revision = '113caf282114'
+branch_labels = None
+depends_on = None
+
+
+records = sa.table('records',
+    sa.column('birthday', sa.Date),
+    sa.column('birthday_key', sa.Integer)
+)
+
+
+def upgrade():
+    op.add_column('records', sa.Column('birthday_key', sa.Integer(), nullable=True))
+    op.create_index(op.f('ix_records_birthday_key'), 'records', ['birthday_key'], unique=False)
+    op.execute(records.update().values(
+        birthday_key=sa.extract('month', records.c.birthday) * 100 +
+        sa.extract('day', records.c.birthday)))
+
+
+def downgrade():
+    op.drop_index(op.f('ix_records_birthday_key'), table_name='records')
+    # a batch rebuild of records would cascade into every child table
+    op.drop_column('records', 'birthday_key')
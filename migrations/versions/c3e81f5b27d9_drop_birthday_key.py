@@ -0,0 +1,36 @@
+"""drop birthday key
+
+Revision ID: c3e81f5b27d9
+Revises: a4d9f62c1e05
+Create Date: 2026-10-18 16:05:12.384206
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3e81f5b27d9'
+down_revision = 'a4d9f62c1e05'
+branch_labels = None
+depends_on = None
+
+
+records = sa.table('records',
+    sa.column('birthday', sa.Date),
+    sa.column('birthday_key', sa.Integer)
+)
+
+
+def upgrade():
+    op.drop_index(op.f('ix_records_birthday_key'), table_name='records')
+    # a batch rebuild of records would cascade into every child table
+    op.drop_column('records', 'birthday_key')
+
+
+def downgrade():
+    op.add_column('records', sa.Column('birthday_key', sa.Integer(), nullable=True))
+    op.create_index(op.f('ix_records_birthday_key'), 'records', ['birthday_key'], unique=False)
+    op.execute(records.update().values(
+        birthday_key=sa.extract('month', records.c.birthday) * 100 +
+        sa.extract('day', records.c.birthday)))
@@ -0,0 +1,68 @@
+"""contact search
+
+Revision ID: cf3c42a8908b
+Revises: b6bab34d6e4b
+Create Date: 2026-10-18 11:02:17.288410
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'cf3c42a8908b'
+down_revision = 'b6bab34d6e4b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        upgrade_postgresql()
+    if dialect != 'sqlite':
+        return
+    op.execute("CREATE VIRTUAL TABLE contact_search USING fts5("
+               "name, phones, emails, addresses, notes, tags, prefix='2 3')")
+    op.execute("INSERT INTO contact_search(contact_search, rank) "
+               "VALUES ('rank', 'bm25(10.0, 5.0, 5.0, 2.0, 1.0, 2.0)')")
+    op.execute("""
+        INSERT INTO contact_search(rowid, name, phones, emails, addresses, notes, tags)
+        SELECT records.id, records.name,
+            (SELECT group_concat(number, ' ') FROM phones WHERE records_id = records.id),
+            (SELECT group_concat(title, ' ') FROM emails WHERE records_id = records.id),
+            (SELECT group_concat(title, ' ') FROM addresses WHERE records_id = records.id),
+            (SELECT group_concat(title, ' ') FROM notes WHERE records_id = records.id),
+            (SELECT group_concat(tags.title, ' ') FROM tags
+                JOIN notes ON notes.id = tags.notes_id WHERE notes.records_id = records.id)
+        FROM records
+    """)
+
+
+def upgrade_postgresql():
+    op.execute("CREATE TABLE contact_search ("
+               "rowid INTEGER PRIMARY KEY, document TSVECTOR NOT NULL)")
+    op.execute("CREATE INDEX ix_contact_search_document ON contact_search USING gin (document)")
+    op.execute("""
+        INSERT INTO contact_search(rowid, document)
+        SELECT records.id,
+            setweight(to_tsvector('simple', coalesce(records.name, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce((SELECT string_agg(number, ' ')
+                FROM phones WHERE records_id = records.id), '')), 'B') ||
+            setweight(to_tsvector('simple', coalesce((SELECT string_agg(title, ' ')
+                FROM emails WHERE records_id = records.id), '')), 'B') ||
+            setweight(to_tsvector('simple', coalesce((SELECT string_agg(title, ' ')
+                FROM addresses WHERE records_id = records.id), '')), 'C') ||
+            setweight(to_tsvector('simple', coalesce((SELECT string_agg(title, ' ')
+                FROM notes WHERE records_id = records.id), '')), 'D') ||
+            setweight(to_tsvector('simple', coalesce((SELECT string_agg(tags.title, ' ')
+                FROM tags JOIN notes ON notes.id = tags.notes_id
+                WHERE notes.records_id = records.id), '')), 'C')
+        FROM records
+    """)
+
+
+def downgrade():
+    if op.get_bind().dialect.name not in ('sqlite', 'postgresql'):
+        return
+    op.execute("DROP TABLE contact_search")
@@ -0,0 +1,34 @@
+"""collection versions
+
+Revision ID: e27b4c90d6a3
+Revises: 5c1e9d8a7b42
+Create Date: 2026-10-18 19:03:51.842176
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e27b4c90d6a3'
+down_revision = '5c1e9d8a7b42'
+branch_labels = None
+depends_on = None
+
+TABLES = ('records', 'phones', 'emails', 'addresses', 'notes', 'tags', 'note_tags')
+
+
+def upgrade():
+    collection_versions = op.create_table('collection_versions',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('changed_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(collection_versions, [{'name': name, 'version': 0,
+                                          'changed_at': datetime.utcnow()} for name in TABLES])
+
+
+def downgrade():
+    op.drop_table('collection_versions')
@@ -0,0 +1,71 @@
+"""phone normalized
+
+Revision ID: fb3cefdfaf1a
+Revises: a85f2def0157
+Create Date: 2026-10-18 15:20:37.118402
+
+"""
+from alembic import op
+from flask import current_app
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'fb3cefdfaf1a'
+down_revision = 'a85f2def0157'
+branch_labels = None
+depends_on = None
+
+
+phones = sa.table('phones',
+    sa.column('id', sa.Integer),
+    sa.column('number', sa.String),
+    sa.column('normalized', sa.String)
+)
+
+CHUNK = 1000
+
+
+def normalize(number, country_code):
+    # frozen copy of book.models.normalize_number at this revision
+    digits = ''.join(char for char in number or '' if char.isdigit())
+    if not digits:
+        return None
+    if (number or '').lstrip().startswith('+'):
+        return '+' + digits
+    if digits.startswith('00'):
+        return '+' + digits[2:]
+    if digits.startswith('0'):
+        return '+' + country_code + digits[1:]
+    return '+' + digits
+
+
+def upgrade():
+    op.add_column('phones', sa.Column('normalized', sa.String(), nullable=True))
+    connection = op.get_bind()
+    country_code = current_app.config['PHONE_COUNTRY_CODE']
+    last_id = 0
+    while True:
+        rows = connection.execute(sa.select(phones.c.id, phones.c.number)
+                                  .where(phones.c.id > last_id)
+                                  .order_by(phones.c.id).limit(CHUNK)).all()
+        if not rows:
+            break
+        connection.execute(phones.update().where(phones.c.id == sa.bindparam('phone_id'))
+                           .values(normalized=sa.bindparam('value')),
+                           [{'phone_id': row.id, 'value': normalize(row.number, country_code)}
+                            for row in rows])
+        last_id = rows[-1].id
+    op.execute("""
+        DELETE FROM phones WHERE normalized IS NOT NULL AND id NOT IN (
+            SELECT min(id) FROM phones WHERE normalized IS NOT NULL
+            GROUP BY normalized, records_id)
+    """)
+    op.create_index('uq_phones_normalized_records_id', 'phones', ['normalized', 'records_id'],
+                    unique=True)
+
+
+def downgrade():
+    op.drop_index('uq_phones_normalized_records_id', table_name='phones')
+    with op.batch_alter_table('phones') as batch_op:
+        batch_op.drop_column('normalized')
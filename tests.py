@@ -1,13 +1,79 @@
 """ tests.py """
+import asyncio
+import gzip
+import importlib.util
+import io
+import json
 import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
 import unittest
-from datetime import datetime
+from datetime import date, datetime, timedelta
 from book import app, db
-from book.models import Record, Phone, Email, Address, Note
-from config import basedir
+from book.models import Record, Phone, Email, Address, Note, Tag, UpcomingBirthday, Change, \
+    CollectionVersion
+from book.changes import prune_changes
+from book.birthdays import next_birthday
+from book.upcoming import refresh_due, next_after, upcoming_birthdays
+from book.cache import cache, LRUCache
+from book.instrumentation import metrics
+from book.trash import purge_deleted
+from book.batching import committer
+from book.editing import update_row, tag_note
+from book.duplicates import MAX_BLOCK
+from book.snapshots import stale_snapshots
+from book.reads import ContactRow, contact_statement, contact_rows
+from config import basedir, engine_options
+from contact import snapshots_command
 
 
 TEST_DB = 'test.db'
+TEST_DATABASE_URL = 'sqlite:///' + os.path.join(basedir, TEST_DB)
+POSTGRES_DIR = None
+
+
+def start_postgres():
+    """ throwaway postgres cluster from the initdb on PG_BIN or PATH, None without one """
+    initdb = shutil.which('initdb', path=os.environ.get('PG_BIN'))
+    if initdb is None or importlib.util.find_spec('psycopg2') is None:
+        return None
+    directory = tempfile.mkdtemp(prefix='contacts-pg-')
+    data = os.path.join(directory, 'data')
+    pg_ctl = os.path.join(os.path.dirname(initdb), 'pg_ctl')
+    try:
+        subprocess.run([initdb, '-D', data, '-A', 'trust', '-U', 'postgres', '-E', 'UTF8',
+                        '--no-sync'], check=True, capture_output=True)
+        subprocess.run([pg_ctl, '-D', data, '-w', '-l', os.path.join(directory, 'log'),
+                        '-o', "-F -c listen_addresses='' -k {}".format(directory), 'start'],
+                       check=True, capture_output=True)
+    except (OSError, subprocess.CalledProcessError):
+        shutil.rmtree(directory, ignore_errors=True)
+        return None
+    return directory
+
+
+def setUpModule():
+    """ run against TEST_DATABASE_URL, else a temporary postgres, else SQLite """
+    global TEST_DATABASE_URL, POSTGRES_DIR
+    if os.environ.get('TEST_DATABASE_URL'):
+        TEST_DATABASE_URL = os.environ['TEST_DATABASE_URL']
+        return
+    POSTGRES_DIR = start_postgres()
+    if POSTGRES_DIR:
+        TEST_DATABASE_URL = 'postgresql://postgres@/postgres?host=' + POSTGRES_DIR
+
+
+def tearDownModule():
+    """ stop the temporary postgres """
+    if POSTGRES_DIR:
+        db.get_engine().dispose()
+        subprocess.run([shutil.which('pg_ctl', path=os.environ.get('PG_BIN')), '-D',
+                        os.path.join(POSTGRES_DIR, 'data'), '-m', 'immediate', 'stop'],
+                       capture_output=True)
+        shutil.rmtree(POSTGRES_DIR, ignore_errors=True)
 
 
 def add_record():
@@ -35,15 +101,18 @@ class BasicTests(unittest.TestCase):
         app.config['TESTING'] = True
         app.config['WTF_CSRF_ENABLED'] = False
         app.config['DEBUG'] = False
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + \
-            os.path.join(basedir, 'test.db')
+        app.config['RECORDS_PER_PAGE'] = 8
+        app.config['PAGINATION'] = 'keyset'
+        app.config['SQLALCHEMY_DATABASE_URI'] = TEST_DATABASE_URL
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(TEST_DATABASE_URL)
         self.app = app.test_client()
         db.drop_all()
         db.create_all()
+        cache.clear()
         self.assertEqual(app.debug, False)
 
     def tearDown(self):
-        pass
+        db.session.remove()
 
     def test_home_page(self):
         """ test home page """
@@ -57,6 +126,54 @@ class BasicTests(unittest.TestCase):
         self.assertIn(b'st. Test 123', response.data)
         self.assertIn(b'test note', response.data)
 
+    def test_home_page_query_count(self):
+        """ test home page query count does not grow with page size """
+        add_record()
+        response = self.app.get('/', follow_redirects=True)
+        queries = response.headers['X-Query-Count']
+        many = Tag(title='many')
+        for i in range(10):
+            db.session.add(Record(name=f'Many{i}', phones=[Phone(number='380686543401')],
+                                  emails=[Email(title='many@test.ua')],
+                                  addresses=[Address(title='st. Many 1')],
+                                  notes=[Note(title='many note', tags=[many])]))
+        db.session.commit()
+        response = self.app.get('/', follow_redirects=True)
+        self.assertIn(b'many note', response.data)
+        self.assertEqual(response.headers['X-Query-Count'], queries)
+
+    def test_home_page_keyset(self):
+        """ test home page cursor pagination """
+        app.config['RECORDS_PER_PAGE'] = 3
+        for name in ('Delta', 'Alpha', 'Echo', 'Charlie', 'Bravo'):
+            db.session.add(Record(name=name))
+        db.session.commit()
+        response = self.app.get('/', follow_redirects=True)
+        self.assertIn(b'5 contacts', response.data)
+        self.assertIn(b'Charlie', response.data)
+        self.assertNotIn(b'Delta', response.data)
+        after = re.search(r'after=([^"&]+)', response.data.decode()).group(1)
+        response = self.app.get('/index?after=' + after, follow_redirects=True)
+        self.assertIn(b'Delta', response.data)
+        self.assertIn(b'Echo', response.data)
+        self.assertNotIn(b'Charlie', response.data)
+        before = re.search(r'before=([^"&]+)', response.data.decode()).group(1)
+        response = self.app.get('/index?before=' + before, follow_redirects=True)
+        self.assertIn(b'Alpha', response.data)
+        self.assertIn(b'Charlie', response.data)
+        self.assertNotIn(b'Delta', response.data)
+        response = self.app.get('/index?after=broken', follow_redirects=True)
+        self.assertEqual(response.status_code, 400)
+
+    def test_home_page_offset(self):
+        """ test home page offset pagination """
+        app.config['PAGINATION'] = 'offset'
+        app.config['RECORDS_PER_PAGE'] = 1
+        add_record()
+        response = self.app.get('/index?page=2', follow_redirects=True)
+        self.assertIn(b'Test1', response.data)
+        self.assertIn(b'/index?page=1', response.data)
+
     def test_search_page(self):
         """ test search page """
         response = self.app.get('/search', follow_redirects=True)
@@ -83,6 +200,45 @@ class BasicTests(unittest.TestCase):
                                    data={'contact': ''}, follow_redirects=True)
         self.assertIn(b'Enter the name of contact', response.data)
 
+    def test_search_partial(self):
+        """ test search by name prefix, phone prefix and email """
+        add_record()
+        response = self.app.get('/search?q=tes', follow_redirects=True)
+        self.assertIn(b'st. Test1 123', response.data)
+        self.assertIn(b'st. Test 123', response.data)
+        response = self.app.get('/search?q=38068654340', follow_redirects=True)
+        self.assertIn(b'st. Test1 123', response.data)
+        self.assertNotIn(b'st. Test 123', response.data)
+        response = self.app.get('/search?q=test1@test.ua', follow_redirects=True)
+        self.assertIn(b'st. Test1 123', response.data)
+        self.assertNotIn(b'st. Test 123', response.data)
+
+    def test_search_index_sync(self):
+        """ test search index follows edits, tags and deletes """
+        add_record()
+        self.app.post('/add_tag/1', buffered=True, content_type='multipart/form-data',
+                      data={'title': 'Colleague'})
+        response = self.app.get('/search?q=colleague', follow_redirects=True)
+        self.assertIn(b'st. Test 123', response.data)
+        self.app.post('/edit_address/2', buffered=True, content_type='multipart/form-data',
+                      data={'title': 'Baker street'})
+        response = self.app.get('/search?q=baker', follow_redirects=True)
+        self.assertIn(b'Test1', response.data)
+        self.app.post('/delete_record/2', buffered=True, content_type='multipart/form-data')
+        response = self.app.get('/search?q=baker', follow_redirects=True)
+        self.assertNotIn(b'Test1', response.data)
+
+    def test_search_pagination(self):
+        """ test search results are paginated """
+        app.config['RECORDS_PER_PAGE'] = 2
+        add_record()
+        db.session.add(Record(name='Test2', addresses=[Address(title='st. Test2 123')]))
+        db.session.commit()
+        response = self.app.get('/search?q=test', follow_redirects=True)
+        self.assertEqual(response.data.count(b'st. Test'), 2)
+        response = self.app.get('/search?q=test&page=2', follow_redirects=True)
+        self.assertEqual(response.data.count(b'st. Test'), 1)
+
     def test_add_record_page(self):
         """ test add record page """
         response = self.app.get('/add_record', follow_redirects=True)
@@ -138,6 +294,17 @@ class BasicTests(unittest.TestCase):
                                          'note': 'test note'}, follow_redirects=True)
         self.assertIn(b'Please use a different name.', response.data)
 
+    def test_record_add_exist_name_other_case(self):
+        """ test record add with exist name in other case """
+        add_record()
+        response = self.app.post('/add_record', buffered=True,
+                                 content_type='multipart/form-data',
+                                 data={'name': 'tEST1',
+                                       'birthday': '2022-06-29',
+                                       'phone': '380686543423',
+                                       'email': 'test@test.ua'}, follow_redirects=True)
+        self.assertIn(b'Please use a different name.', response.data)
+
     def test_edit_record_page(self):
         """ test edit record page """
         add_record()
@@ -151,11 +318,41 @@ class BasicTests(unittest.TestCase):
         add_record()
         response = self.app.post('/edit_record/1', buffered=True,
                                    content_type='multipart/form-data',
-                                   data={'name': 'Test1',
+                                   data={'name': 'Test2',
                                          'birthday': '2022-06-28',
                                          }, follow_redirects=True)
         self.assertIn(b'Your changes have been saved.', response.data)
 
+    def test_edit_record_missing(self):
+        """ test edit pages of missing rows or rows of a deleted record answer 404 """
+        add_record()
+        self.assertEqual(self.app.get('/edit_record/9').status_code, 404)
+        self.app.post('/delete_record/2')
+        self.assertEqual(self.app.get('/edit_record/2').status_code, 404)
+        for url in ('/edit_phone/9', '/edit_email/9', '/edit_address/9', '/edit_note/9',
+                    '/add_tag/9', '/edit_tag/9', '/delete_record/9',
+                    '/edit_phone/2', '/edit_email/2', '/edit_address/2', '/edit_note/2',
+                    '/add_tag/2', '/delete_record/2'):
+            self.assertEqual(self.app.get(url).status_code, 404, url)
+            self.assertEqual(self.app.post(url, data={'title': 'x'}).status_code, 404, url)
+        self.assertEqual(self.app.get('/edit_phone/1').status_code, 200)
+
+    def test_edit_record_exist_name(self):
+        """ test edit record with name of another record """
+        add_record()
+        response = self.app.post('/edit_record/1', buffered=True,
+                                 content_type='multipart/form-data',
+                                 data={'name': 'test1',
+                                       'birthday': '2022-06-28',
+                                       }, follow_redirects=True)
+        self.assertIn(b'Please use a different name.', response.data)
+        response = self.app.post('/edit_record/1', buffered=True,
+                                 content_type='multipart/form-data',
+                                 data={'name': 'TEST',
+                                       'birthday': '2022-06-28',
+                                       }, follow_redirects=True)
+        self.assertIn(b'Your changes have been saved.', response.data)
+
     def test_edit_phone_page(self):
         """ test edit phone page """
         add_record()
@@ -234,6 +431,7 @@ class BasicTests(unittest.TestCase):
 
     def test_add_tag_page(self):
         """ test add tag page """
+        add_record()
         response = self.app.get('/add_tag/1', follow_redirects=True)
         self.assertEqual(response.status_code, 200)
         self.assertIn(b'Add', response.data)
@@ -270,6 +468,171 @@ class BasicTests(unittest.TestCase):
                                  data={'title': 'test note1'}, follow_redirects=True)
         self.assertIn(b'Your changes have been saved.', response.data)
 
+    def test_tag_dedupe_and_filter(self):
+        """ test one tag row per title and the tag filtered listing """
+        add_record()
+        self.app.post('/add_tag/1', data={'title': 'work'})
+        self.app.post('/add_tag/2', data={'title': ' work '})
+        self.app.post('/add_tag/2', data={'title': 'home'})
+        self.assertEqual(Tag.query.filter_by(title='work').count(), 1)
+        self.assertEqual(len(Note.query.get(2).tags), 2)
+        response = self.app.get('/index?tag=home')
+        self.assertIn(b'st. Test1 123', response.data)
+        self.assertNotIn(b'st. Test 123', response.data)
+        self.assertIn(b'1 contacts', response.data)
+        response = self.app.get('/tags')
+        self.assertEqual(json.loads(response.data)['items'],
+                         [{'title': 'work', 'contacts': 2}, {'title': 'home', 'contacts': 1}])
+        response = self.app.get('/tags/complete?q=wo')
+        self.assertEqual(json.loads(response.data)['items'], ['work'])
+
+    def test_edit_tag_scope(self):
+        """ test edit tag renames everywhere, or only on the note given by ?note= """
+        add_record()
+        self.app.post('/add_tag/1', data={'title': 'work'})
+        self.app.post('/add_tag/2', data={'title': 'work'})
+        self.app.post('/edit_tag/1?note=2', data={'title': 'club'})
+        self.assertEqual([tag.title for tag in Note.query.get(1).tags], ['work'])
+        self.assertEqual([tag.title for tag in Note.query.get(2).tags], ['club'])
+        self.app.post('/edit_tag/1', data={'title': 'club'})
+        self.assertEqual([tag.title for tag in Tag.query.all()], ['club'])
+        self.assertEqual([tag.title for tag in Note.query.get(1).tags], ['club'])
+
+    def test_edit_contact(self):
+        """ test the combined edit updates record and child rows in one save """
+        add_record()
+        response = self.app.get('/contact/1')
+        self.assertIn(b'value="380686543423"', response.data)
+        response = self.app.post('/contact/1', data={
+            'version': '1', 'name': 'Renamed', 'birthday': '1990-01-02',
+            'phones-0-ref': '1', 'phones-0-value': '380686543499',
+            'phones-1-ref': '', 'phones-1-value': '380686543498',
+            'emails-0-ref': '1', 'emails-0-value': '',
+            'addresses-0-ref': '1', 'addresses-0-value': 'st. New 1',
+            'notes-0-ref': '1', 'notes-0-value': 'test note', 'notes-0-tags': 'work, home'},
+            follow_redirects=True)
+        self.assertIn(b'Your changes have been saved.', response.data)
+        self.assertIn(b'Edit contact', response.data)
+        record = Record.query.get(1)
+        self.assertEqual(record.version, 2)
+        self.assertEqual([phone.number for phone in record.phones],
+                         ['380686543499', '380686543498'])
+        self.assertEqual(record.emails, [])
+        self.assertEqual([tag.title for tag in record.notes[0].tags], ['work', 'home'])
+        response = self.app.post('/contact/1', data={'version': '1', 'name': 'Stale'})
+        self.assertEqual(response.status_code, 409)
+        self.assertIn(b'Someone else changed this contact', response.data)
+        self.assertIn(b'value="Renamed"', response.data)
+        response = self.app.post('/contact/1', data={
+            'version': '2', 'name': 'Renamed', 'phones-0-value': '380686543499',
+            'phones-1-value': '380686543499'})
+        self.assertIn(b'The contact already has this number.', response.data)
+
+    def test_contact_child_version(self):
+        """ test adding or removing only child rows moves the record version """
+        add_record()
+        data = {'name': 'Test', 'birthday': '2022-06-29',
+                'phones-0-ref': '1', 'phones-0-value': '380686543423',
+                'emails-0-ref': '1', 'emails-0-value': 'test@test.ua',
+                'addresses-0-ref': '1', 'addresses-0-value': 'st. Test 123',
+                'notes-0-ref': '1', 'notes-0-value': 'test note'}
+        response = self.app.post('/contact/1', data=dict(
+            data, version='1', **{'phones-1-ref': '', 'phones-1-value': '380686543498'}))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Record.query.get(1).version, 2)
+        response = self.app.post('/contact/1', data=dict(data, version='2',
+                                                         **{'emails-0-value': ''}))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Record.query.get(1).version, 3)
+        response = self.app.post('/contact/1', data=dict(data, version='2'))
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(len(Record.query.get(1).phones), 2)
+
+    def test_contact_move_phones(self):
+        """ test numbers moved between or swapped across phone rows are saved """
+        add_record()
+        data = {'name': 'Test', 'birthday': '2022-06-29'}
+        response = self.app.post('/contact/1', data=dict(data, **{
+            'version': '1', 'phones-0-ref': '1', 'phones-0-value': '',
+            'phones-1-ref': '', 'phones-1-value': '380686543423'}))
+        self.assertEqual(response.status_code, 302)
+        response = self.app.post('/contact/1', data=dict(data, **{
+            'version': '1', 'phones-0-ref': '1', 'phones-0-value': '380686543423',
+            'phones-1-ref': '', 'phones-1-value': '380686543477'}))
+        self.assertEqual(response.status_code, 302)
+        version = Record.query.get(1).version
+        response = self.app.post('/contact/1', data=dict(data, **{
+            'version': str(version), 'phones-0-ref': '1', 'phones-0-value': '380686543477',
+            'phones-1-ref': '3', 'phones-1-value': '380686543423'}))
+        self.assertEqual(response.status_code, 302)
+        db.session.remove()
+        self.assertEqual(sorted(phone.number for phone in Record.query.get(1).phones),
+                         ['380686543423', '380686543477'])
+
+    def test_record_version(self):
+        """ test child edits move the record version and stale api updates are refused """
+        add_record()
+        self.app.post('/edit_phone/1', data={'number': '380686543411'})
+        response = self.app.get('/api/v1/contacts/1')
+        self.assertEqual(response.headers['ETag'], '"2"')
+        response = self.app.patch('/api/v1/contacts/1', json={'name': 'late'},
+                                  headers={'If-Match': '"1"'})
+        self.assertEqual(response.status_code, 412)
+        response = self.app.patch('/api/v1/contacts/1', json={'name': 'fresh'},
+                                  headers={'If-Match': '"2"'})
+        self.assertEqual(response.headers['ETag'], '"3"')
+        response = self.app.post('/api/v1/contacts/batch', json={
+            'update': [{'id': 1, 'version': 2, 'name': 'stale'}]})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Record.query.get(1).name, 'Fresh')
+
+    def test_group_commit(self):
+        """ test queued edits share a commit and a failing edit leaves the others applied """
+        add_record()
+        app.config['GROUP_COMMIT'] = True
+        app.config['GROUP_COMMIT_WINDOW_MS'] = 200
+        try:
+            response = self.app.post('/edit_phone/1', data={'number': '380686543411'},
+                                     follow_redirects=True)
+            self.assertIn(b'Your changes have been saved.', response.data)
+            response = self.app.post('/contact/1', data={'version': '1', 'name': 'Stale'})
+            self.assertEqual(response.status_code, 409)
+            commits = committer.commits
+            statuses = []
+
+            def save(name):
+                response = app.test_client().post('/contact/1', data={'version': '2',
+                                                                      'name': name})
+                statuses.append(response.status_code)
+
+            threads = [threading.Thread(target=save, args=(name,))
+                       for name in ('Usera', 'Userb')]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(sorted(statuses), [302, 409])
+            self.assertEqual(committer.commits, commits + 1)
+            futures = [committer.submit(update_row, Note, 1, {'title': 'note {}'.format(i)})
+                       for i in range(5)]
+            for future in futures:
+                future.result()
+            self.assertEqual(committer.commits, commits + 2)
+            failing = committer.submit(tag_note, 99, 'work')
+            applied = committer.submit(tag_note, 1, 'work')
+            with self.assertRaises(AttributeError):
+                failing.result()
+            applied.result()
+            self.assertEqual(committer.commits, commits + 3)
+        finally:
+            app.config['GROUP_COMMIT'] = False
+        db.session.remove()
+        self.assertEqual(Phone.query.get(1).number, '380686543411')
+        self.assertEqual(Note.query.get(1).title, 'note 4')
+        self.assertEqual([tag.title for tag in Note.query.get(1).tags], ['work'])
+        self.assertIn(Record.query.get(1).name, ('Usera', 'Userb'))
+        self.assertEqual(stale_snapshots(db.session.connection()), [])
+
     def test_delete_record_page(self):
         """ test delete record page """
         add_record()
@@ -285,6 +648,45 @@ class BasicTests(unittest.TestCase):
                                  follow_redirects=True)
         self.assertIn(b'Your delete contact: Test', response.data)
 
+    def test_delete_record_undo(self):
+        """ test soft delete hides the contact until undo, purge removes it for good """
+        add_record()
+        response = self.app.post('/delete_record/2', follow_redirects=True)
+        self.assertIn(b'/restore_record/2', response.data)
+        self.assertNotIn(b'st. Test1 123', response.data)
+        self.assertIn(b'1 contacts', response.data)
+        response = self.app.get('/search?q=test1', follow_redirects=True)
+        self.assertNotIn(b'st. Test1 123', response.data)
+        self.app.post('/add_record', data={'name': 'test1', 'phone': '380686543400',
+                                           'email': 'x@x.ua', 'birthday': '1990-01-01'})
+        response = self.app.post('/restore_record/2', follow_redirects=True)
+        self.assertIn(b'Another contact is already named Test1.', response.data)
+        self.app.post('/delete_record/3')
+        response = self.app.post('/restore_record/2', follow_redirects=True)
+        self.assertIn(b'Your restore contact: Test1', response.data)
+        self.assertIn(b'st. Test1 123', response.data)
+        self.assertEqual(purge_deleted(datetime.utcnow(), 1), 0)
+        app.config['DELETE_UNDO_SECONDS'] = -1
+        try:
+            self.assertEqual(purge_deleted(datetime.utcnow(), 1), 1)
+        finally:
+            app.config['DELETE_UNDO_SECONDS'] = 600
+        self.assertIsNone(Record.query.execution_options(include_deleted=True).get(3))
+        self.assertEqual(Phone.query.filter_by(records_id=3).count(), 0)
+
+    def test_api_bulk_delete(self):
+        """ test bulk delete and restore through the api """
+        add_record()
+        response = self.app.post('/api/v1/contacts/delete', json={'ids': [1, 2]})
+        self.assertEqual(json.loads(response.data)['deleted'], [1, 2])
+        self.assertEqual(json.loads(self.app.get('/api/v1/contacts').data)['items'], [])
+        response = self.app.post('/api/v1/contacts/delete', json={'ids': [1]})
+        self.assertEqual(response.status_code, 422)
+        response = self.app.post('/api/v1/contacts/restore', json={'ids': [2, 9]})
+        self.assertEqual(json.loads(response.data), {'restored': [2]})
+        response = self.app.get('/api/v1/contacts?fields=name')
+        self.assertEqual(json.loads(response.data)['items'], [{'id': 2, 'name': 'Test1'}])
+
     def test_holidays_period_page(self):
         """ test holidays period page """
         response = self.app.get('/holidays_period', follow_redirects=True)
@@ -332,6 +734,646 @@ class BasicTests(unittest.TestCase):
                                  data={'period': '380'}, follow_redirects=True)
         self.assertIn(b'Period cannot be more than 365', response.data)
 
+    def test_holidays_period_sorted(self):
+        """ test holidays period sorted by days remaining """
+        today = date.today()
+        for name, days in (('Later', 5), ('Sooner', 2), ('Outside', 30)):
+            birthday = (today + timedelta(days=days)).replace(year=1990)
+            db.session.add(Record(name=name, birthday=birthday))
+        db.session.commit()
+        response = self.app.post('/holidays_period', buffered=True,
+                                 content_type='multipart/form-data',
+                                 data={'period': '10'}, follow_redirects=True)
+        self.assertIn(b'| 2 days left till next birthday', response.data)
+        self.assertIn(b'| 5 days left till next birthday', response.data)
+        self.assertNotIn(b'Outside', response.data)
+        self.assertLess(response.data.index(b'Sooner'), response.data.index(b'Later'))
+
+    def test_next_birthday_leap_day(self):
+        """ test Feb 29 birthday falls on Mar 1 in common years """
+        self.assertEqual(next_birthday(date(2000, 2, 29), date(2023, 2, 27)), date(2023, 3, 1))
+        self.assertEqual(next_birthday(date(2000, 2, 29), date(2024, 2, 27)), date(2024, 2, 29))
+        self.assertEqual(next_birthday(date(2000, 2, 29), date(2023, 3, 2)), date(2024, 2, 29))
+
+    def test_upcoming_birthdays_refresh(self):
+        """ test precomputed birthdays follow edits and move on once they pass """
+        add_record()
+        record = Record.query.get(1)
+        record.birthday = date(1990, 2, 28)
+        db.session.commit()
+        self.assertEqual(UpcomingBirthday.query.get(1).next_birthday,
+                         next_after(date(1990, 2, 28), date.today()))
+        UpcomingBirthday.query.update({'next_birthday': date(2023, 2, 28)})
+        db.session.commit()
+        with db.engine.begin() as connection:
+            self.assertEqual(refresh_due(connection, date(2023, 2, 28)), 2)
+        db.session.expire_all()
+        self.assertEqual(UpcomingBirthday.query.get(1).next_birthday, date(2024, 2, 28))
+        self.assertEqual(UpcomingBirthday.query.get(2).next_birthday, date(2023, 4, 10))
+        db.session.delete(Record.query.get(2))
+        db.session.commit()
+        self.assertIsNone(UpcomingBirthday.query.get(2))
+
+    def test_upcoming_feed(self):
+        """ test upcoming birthdays JSON and iCalendar feeds, Feb 29 on Mar 1 """
+        today = date.today()
+        soon = (today + timedelta(days=3)).replace(year=1990)
+        db.session.add(Record(name='Soon', birthday=soon))
+        db.session.add(Record(name='Leap', birthday=date(2000, 2, 29)))
+        db.session.commit()
+        response = self.app.get('/upcoming.json?days=366')
+        items = json.loads(response.data)['items']
+        self.assertEqual(items[0]['name'], 'Soon')
+        self.assertEqual(items[0]['days'], 3)
+        leap = next(item for item in items if item['name'] == 'Leap')
+        self.assertIn(leap['date'][5:], ('02-29', '03-01'))
+        self.assertEqual(leap['days'], (next_birthday(date(2000, 2, 29), today) - today).days)
+        response = self.app.get('/upcoming.ics?days=5')
+        self.assertEqual(response.mimetype, 'text/calendar')
+        self.assertIn(b'SUMMARY:Soon birthday', response.data)
+        self.assertIn('DTSTART;VALUE=DATE:{:%Y%m%d}'.format(today + timedelta(days=3)).encode(),
+                      response.data)
+        self.assertNotIn(b'Leap', response.data)
+        self.assertEqual(self.app.get('/upcoming.xml').status_code, 404)
+
+    def test_import_csv(self):
+        """ test csv import validates rows like the add record form """
+        add_record()
+        data = ('name,birthday,phone,email,address,note,tags\n'
+                'alice,1990-01-02,380111111111;380111111112,a@x.ua,st. A 1,hello,friend;work\n'
+                'bob,,12345,b@x.ua,,,\n'
+                'test,,380111111113,,,,\n')
+        response = self.app.post('/import', content_type='multipart/form-data',
+                                 data={'file': (io.BytesIO(data.encode()), 'contacts.csv')})
+        result = json.loads(response.data)
+        self.assertEqual(result['imported'], 1)
+        self.assertEqual(result['rejected'], 2)
+        self.assertEqual(result['errors'][0],
+                         {'row': 2, 'error': 'Invalid phone number(at least 12 digits).'})
+        self.assertEqual(result['errors'][1], {'row': 3, 'error': 'Please use a different name.'})
+        response = self.app.get('/search?q=friend', follow_redirects=True)
+        self.assertIn(b'380111111112', response.data)
+        self.assertIn(b'st. A 1', response.data)
+
+    def test_import_json(self):
+        """ test json lines import rejects lines that are not objects or have mistyped fields """
+        data = ('{"name": "alice", "phones": ["380111111111"]}\n[1, 2]\n"x"\n'
+                '{"name": 5}\n{"name": "bob", "birthday": 19900101}\n'
+                '{"name": "carol", "emails": {"a": 1}}\n{"name": "dave", "phone": [380111111112]}\n')
+        response = self.app.post('/import', content_type='multipart/form-data',
+                                 data={'file': (io.BytesIO(data.encode()), 'contacts.jsonl')})
+        result = json.loads(response.data)
+        self.assertEqual((result['imported'], result['rejected']), (2, 5))
+        self.assertEqual(result['errors'], [
+            {'row': 2, 'error': 'Contact must be an object.'},
+            {'row': 3, 'error': 'Contact must be an object.'},
+            {'row': 4, 'error': 'Name must be a string.'},
+            {'row': 5, 'error': 'Invalid birthday 19900101.'},
+            {'row': 6, 'error': 'emails must be a list of strings.'}])
+
+    def test_import_deleted_name(self):
+        """ test an import reusing the name of a soft deleted contact gets its own rows """
+        add_record()
+        self.app.post('/delete_record/1')
+        data = 'name,phone\ntest,380111111119\n'
+        response = self.app.post('/import', content_type='multipart/form-data',
+                                 data={'file': (io.BytesIO(data.encode()), 'contacts.csv')})
+        self.assertEqual(json.loads(response.data)['imported'], 1)
+        record = Record.query.filter_by(name='Test').one()
+        self.assertNotEqual(record.id, 1)
+        self.assertEqual([phone.number for phone in record.phones], ['380111111119'])
+        self.assertEqual(Phone.query.filter_by(records_id=1).count(), 1)
+
+    def test_import_vcard(self):
+        """ test vcard import """
+        data = ('BEGIN:VCARD\r\nVERSION:3.0\r\nFN:Eve\r\nBDAY:19851201\r\n'
+                'TEL;TYPE=cell:+380 33 333 3333\r\nEMAIL:eve@x.ua\r\n'
+                'NOTE:long\r\n  note\r\nCATEGORIES:club\r\nEND:VCARD\r\n')
+        response = self.app.post('/import?format=vcard', data=data.encode())
+        self.assertEqual(json.loads(response.data)['imported'], 1)
+        response = self.app.get('/', follow_redirects=True)
+        self.assertIn(b'1985-12-01', response.data)
+        self.assertIn(b'380333333333', response.data)
+        self.assertIn(b'long note', response.data)
+        self.assertIn(b'club', response.data)
+
+    def test_export(self):
+        """ test streamed export round trips through import """
+        add_record()
+        response = self.app.get('/export?format=json')
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        contacts = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertEqual(contacts[0]['phones'], ['380686543423'])
+        self.assertEqual(contacts[1]['name'], 'Test1')
+        response = self.app.get('/export?format=vcard')
+        self.assertIn(b'FN:Test1', response.data)
+        response = self.app.get('/export?format=csv')
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        response = self.app.post('/import?format=csv', data=response.data)
+        self.assertEqual(json.loads(response.data)['imported'], 2)
+        response = self.app.get('/export?format=xml')
+        self.assertEqual(response.status_code, 400)
+
+    def test_page_cache(self):
+        """ test listing pages are served from cache until a commit touches their tables """
+        add_record()
+        self.app.get('/', follow_redirects=True)
+        hits = cache.hits
+        response = self.app.get('/', follow_redirects=True)
+        # the page, the collection versions are read every time
+        self.assertEqual(cache.hits, hits + 1)
+        self.assertEqual(response.headers['X-Query-Count'], '1')
+        self.app.post('/edit_phone/1', buffered=True, content_type='multipart/form-data',
+                      data={'number': '380686543499'})
+        self.app.get('/', follow_redirects=True)
+        response = self.app.get('/', follow_redirects=True)
+        self.assertIn(b'380686543499', response.data)
+
+    def test_holidays_period_cache(self):
+        """ test birthday results are invalidated by record edits """
+        birthday = (date.today() + timedelta(days=3)).replace(year=1990)
+        db.session.add(Record(name='Soon', birthday=birthday))
+        db.session.commit()
+        response = self.app.post('/holidays_period', data={'period': '10'})
+        self.assertIn(b'Soon', response.data)
+        self.app.post('/edit_record/1', data={'name': 'Later', 'birthday': '1990-01-01'})
+        response = self.app.post('/holidays_period', data={'period': '10'})
+        self.assertNotIn(b'Soon', response.data)
+
+    def test_streaming(self):
+        """ test result pages stream their rows in order with per_page capped """
+        today = date.today()
+        db.session.add_all([Record(name='Stream{:02}'.format(i),
+                                   birthday=(today + timedelta(days=i + 2)).replace(year=1992))
+                            for i in range(12)])
+        db.session.commit()
+        app.config.update(STREAM_RESULTS=True, STREAM_YIELD_PER=5, MAX_PER_PAGE=10)
+        try:
+            response = self.app.get('/holidays_period?period=365')
+            self.assertTrue(response.is_streamed)
+            self.assertEqual(re.findall(rb'Stream(\d+) ', response.data),
+                             [b'%02d' % i for i in range(12)])
+            response = self.app.get('/holidays_period?period=0')
+            self.assertIn(b'No contacts with birthdays for this period.', response.data)
+            response = self.app.get('/search?q=stream&per_page=50')
+            self.assertTrue(response.is_streamed)
+            self.assertEqual(len(re.findall(rb'<h5>Stream\d+</h5>', response.data)), 10)
+            self.assertIn(b'page=2&amp;per_page=50', response.data)
+        finally:
+            app.config.update(STREAM_RESULTS=False, STREAM_YIELD_PER=100, MAX_PER_PAGE=1000)
+
+    def test_snapshots(self):
+        """ test the listing reads one row per contact and snapshots follow child writes """
+        add_record()
+        note = Note.query.get(1)
+        note.tags = [Tag(title='work')]
+        db.session.commit()
+        Tag.query.filter_by(title='work').one().title = 'job'
+        db.session.delete(Email.query.get(2))
+        db.session.commit()
+        self.assertEqual(stale_snapshots(db.session.connection()), [])
+        expected = self.app.get('/')
+        app.config['LISTING_SNAPSHOTS'] = True
+        try:
+            cache.clear()
+            response = self.app.get('/')
+            self.assertEqual(response.data, expected.data)
+            self.assertIn(b'job', response.data)
+            self.assertLess(int(response.headers['X-Query-Count']),
+                            int(expected.headers['X-Query-Count']))
+            self.assertIn(b'st. Test1 123', self.app.get('/search?q=test1').data)
+        finally:
+            app.config['LISTING_SNAPSHOTS'] = False
+        db.session.execute(Record.__table__.update().values(snapshot=None))
+        db.session.commit()
+        runner = app.test_cli_runner()
+        result = runner.invoke(snapshots_command, ['--check'])
+        self.assertEqual((result.exit_code, result.output.splitlines()[-1]),
+                         (1, '2 stale snapshots.'))
+        runner.invoke(snapshots_command)
+        self.assertEqual(runner.invoke(snapshots_command, ['--check']).exit_code, 0)
+
+    def test_read_rows(self):
+        """ test listing reads build slotted rows with Core and leave the identity map empty """
+        add_record()
+        db.session.remove()
+        rows = contact_rows(db.session.connection(),
+                            contact_statement().order_by(Record.name, Record.id))
+        self.assertEqual([row.name for row in rows], ['Test', 'Test1'])
+        self.assertIsInstance(rows[0], ContactRow)
+        self.assertFalse(hasattr(rows[0], '__dict__'))
+        self.assertEqual((rows[0].phones[0].number, rows[1].notes[0].title),
+                         ('380686543423', 'test1 note'))
+        self.assertEqual(sorted(row.name for row in upcoming_birthdays(365, date.today())),
+                         ['Test', 'Test1'])
+        self.assertEqual(len(db.session.identity_map), 0)
+        app.config['PAGINATION'] = 'offset'
+        self.assertIn(b'st. Test1 123', self.app.get('/?page=1').data)
+        self.assertEqual(self.app.get('/?page=2').status_code, 404)
+
+    def test_lru_cache(self):
+        """ test lru backend size and ttl eviction """
+        backend = LRUCache(max_entries=2, ttl=60)
+        backend.set('a', 1)
+        backend.set('b', 2)
+        backend.get('a')
+        backend.set('c', 3)
+        self.assertEqual(backend.get('a'), 1)
+        self.assertIsNone(backend.get('b'))
+        backend.set('d', 4, ttl=-1)
+        self.assertIsNone(backend.get('d'))
+        self.assertEqual(backend.generations(['records']), [0])
+        backend.bump(['records'])
+        self.assertEqual(backend.generations(['records', 'tags']), [1, 0])
+
+    def test_server_timing(self):
+        """ test per request timing headers """
+        add_record()
+        response = self.app.get('/', follow_redirects=True)
+        timing = response.headers['Server-Timing']
+        self.assertIn('sql;desc="{} queries"'.format(response.headers['X-Query-Count']), timing)
+        self.assertIn('render;dur=', timing)
+        self.assertIn('total;dur=', timing)
+
+    def test_metrics(self):
+        """ test prometheus metrics endpoint """
+        metrics.reset()
+        add_record()
+        # recorded once the server closes the response, the test client leaves that to us
+        self.app.get('/', follow_redirects=True).close()
+        self.app.get('/search?q=test', follow_redirects=True).close()
+        self.assertEqual(self.app.get('/metrics').status_code, 404)
+        app.config['METRICS_ENDPOINT'] = True
+        try:
+            response = self.app.get('/metrics')
+        finally:
+            app.config['METRICS_ENDPOINT'] = False
+        self.assertEqual(response.mimetype, 'text/plain')
+        self.assertIn(b'contacts_requests_total{endpoint="index",status="200"} 1', response.data)
+        self.assertIn(b'contacts_request_duration_seconds_count{endpoint="search"} 1',
+                      response.data)
+        self.assertIn(b'contacts_sql_queries_total{endpoint="index"}', response.data)
+        self.assertIn(b'contacts_cache_misses_total', response.data)
+        self.assertNotIn(b'endpoint="metrics_endpoint"', response.data)
+
+    def test_metrics_streamed(self):
+        """ test a streamed response is recorded with its body queries once it is closed """
+        metrics.reset()
+        add_record()
+        response = self.app.get('/export?format=json', buffered=False)
+        self.assertNotIn('export_records', metrics.endpoints)
+        self.assertIn(b'Test1', b''.join(response.response))
+        response.close()
+        stats = metrics.endpoints['export_records']
+        self.assertEqual(stats['requests'], {200: 1})
+        self.assertGreater(stats['queries'], int(response.headers['X-Query-Count']))
+
+    def test_failed_query_timing(self):
+        """ test a statement that raised leaves no start time behind on its connection """
+        with db.engine.connect() as connection:
+            with self.assertRaises(Exception):
+                connection.exec_driver_sql('SELECT * FROM no_such_table')
+            self.assertEqual(connection.info['query_start'], [])
+
+    def test_slow_query_log(self):
+        """ test queries over the threshold are logged """
+        app.config['SLOW_QUERY_MS'] = 0
+        try:
+            with self.assertLogs(app.logger, 'WARNING') as logs:
+                self.app.get('/', follow_redirects=True)
+        finally:
+            app.config['SLOW_QUERY_MS'] = None
+        self.assertIn('Slow query', logs.output[0])
+        self.assertIn('in index', logs.output[0])
+
+    def test_api_contacts(self):
+        """ test api listing with sparse fieldsets and cursors """
+        add_record()
+        response = self.app.get('/api/v1/contacts?fields=name,phones&limit=1')
+        data = json.loads(response.data)
+        self.assertEqual(data['items'], [{'id': 1, 'name': 'Test', 'phones': ['380686543423']}])
+        response = self.app.get('/api/v1/contacts?fields=name&after=' + data['next'])
+        self.assertEqual(json.loads(response.data)['items'], [{'id': 2, 'name': 'Test1'}])
+        response = self.app.get('/api/v1/contacts/2')
+        self.assertEqual(json.loads(response.data)['notes'], ['test1 note'])
+        self.assertEqual(self.app.get('/api/v1/contacts/9').status_code, 404)
+        self.assertEqual(self.app.get('/api/v1/contacts?fields=secret').status_code, 400)
+
+    def test_api_batch(self):
+        """ test batch create, update and delete in one transaction """
+        add_record()
+        response = self.app.post('/api/v1/contacts/batch', json={
+            'create': [{'name': 'alice', 'birthday': '1990-01-02', 'phones': ['380111111111'],
+                        'tags': ['friend']}],
+            'update': [{'id': 1, 'phones': ['380222222222'], 'emails': [], 'tags': ['work']}],
+            'delete': [2]})
+        self.assertEqual(json.loads(response.data),
+                         {'created': [3], 'updated': [1], 'deleted': [2]})
+        self.assertEqual(Record.query.get(3).name, 'Alice')
+        response = self.app.get('/api/v1/contacts/1?fields=phones,emails,notes,tags')
+        self.assertEqual(json.loads(response.data), {
+            'id': 1, 'phones': ['380222222222'], 'emails': [], 'notes': ['test note'],
+            'tags': ['work']})
+        response = self.app.get('/search?q=friend', follow_redirects=True)
+        self.assertIn(b'Alice', response.data)
+
+    def test_api_replace_phones(self):
+        """ test an api update resending a number the contact already has """
+        add_record()
+        response = self.app.patch('/api/v1/contacts/1',
+                                  json={'phones': ['380686543423', '380686543477']})
+        self.assertEqual(response.status_code, 200)
+        response = self.app.patch('/api/v1/contacts/1', json={'phones': ['380686543477']})
+        self.assertEqual(response.status_code, 200)
+        response = self.app.get('/api/v1/contacts/1?fields=phones')
+        self.assertEqual(json.loads(response.data)['phones'], ['380686543477'])
+
+    def test_api_batch_rollback(self):
+        """ test one invalid operation rejects the whole batch """
+        add_record()
+        response = self.app.post('/api/v1/contacts/batch', json={
+            'create': [{'name': 'bob', 'phones': ['380333333333']}],
+            'update': [{'id': 2, 'name': 'test'}]})
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(json.loads(response.data)['errors'],
+                         [{'op': 'update', 'index': 0, 'error': 'Please use a different name.'}])
+        response = self.app.post('/api/v1/contacts', json={'name': 'bob', 'phones': ['123']})
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(Record.query.count(), 2)
+
+    def test_api_phone_lookup(self):
+        """ test reverse phone lookup matches numbers in any written form """
+        add_record()
+        db.session.add(Record(name='Shared', phones=[Phone(number='380686543400')]))
+        db.session.commit()
+        self.assertEqual(Phone.query.get(1).normalized, '+380686543423')
+        response = self.app.get('/api/v1/phones/+38 (068) 654-34-23')
+        self.assertEqual(json.loads(response.data)['contacts'], [{'id': 1, 'name': 'Test'}])
+        response = self.app.post('/api/v1/phones/lookup', json={
+            'numbers': ['068 654 34 00', '00380686543423', '380000000000']})
+        items = json.loads(response.data)['items']
+        self.assertEqual(items[0], {'number': '068 654 34 00', 'normalized': '+380686543400',
+                                    'contacts': [{'id': 2, 'name': 'Test1'},
+                                                 {'id': 3, 'name': 'Shared'}]})
+        self.assertEqual(items[1]['contacts'], [{'id': 1, 'name': 'Test'}])
+        self.assertEqual(items[2]['contacts'], [])
+        response = self.app.post('/api/v1/phones/lookup', json={'numbers': '380686543423'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_phone_duplicate(self):
+        """ test a contact cannot hold the same number twice """
+        add_record()
+        db.session.add(Phone(number='380111111111', records_id=1))
+        db.session.commit()
+        response = self.app.post('/edit_phone/3', data={'number': '380686543423'})
+        self.assertIn(b'The contact already has this number.', response.data)
+        response = self.app.patch('/api/v1/contacts/1',
+                                  json={'phones': ['380222222222', '380222222222']})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([phone.number for phone in Record.query.get(1).phones],
+                         ['380222222222'])
+
+    def test_duplicates(self):
+        """ test suggestions from shared phones, emails and sound-alike names """
+        add_record()
+        db.session.add(Record(name='Robert', birthday=date(1980, 5, 1)))
+        db.session.add(Record(name='Rupert', birthday=date(1980, 5, 1)))
+        db.session.add(Record(name='Tset', phones=[Phone(number='0686543423')],
+                              emails=[Email(title='TEST@test.ua')]))
+        db.session.commit()
+        self.assertEqual(Record.query.get(3).name_key, 'R163')
+        response = self.app.get('/api/v1/duplicates')
+        self.assertEqual(json.loads(response.data)['items'], [
+            {'records': [1, 5], 'score': 8, 'reasons': ['phone', 'email', 'name']},
+            {'records': [3, 4], 'score': 3, 'reasons': ['name', 'birthday']}])
+
+    def test_duplicates_large_block(self):
+        """ test a common name block is split on the birth year, and too large ones reported """
+        db.session.add_all(Record(name='Smith' + 'e' * number, birthday=date(1990, 1, 1 + number))
+                           for number in range(MAX_BLOCK + 1))
+        db.session.add(Record(name='Smithy', birthday=date(1980, 5, 1)))
+        db.session.add(Record(name='Smitha', birthday=date(1980, 5, 1)))
+        db.session.commit()
+        self.assertEqual(len({record.name_key for record in Record.query}), 1)
+        response = json.loads(self.app.get('/api/v1/duplicates').data)
+        self.assertEqual(response['items'], [
+            {'records': [22, 23], 'score': 3, 'reasons': ['name', 'birthday']}])
+        self.assertEqual(response['skipped_blocks'], 1)
+
+    def test_merge(self):
+        """ test merge moves child rows and tags onto the kept contact """
+        add_record()
+        self.app.post('/add_tag/2', data={'title': 'work'})
+        db.session.add(Phone(number='380686543423', records_id=2))
+        db.session.add(Note(title='test note', records_id=2))
+        db.session.commit()
+        response = self.app.post('/api/v1/contacts/1/merge', json={'ids': [2]})
+        contact = json.loads(response.data)
+        self.assertEqual(contact['phones'], ['380686543423', '380686543400'])
+        self.assertEqual(contact['emails'], ['test@test.ua', 'test1@test.ua'])
+        self.assertEqual(contact['notes'], ['test note', 'test1 note'])
+        self.assertEqual(contact['tags'], ['work'])
+        self.assertIsNone(Record.query.get(2))
+        response = self.app.get('/search?q=test1@test.ua', follow_redirects=True)
+        self.assertIn(b'st. Test 123', response.data)
+        self.assertEqual(self.app.post('/api/v1/contacts/1/merge',
+                                       json={'ids': [2]}).status_code, 404)
+        self.assertEqual(self.app.post('/api/v1/contacts/1/merge',
+                                       json={'ids': [1]}).status_code, 422)
+
+    @unittest.skipUnless(importlib.util.find_spec('aiosqlite'), 'needs requirements-async.txt')
+    def test_asgi_reads(self):
+        """ test the async read views render like the WSGI ones and delegate the rest """
+        if TEST_DATABASE_URL.startswith('postgresql') and not importlib.util.find_spec('asyncpg'):
+            self.skipTest('needs requirements-postgres.txt')
+        from book.asgi import AsyncReads
+        add_record()
+        application = AsyncReads(app)
+
+        async def call(method, path, query=b'', body=b''):
+            messages = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+
+            async def send(message):
+                messages.append(message)
+
+            await application({'type': 'http', 'method': method, 'path': path,
+                               'query_string': query, 'root_path': '', 'http_version': '1.1',
+                               'headers': [
+                                   (b'content-type', b'application/x-www-form-urlencoded')]},
+                              receive, send)
+            return messages[0]['status'], b''.join(message.get('body', b'')
+                                                   for message in messages[1:])
+
+        async def run():
+            try:
+                return [await call('GET', '/'),
+                        await call('GET', '/search', b'q=test1'),
+                        await call('POST', '/holidays_period', body=b'period=365'),
+                        await call('GET', '/edit_phone/1')]
+            finally:
+                await application.stop()
+
+        index, found, holidays, edit = asyncio.run(run())
+        self.assertEqual(index[0], 200)
+        self.assertIn(b'st. Test1 123', index[1])
+        self.assertIn(b'2 contacts', index[1])
+        self.assertIn(b'st. Test1 123', found[1])
+        self.assertNotIn(b'st. Test 123', found[1])
+        self.assertIn(b'days left till next birthday', holidays[1])
+        self.assertEqual(edit[0], 200)
+        self.assertIn(b'380686543423', edit[1])
+
+    def test_change_log(self):
+        """ test every flushed row is logged in sequence against its contact """
+        add_record()
+        note = Note.query.get(1)
+        note.tags = [Tag(title='work')]
+        db.session.commit()
+        Tag.query.filter_by(title='work').one().title = 'job'
+        db.session.delete(Email.query.get(2))
+        db.session.commit()
+        changes = [(change.table_name, change.row_id, change.records_id, change.operation)
+                   for change in Change.query.order_by(Change.seq)]
+        self.assertEqual(changes[:10:5], [('records', 1, 1, 'insert'),
+                                          ('records', 2, 2, 'insert')])
+        self.assertEqual(set(changes[10:13]), {('tags', 1, 1, 'insert'),
+                                               ('notes', 1, 1, 'update'),
+                                               ('records', 1, 1, 'update')})
+        self.assertEqual(set(changes[13:]), {('tags', 1, 1, 'update'),
+                                             ('records', 2, 2, 'update'),
+                                             ('emails', 2, 2, 'delete')})
+        self.assertEqual([change.seq for change in Change.query.order_by(Change.seq)],
+                         list(range(1, 17)))
+
+    def test_change_log_lock(self):
+        """ test change log writers commit in sequence order on PostgreSQL """
+        if not TEST_DATABASE_URL.startswith('postgresql'):
+            self.skipTest('SQLite has a single writer')
+        add_record()
+        Phone.query.get(1).number = '380686543411'
+        db.session.flush()
+        written = threading.Event()
+
+        def write():
+            with app.app_context():
+                # a tag alone shares no collection version row with the phone edit
+                db.session.add(Tag(title='solo'))
+                db.session.commit()
+                written.set()
+
+        thread = threading.Thread(target=write)
+        thread.start()
+        self.assertFalse(written.wait(0.5))
+        db.session.commit()
+        thread.join()
+        changes = [change.table_name for change in Change.query.order_by(Change.seq)]
+        self.assertEqual(changes[-1], 'tags')
+
+    def test_api_sync(self):
+        """ test incremental sync pages changed contacts after a cursor """
+        add_record()
+        cursor = json.loads(self.app.get('/api/v1/changes').data)['cursor']
+        self.app.patch('/api/v1/contacts/1', json={'phones': ['380999999999']})
+        self.app.delete('/api/v1/contacts/2')
+        response = self.app.get('/api/v1/changes?fields=name,phones&limit=3&since={}'
+                                .format(cursor))
+        data = json.loads(response.data)
+        self.assertEqual(data['contacts'], [{'id': 1, 'name': 'Test',
+                                             'phones': ['380999999999']}])
+        self.assertEqual((data['deleted'], data['more']), ([], True))
+        response = self.app.get('/api/v1/changes?since={}'.format(data['cursor']),
+                                headers={'Accept-Encoding': 'gzip'})
+        data = json.loads(gzip.decompress(response.data)) \
+            if response.headers.get('Content-Encoding') == 'gzip' else json.loads(response.data)
+        self.assertEqual((data['deleted'], data['more']), ([2], False))
+        self.assertEqual(json.loads(self.app.get('/api/v1/changes?since={}'.format(
+            data['cursor'])).data)['changes'], [])
+        db.session.add(Record(name='Later'))
+        db.session.commit()
+        purge_deleted(datetime.utcnow() + timedelta(days=1), 10)
+        self.assertEqual(prune_changes(datetime.utcnow() + timedelta(seconds=1), 5), 19)
+        self.assertEqual(self.app.get('/api/v1/changes?since=0').status_code, 410)
+        cursor = json.loads(self.app.get('/api/v1/changes').data)['cursor']
+        self.assertEqual(len(json.loads(self.app.get('/api/v1/changes?since={}'.format(
+            cursor - 1)).data)['changes']), 1)
+
+    def test_conditional_get(self):
+        """ test listing pages answer 304 until a write moves the versions of their tables """
+        add_record()
+        response = self.app.get('/')
+        etag = response.headers['ETag']
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+        response = self.app.get('/', headers={'If-None-Match': etag})
+        self.assertEqual((response.status_code, response.data), (304, b''))
+        self.assertEqual(self.app.get('/?tag=work', headers={'If-None-Match': etag})
+                         .status_code, 200)
+        self.app.post('/edit_phone/1', buffered=True, content_type='multipart/form-data',
+                      data={'number': '380686543499'})
+        self.assertNotIn('ETag', self.app.get('/').headers)
+        response = self.app.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        response = self.app.get('/holidays_period?period=365')
+        self.assertIn(b'days left till next birthday', response.data)
+        self.assertEqual(self.app.get('/holidays_period?period=365', headers={
+            'If-None-Match': response.headers['ETag']}).status_code, 304)
+        CollectionVersion.query.update({'changed_at': datetime.utcnow() - timedelta(days=1)})
+        db.session.commit()
+        cache.clear()
+        response = self.app.get('/search?q=test1')
+        self.assertEqual(self.app.get('/search?q=test1', headers={
+            'If-Modified-Since': response.headers['Last-Modified']}).status_code, 304)
+        self.app.post('/search', data={'contact': ''})
+        self.assertNotIn('ETag', self.app.get('/').headers)
+        etag = self.app.get('/').headers['ETag']
+        # a commit of another worker process, its cache invalidation stays over there
+        with db.engine.begin() as connection:
+            connection.execute(CollectionVersion.__table__.update().values(
+                version=CollectionVersion.version + 1))
+        self.assertEqual(self.app.get('/', headers={'If-None-Match': etag}).status_code, 200)
+
+    def test_compression(self):
+        """ test large pages are compressed for clients accepting it, with their own ETag """
+        add_record()
+        response = self.app.get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn(b'st. Test1 123', gzip.decompress(response.data))
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        etag = response.headers['ETag']
+        self.assertTrue(etag.endswith('-gzip"'))
+        response = self.app.get('/', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual((response.status_code, response.headers['ETag']), (304, etag))
+        response = self.app.get('/')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.headers['ETag'], etag.replace('-gzip', ''))
+        response = self.app.get('/api/v1/contacts/1', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_memory_database_pool(self):
+        """ test an in-memory database is one database for every thread of the engine """
+        engine = db.create_engine('sqlite://', engine_options('sqlite://'))
+        with engine.begin() as connection:
+            connection.exec_driver_sql('CREATE TABLE t (x INTEGER)')
+            connection.exec_driver_sql('INSERT INTO t VALUES (1)')
+        rows = []
+
+        def read():
+            with engine.connect() as connection:
+                rows.extend(connection.exec_driver_sql('SELECT x FROM t').fetchall())
+
+        # a connection checked out elsewhere, a pool would open the reader a new one
+        with engine.connect():
+            thread = threading.Thread(target=read)
+            thread.start()
+            thread.join()
+        self.assertEqual(rows, [(1,)])
+        self.assertEqual(engine_options('sqlite:///' + TEST_DB)['pool_size'], 5)
+
 
 if __name__ == "__main__":
     unittest.main()